@@ -0,0 +1,112 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Benchmark for the ServerQuery codec and response parser.
+
+This builds a `clientlist -uid -away -voice` response of the same shape as
+one recorded from a live server, and times escaping, unescaping and parsing
+it. Run it from your Ultros directory, with this package installed:
+
+    python path/to/Teamspeak/benchmarks/codec.py [clients]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+import utils.teamspeak as utils
+
+
+def make_client(clid):
+    return {
+        "clid": clid,
+        "cid": clid % 40 + 1,
+        "client_database_id": clid + 1000,
+        "client_nickname": "Player %s | [Clan/Tag]" % clid,
+        "client_type": 0,
+        "client_unique_identifier": "aBcD%08d/xyz+QWE=" % clid,
+        "client_away": clid % 7 == 0 and 1 or 0,
+        "client_away_message": clid % 7 == 0 and "brb, getting food" or "",
+        "client_flag_talking": 0,
+        "client_input_muted": clid % 3 == 0 and 1 or 0,
+        "client_output_muted": 0,
+        "client_input_hardware": 1,
+        "client_output_hardware": 1,
+        "client_talk_power": 75,
+        "client_is_talker": 0,
+        "client_is_priority_speaker": 0,
+        "client_is_recording": 0,
+        "client_is_channel_commander": 0,
+    }
+
+
+def make_response(count):
+    rows = []
+
+    for clid in xrange(1, count + 1):
+        rows.append(" ".join(
+            "%s=%s" % (k, utils.escape(v)) if v != "" else k
+            for k, v in sorted(make_client(clid).items())
+        ))
+
+    return "|".join(rows)
+
+
+def old_unescape(instr):
+    # The chained str.replace version this codec replaced, for comparison
+    instr = str(instr)
+    for a, b in (("\\s", " "), ("\\n", "\n"), ("\\r", "\r"), ("\\t", "\t"),
+                 ("\\p", "|"), ("\\a", "\7"), ("\\b", "\\8"), ("\\f", "\12"),
+                 ("\\v", "\11"), ("\\/", "/"), ("\\\\", "\\")):
+        instr = instr.replace(a, b)
+    return instr
+
+
+def old_parse(line):
+    rows = []
+
+    for chunk in line.split("|"):
+        done = {}
+        for pair in chunk.split():
+            double = pair.split("=", 1)
+            if len(double) != 2:
+                continue
+            done[double[0]] = old_unescape(double[1])
+        rows.append(done)
+
+    return rows
+
+
+def bench(name, func, number):
+    taken = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print "%-36s %10.3f ms" % (name, taken * 1000)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    line = make_response(count)
+    nicknames = [make_client(i)["client_nickname"] for i in xrange(count)]
+    escaped = [utils.escape(n) for n in nicknames]
+
+    print "clientlist -uid -away -voice: %s clients, %s bytes" % (
+        count, len(line)
+    )
+    print
+
+    bench("escape (per list)", lambda: [utils.escape(n) for n in nicknames],
+          10)
+    bench("unescape (per list)",
+          lambda: [utils.unescape(n) for n in escaped], 10)
+    bench("unescape, chained replace (per list)",
+          lambda: [old_unescape(n) for n in escaped], 10)
+    bench("parse, eager (old)", lambda: old_parse(line), 5)
+    bench("parse, all rows", lambda: list(utils.parse_line(line)), 5)
+    bench("parse, lazy - first row only",
+          lambda: utils.parse_line(line)[0], 5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+A local stand-in for a Teamspeak ServerQuery server.
+
+This implements just enough of ServerQuery for the protocol to log in and
+run - login, use, clientupdate, servernotifyregister, whoami, channellist,
+clientlist, sendtextmessage and quit - against a set of generated virtual
+servers. It can pretend to have lots of clients, reply slowly, and push
+notifications at a given rate, so the protocol can be tested and
+benchmarked without a real server.
+
+It can also be run on its own, to point a development copy of Ultros at:
+
+    python path/to/Teamspeak/benchmarks/fake_server.py [options]
+"""
+
+import itertools
+import optparse
+import os
+import random
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+
+sys.path.insert(0, os.getcwd())
+
+import utils.teamspeak as utils
+
+#: Kinds of notification we generate - the event type a connection has to
+#: register for to get them, and how often they're picked
+NOTIFICATIONS = (
+    ("moved", "channel", 0.5),
+    ("entered", "server", 0.15),
+    ("left", "server", 0.15),
+    ("text", "textserver", 0.2)
+)
+
+
+class FakeVirtualServer(object):
+
+    def __init__(self, sid, channels, clients):
+        self.sid = str(sid)
+        self.channels = []
+        self.clients = {}
+        self.next_clid = itertools.count(1000)
+
+        for cid in xrange(1, channels + 1):
+            self.channels.append({
+                "cid": str(cid),
+                "pid": "0",
+                "channel_order": str(cid - 1),
+                "channel_name": "Channel %s" % cid,
+                "channel_topic": "Topic for channel %s" % cid,
+                "channel_flag_default": "1" if cid == 1 else "0",
+                "channel_flag_password": "0",
+                "channel_flag_permanent": "1",
+                "channel_maxclients": "-1",
+                "total_clients": "0"
+            })
+
+        for _ in xrange(clients):
+            self.add_client()
+
+    def add_client(self, cid=None):
+        clid = str(self.next_clid.next())
+
+        client = {
+            "clid": clid,
+            "cid": cid or random.choice(self.channels)["cid"],
+            "client_database_id": clid,
+            "client_nickname": "Fake user %s" % clid,
+            "client_type": "0",
+            "client_unique_identifier": "fake%s/uid=" % clid,
+            "client_away": "0",
+            "client_away_message": "",
+            "client_flag_talking": "0",
+            "client_input_muted": "0",
+            "client_output_muted": "0",
+            "client_talk_power": "75",
+            "client_servergroups": "8",
+            "client_channel_group_id": "8",
+            "client_version": "3.0.16 [Build: 1407159763]",
+            "client_platform": "Linux"
+        }
+
+        self.clients[clid] = client
+        return client
+
+
+class FakeQueryProtocol(LineReceiver):
+    """
+    One ServerQuery client connected to the fake server.
+    """
+
+    delimiter = "\n"
+
+    def __init__(self, server):
+        self.server = server
+        self.logged_in = False
+        self.selected = None
+        self.registered = set()
+        self.clid = None
+
+    def connectionMade(self):
+        self.server.connections.append(self)
+
+        self.send_line("TS3")
+        self.send_line(
+            "Welcome to the TeamSpeak 3 ServerQuery interface, type \"help\" "
+            "for a list of commands and \"help <command>\" for information "
+            "on a specific command."
+        )
+
+    def connectionLost(self, reason=None):
+        if self in self.server.connections:
+            self.server.connections.remove(self)
+
+    def send_line(self, line):
+        self.transport.write("%s\n\r" % line)
+
+    def send_rows(self, rows):
+        self.send_line("|".join(
+            " ".join("%s=%s" % (k, utils.escape(v)) if v != "" else k
+                     for k, v in row.iteritems())
+            for row in rows
+        ))
+
+    def send_error(self, error_id=0, msg="ok"):
+        self.send_line("error id=%s msg=%s" % (error_id, utils.escape(msg)))
+
+    def lineReceived(self, line):
+        line = line.strip()
+
+        if not line:
+            return
+
+        self.server.counters["commands"] += 1
+        words = line.split()
+        command = words[0].lower()
+        args = utils.parse_words(w for w in words[1:] if "=" in w)
+
+        handler = getattr(self, "cmd_%s" % command, None)
+
+        if handler is None:
+            return self.reply(self.send_error, 256, "command not found")
+
+        self.reply(handler, args)
+
+    def reply(self, func, *args):
+        delay = self.server.reply_delay
+
+        if delay:
+            reactor.callLater(delay, func, *args)
+        else:
+            func(*args)
+
+    @property
+    def virtual(self):
+        return self.server.virtual_servers.get(self.selected, None)
+
+    def cmd_login(self, args):
+        self.logged_in = True
+        self.send_error()
+
+    def cmd_use(self, args):
+        sid = args.get("sid", None)
+
+        if sid not in self.server.virtual_servers:
+            return self.send_error(1024, "invalid serverID")
+
+        if self.selected is not None and self.clid is not None:
+            self.server.virtual_servers[self.selected].clients.pop(
+                self.clid, None
+            )
+
+        self.selected = sid
+        self.clid = self.virtual.add_client(cid="1")["clid"]
+        self.virtual.clients[self.clid]["client_type"] = "1"
+        self.send_error()
+
+    def cmd_clientupdate(self, args):
+        if self.virtual is None:
+            return self.send_error(1024, "invalid serverID")
+
+        self.virtual.clients[self.clid].update(args)
+        self.send_error()
+
+    def cmd_servernotifyregister(self, args):
+        if self.virtual is None:
+            return self.send_error(1024, "invalid serverID")
+
+        self.registered.add((self.selected, args.get("event", None)))
+        self.send_error()
+
+    def cmd_whoami(self, args):
+        if self.virtual is None:
+            self.send_rows([{"virtualserver_status": "unknown",
+                             "client_id": "0", "client_channel_id": "0"}])
+            return self.send_error()
+
+        self.send_rows([{
+            "virtualserver_status": "online",
+            "virtualserver_id": self.selected,
+            "client_id": self.clid,
+            "client_channel_id": self.virtual.clients[self.clid]["cid"],
+            "client_nickname":
+                self.virtual.clients[self.clid]["client_nickname"]
+        }])
+        self.send_error()
+
+    def cmd_channellist(self, args):
+        if self.virtual is None:
+            return self.send_error(1024, "invalid serverID")
+
+        self.send_rows(self.virtual.channels)
+        self.send_error()
+
+    def cmd_clientlist(self, args):
+        if self.virtual is None:
+            return self.send_error(1024, "invalid serverID")
+
+        self.send_rows(self.virtual.clients.values())
+        self.send_error()
+
+    def cmd_sendtextmessage(self, args):
+        if self.virtual is None:
+            return self.send_error(1024, "invalid serverID")
+
+        self.server.counters["messages"] += 1
+        self.server.messages.append(args)
+        self.send_error()
+
+    def cmd_quit(self, args):
+        self.send_error()
+        self.transport.loseConnection()
+
+
+class FakeServer(Factory):
+    """
+    The fake ServerQuery server itself.
+
+    :param servers: Number of virtual servers, with sids starting at 1
+    :param channels: Number of channels per virtual server
+    :param clients: Number of clients per virtual server
+    :param reply_delay: Seconds to wait before replying to each command
+    """
+
+    def __init__(self, servers=1, channels=20, clients=100, reply_delay=0):
+        self.virtual_servers = {}
+        self.connections = []
+        self.messages = []
+        self.reply_delay = reply_delay
+        self.notify_task = None
+
+        self.counters = {"commands": 0, "messages": 0, "notifications": 0}
+
+        for sid in xrange(1, servers + 1):
+            self.virtual_servers[str(sid)] = FakeVirtualServer(
+                sid, channels, clients
+            )
+
+    def buildProtocol(self, addr):
+        return FakeQueryProtocol(self)
+
+    def listen(self, port=0, interface="127.0.0.1"):
+        """
+        Start listening, returning the port that we're listening on.
+        """
+
+        return reactor.listenTCP(port, self, interface=interface)
+
+    ## Notifications
+
+    def make_notification(self, virtual, events):
+        """
+        Generate a random, but valid, notification for a virtual server,
+        updating its state to match. Only notifications for the given event
+        types are generated - if there aren't any we can make, this returns
+        None and leaves the state alone.
+        """
+
+        cid = random.choice(virtual.channels)["cid"]
+        others = [c for c in virtual.clients.itervalues()
+                  if c["client_type"] == "0"]
+
+        kinds = [
+            (kind, weight) for kind, event, weight in NOTIFICATIONS
+            if event in events and (others or kind == "entered")
+        ]
+
+        if not kinds:
+            return None
+
+        roll = random.random() * sum(weight for _, weight in kinds)
+
+        for kind, weight in kinds:
+            if roll < weight:
+                break
+            roll -= weight
+
+        if kind == "moved":
+            client = random.choice(others)
+            client["cid"] = cid
+
+            return "notifyclientmoved", "channel", {
+                "ctid": cid, "reasonid": "0", "clid": client["clid"]
+            }
+        elif kind == "entered":
+            client = virtual.add_client(cid)
+            row = dict(client)
+
+            row.update({"cfid": "0", "ctid": cid, "reasonid": "0"})
+            del row["cid"]
+
+            return "notifycliententerview", "server", row
+        elif kind == "left":
+            client = random.choice(others)
+            del virtual.clients[client["clid"]]
+
+            return "notifyclientleftview", "server", {
+                "cfid": client["cid"], "ctid": "0", "reasonid": "8",
+                "reasonmsg": "leaving", "clid": client["clid"]
+            }
+        else:
+            client = random.choice(others)
+
+            return "notifytextmessage", "textserver", {
+                "targetmode": "3",
+                "msg": "Message number %s | with some /escapes/"
+                       % self.counters["notifications"],
+                "invokerid": client["clid"],
+                "invokername": client["client_nickname"],
+                "invokeruid": client["client_unique_identifier"]
+            }
+
+    def notify(self, count=1):
+        """
+        Send `count` notifications to every registered connection.
+        """
+
+        for _ in xrange(count):
+            for conn in list(self.connections):
+                virtual = conn.virtual
+
+                if virtual is None:
+                    continue
+
+                # Only touch the state for notifications that will be sent,
+                # or the connection's view of it would drift
+                events = set(
+                    event for sid, event in conn.registered
+                    if sid == conn.selected
+                )
+                notification = self.make_notification(virtual, events)
+
+                if notification is None:
+                    continue
+
+                name, _, row = notification
+
+                conn.send_line("%s %s" % (name, " ".join(
+                    "%s=%s" % (k, utils.escape(v)) for k, v in row.iteritems()
+                )))
+                self.counters["notifications"] += 1
+
+    def start_notifying(self, rate, batch=1):
+        """
+        Send notifications to each connection at roughly `rate` per second.
+        """
+
+        self.stop_notifying()
+
+        interval = float(batch) / rate
+        self.notify_task = LoopingCall(self.notify, batch)
+        self.notify_task.start(interval, False)
+
+    def stop_notifying(self):
+        if self.notify_task is not None and self.notify_task.running:
+            self.notify_task.stop()
+        self.notify_task = None
+
+
+def main():
+    parser = optparse.OptionParser()
+
+    parser.add_option("-p", "--port", type="int", default=10011)
+    parser.add_option("-s", "--servers", type="int", default=1)
+    parser.add_option("-c", "--channels", type="int", default=20)
+    parser.add_option("-u", "--clients", type="int", default=100)
+    parser.add_option("-d", "--delay", type="float", default=0,
+                      help="Seconds to wait before each reply")
+    parser.add_option("-n", "--notify-rate", type="float", default=0,
+                      help="Notifications per second, per connection")
+
+    options, _ = parser.parse_args()
+
+    server = FakeServer(options.servers, options.channels, options.clients,
+                        options.delay)
+    server.listen(options.port)
+
+    if options.notify_rate:
+        reactor.callWhenRunning(server.start_notifying, options.notify_rate)
+
+    print "Fake ServerQuery listening on port %s" % options.port
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
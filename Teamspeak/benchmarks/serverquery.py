@@ -0,0 +1,234 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Benchmark for the Teamspeak protocol, run against the fake ServerQuery
+server in fake_server.py.
+
+This measures command round-trip times, how many notifications per second
+the protocol can handle, and how much CPU it uses doing so. Run it from your
+Ultros directory, with this package installed:
+
+    python path/to/Teamspeak/benchmarks/serverquery.py [options]
+"""
+
+import json
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.protocol import ClientFactory
+from twisted.internet.task import deferLater
+
+from fake_server import FakeServer
+
+from system.protocols.teamspeak.protocol import Protocol
+
+
+class BenchmarkFactory(ClientFactory):
+    """
+    Stands in for Ultros' factory, which just hands out the protocol.
+    """
+
+    protocol_object = None
+
+    def buildProtocol(self, addr):
+        return self.protocol_object
+
+
+def cpu_time():
+    return sum(os.times()[:2])
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+@inlineCallbacks
+def wait_for(predicate, timeout=30):
+    started = time.time()
+
+    while not predicate():
+        if time.time() - started > timeout:
+            raise RuntimeError("Timed out waiting for the protocol")
+        yield deferLater(reactor, 0.05, lambda: None)
+
+
+@inlineCallbacks
+def bench_round_trip(protocol, count):
+    def run():
+        times = []
+
+        for _ in xrange(count):
+            started = time.time()
+            protocol.send_command("whoami", output=False)
+            times.append((time.time() - started) * 1000)
+
+        return times
+
+    times = yield threads.deferToThread(run)
+
+    returnValue({
+        "commands": count,
+        "mean_ms": sum(times) / len(times),
+        "p50_ms": percentile(times, 50),
+        "p99_ms": percentile(times, 99)
+    })
+
+
+@inlineCallbacks
+def bench_notify(protocol, server, count):
+    counted = [0]
+    original = protocol.handle_notify
+
+    def handle_notify(conn, data):
+        counted[0] += 1
+        return original(conn, data)
+
+    protocol.handle_notify = handle_notify
+
+    cpu = cpu_time()
+    started = time.time()
+
+    # In batches, so the reactor gets to read in between
+    batch = 500
+    sent = 0
+
+    while sent < count:
+        server.notify(min(batch, count - sent))
+        sent += batch
+        yield deferLater(reactor, 0, lambda: None)
+
+    yield wait_for(lambda: counted[0] >= server.counters["notifications"])
+
+    taken = time.time() - started
+    cpu = cpu_time() - cpu
+
+    del protocol.handle_notify
+
+    returnValue({
+        "notifications": counted[0],
+        "seconds": taken,
+        "per_second": counted[0] / taken,
+        "cpu_seconds": cpu
+    })
+
+
+@inlineCallbacks
+def bench_idle(seconds):
+    cpu = cpu_time()
+    yield deferLater(reactor, seconds, lambda: None)
+
+    returnValue({
+        "seconds": seconds,
+        "cpu_percent": (cpu_time() - cpu) / seconds * 100
+    })
+
+
+@inlineCallbacks
+def run(options):
+    server = FakeServer(options.servers, options.channels, options.clients,
+                        options.delay)
+    port = server.listen()
+
+    factory = BenchmarkFactory()
+    config = {
+        "server": {
+            "address": "127.0.0.1",
+            "port": port.getHost().port,
+            "sid": 1,
+            "sids": range(1, options.servers + 1),
+            "connections": options.connections
+        },
+        "identity": {
+            "nickname": "Benchmark",
+            "username": "serveradmin",
+            "password": "password"
+        },
+        "flood": {"commands": 1000000, "time": 1},
+        "state": {"reconcile_interval": 0}
+    }
+
+    factory.protocol_object = Protocol(factory, config)
+    protocol = factory.protocol_object
+
+    started = time.time()
+
+    def ready():
+        if protocol.default_server.client_id is None:
+            return False
+        return len(protocol.state.clients) >= options.clients
+
+    yield wait_for(ready)
+
+    results = {
+        "options": vars(options),
+        "login_and_seed_seconds": time.time() - started
+    }
+
+    results["round_trip"] = yield bench_round_trip(protocol, options.commands)
+    results["notify"] = yield bench_notify(
+        protocol, server, options.notifications
+    )
+    results["idle"] = yield bench_idle(options.idle)
+    results["stats"] = protocol.get_stats()
+
+    protocol.shutdown()
+    yield port.stopListening()
+
+    returnValue(results)
+
+
+def main():
+    parser = optparse.OptionParser()
+
+    parser.add_option("-s", "--servers", type="int", default=1)
+    parser.add_option("-c", "--channels", type="int", default=50)
+    parser.add_option("-u", "--clients", type="int", default=2000)
+    parser.add_option("--connections", type="int", default=1)
+    parser.add_option("-d", "--delay", type="float", default=0,
+                      help="Seconds the server waits before each reply")
+    parser.add_option("--commands", type="int", default=1000)
+    parser.add_option("--notifications", type="int", default=20000)
+    parser.add_option("--idle", type="float", default=5,
+                      help="Seconds to measure idle CPU use over")
+    parser.add_option("-o", "--output", default=None,
+                      help="Write the results to this file as JSON")
+
+    options, _ = parser.parse_args()
+    results = {}
+
+    def done(result):
+        results.update(result)
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: run(options).addCallbacks(done, failed)
+    )
+    reactor.run()
+
+    if not results:
+        sys.exit(1)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(output)
+
+    print output
+
+
+if __name__ == "__main__":
+    main()
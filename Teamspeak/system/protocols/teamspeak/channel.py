@@ -6,11 +6,13 @@ from system.protocols.generic import channel
 
 
 class Channel(channel.Channel):
-    def __init__(self, protocol, name, cid):
+    def __init__(self, protocol, name, cid, sid=None):
         self.protocol = protocol
         self.name = name
         self.users = set()
         self.cid = cid
+        self.sid = sid  # Virtual server this channel is on
+        self.data = {}  # Latest channellist properties for this channel
 
     def __str__(self):
         return self.name
@@ -28,4 +30,4 @@ class Channel(channel.Channel):
                 % (user, self))
 
     def respond(self, message):
-        self.protocol.send_message(2, self.cid, message)
+        self.protocol.send_message(2, self.cid, message, sid=self.sid)
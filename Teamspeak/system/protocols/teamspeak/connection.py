@@ -0,0 +1,254 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+ServerQuery connections.
+
+One protocol may have several of these open to the same ServerQuery port;
+each one logs in separately and switches between virtual servers with
+`use sid=` as commands require.
+"""
+
+import time
+import utils.teamspeak as utils
+
+from Queue import Queue
+from threading import Lock
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ClientFactory, Protocol
+
+
+class QueryConnection(Protocol):
+    """
+    A single ServerQuery connection.
+
+    Lines are framed and handled on the reactor - notifications are passed
+    to the owning protocol, and everything else is treated as a response to
+    whichever command is waiting in `send_command()`, which blocks and
+    should only be called from the threadpool.
+    """
+
+    manager = None  # The Teamspeak protocol this belongs to
+    index = 0
+
+    home = None  # The sid we're registered for notifications on, if any
+    selected = None  # The sid that's currently selected
+
+    last_used = 0
+    logged_in = False
+
+    def __init__(self, manager, index=0):
+        self.manager = manager
+        self.index = index
+
+        self.line_buffer = utils.LineBuffer()
+        self.responses = Queue()
+        self.mutex = Lock()
+
+        self.last_used = time.time()
+
+    def __str__(self):
+        return "Connection %s" % self.index
+
+    @property
+    def busy(self):
+        return self.mutex.locked()
+
+    @property
+    def idle_time(self):
+        return time.time() - self.last_used
+
+    def connectionMade(self):
+        self.line_buffer.clear()
+        self.last_used = time.time()
+
+    def connectionLost(self, reason=None):
+        self.logged_in = False
+
+        # Don't leave a command waiting forever for its response
+        self.responses.put("error id=-1 msg=Connection\\slost")
+        self.manager.connection_lost(self, reason)
+
+    def dataReceived(self, data):
+        self.manager.count(self.selected, "bytes_in", len(data))
+
+        for line in self.line_buffer.feed(data):
+            if not line:
+                continue
+            self.manager.log.trace("<- [%s] %s" % (self.index, line))
+            self.handle_line(line)
+
+    def handle_line(self, line):
+        lower = line.lower()
+
+        if lower.startswith("ts3"):
+            self.manager.log.info("%s: Connected." % self)
+        elif lower.startswith("welcome to the"):
+            self.manager.connection_ready(self)
+        elif lower.startswith("notify"):
+            self.manager.handle_notify(self, line)
+        else:
+            self.responses.put(line)
+
+    def count(self, sid, counter, amount=1):
+        """
+        Update one of a server's counters. They're also updated on the
+        reactor, by dataReceived(), so we don't touch them from a thread.
+        """
+
+        reactor.callFromThread(self.manager.count, sid, counter, amount)
+
+    def write_line(self, data):
+        self.count(self.selected, "bytes_out", len(data) + 1)
+        reactor.callFromThread(self.transport.write, "%s\n" % data)
+
+    def send_command(self, command, args=None, output=True, take_token=True,
+                     sid=None):
+        # Switching servers always costs tokens - a queued message has only
+        # paid for the command itself
+
+        with self.mutex:
+            if sid is not None and str(sid) != str(self.selected):
+                r = self._command("use", {"sid": sid}, False, True)
+
+                if not r["result"]:
+                    return r
+
+                self.selected = str(sid)
+                self.count(sid, "switches")
+
+            result = self._command(command, args, output, take_token)
+
+            if self.home is not None and self.selected != self.home:
+                # Go back to the server we're getting notifications for
+                r = self._command("use", {"sid": self.home}, False, True)
+
+                if r["result"]:
+                    self.selected = self.home
+
+            return result
+
+    def _command(self, command, args, output, take_token):
+        if not args:
+            args = {}
+        done = "%s" % command
+
+        for pair in args.items():
+            done = "%s %s=%s" % (done, pair[0], utils.escape(pair[1]))
+
+        if output:  # Check this and debug output if false
+            self.manager.log.info("-> [%s] %s" % (self.index, done))
+        else:
+            self.manager.log.trace("-> [%s] %s" % (self.index, done))
+
+        if take_token:
+            # Messages from the outbound queue have already been counted
+            self.manager.flood_bucket.wait()
+
+        started = time.time()
+        self.last_used = started
+
+        self.write_line(done)
+
+        lines = []
+
+        while True:
+            element = self.responses.get()
+
+            if element.lower().startswith("error"):
+                error_line = element
+                break
+            lines.append(element)
+
+        self.count(self.selected, "commands")
+        self.count(self.selected, "command_time", time.time() - started)
+
+        parsed_lines = [utils.parse_line(line) for line in lines]
+        parsed_error = utils.parse_words(error_line.split()[1:])
+        done_lines = parsed_lines
+
+        if command.lower().strip() == "clientlist":
+            done_lines = parsed_lines
+        elif len(parsed_lines) == 1:
+            done_lines = parsed_lines[0]
+
+        return {"error_msg": parsed_error["msg"],
+                "error_id": parsed_error["id"],
+                "data": done_lines,
+                "result": True if parsed_error["id"] == "0" else False}
+
+
+class QueryFactory(ClientFactory):
+    """
+    Factory for the extra connections in the pool - the first connection is
+    made through Ultros' own factory, like every other protocol.
+    """
+
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+
+    def buildProtocol(self, addr):
+        return QueryConnection(self.manager, self.index)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.manager.log.warn("Connection %s failed: %s"
+                              % (self.index, reason.getErrorMessage()))
+
+
+class ConnectionPool(object):
+    """
+    The set of logged-in connections, and the logic for picking one to run
+    a command on.
+    """
+
+    def __init__(self):
+        self.connections = []
+
+    def __iter__(self):
+        return iter(list(self.connections))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        if connection not in self.connections:
+            self.connections.append(connection)
+
+    def remove(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+
+    def pick(self, sid=None):
+        """
+        Pick the best connection to run a command for the given sid.
+
+        In order of preference, that's an idle connection that already has
+        the server selected, an idle connection that doesn't have a home
+        server to return to, any idle connection, or failing that, the
+        server's home connection (or the first one we have) to wait on.
+        """
+
+        if not self.connections:
+            return None
+
+        sid = str(sid) if sid is not None else None
+        idle = [c for c in self.connections if not c.busy]
+
+        for c in idle:
+            if c.selected == sid:
+                return c
+
+        for c in idle:
+            if c.home is None:
+                return c
+
+        if idle:
+            return idle[0]
+
+        for c in self.connections:
+            if c.home == sid:
+                return c
+
+        return self.connections[0]
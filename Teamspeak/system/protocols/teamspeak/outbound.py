@@ -0,0 +1,215 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Outbound flood control for ServerQuery.
+
+The server bans query clients that send more than a set number of commands
+in a given period (serverinstance_serverquery_flood_commands and
+serverinstance_serverquery_flood_time, 10 commands per 3 seconds by
+default). Every command we send takes a token from a shared bucket, and text
+messages are queued per target and only sent when there's a token spare.
+"""
+
+import time
+import utils.teamspeak as utils
+
+from collections import deque, OrderedDict
+from threading import Lock
+
+from twisted.internet import reactor
+
+#: Maximum escaped length of a sendtextmessage "msg" parameter
+MESSAGE_LIMIT = 1024
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. Commands sent from the threadpool `wait()` for
+    a token, while the message queue on the reactor uses `try_take()` and
+    schedules itself for later instead.
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period  # Tokens per second
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+        self.lock = Lock()
+
+    def _refill(self):
+        now = time.time()
+
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait(self, count=1):
+        """
+        Block until `count` tokens can be taken, then take them. Never call
+        this on the reactor thread.
+        """
+
+        while True:
+            with self.lock:
+                self._refill()
+
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+
+                delay = (count - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+    def try_take(self, count=1):
+        with self.lock:
+            self._refill()
+
+            if self.tokens < count:
+                return False
+
+            self.tokens -= count
+            return True
+
+    def delay(self, count=1):
+        """
+        How long, in seconds, until `count` tokens will be available.
+        """
+
+        with self.lock:
+            self._refill()
+
+            if self.tokens >= count:
+                return 0
+            return (count - self.tokens) / self.rate
+
+
+class MessageQueue(object):
+    """
+    Per-target queue of outgoing text messages.
+
+    Consecutive messages to the same target are merged into one
+    sendtextmessage (joined with newlines) as long as they fit within the
+    length limit, and messages that are too long are split. Targets are
+    served round-robin, so one chatty channel can't starve the others.
+
+    Sends happen in the threadpool, which doesn't keep them in order, so
+    each target only has one sendtextmessage in flight at a time - the
+    protocol's send_text() must return a Deferred that fires once it's sent.
+
+    This must only be used from the reactor thread.
+    """
+
+    protocol = None
+    bucket = None
+
+    queues = None  # (mode, target) -> deque of messages
+    sending = None  # Targets with a message in flight
+    delayed_call = None
+
+    def __init__(self, protocol, bucket, limit=MESSAGE_LIMIT):
+        self.protocol = protocol
+        self.bucket = bucket
+        self.limit = limit
+
+        self.queues = OrderedDict()
+        self.sending = set()
+
+        self.counters = {
+            "queued": 0,  # Messages passed to put()
+            "sent": 0,  # sendtextmessage commands actually sent
+            "merged": 0,  # Messages that were merged into another
+            "split": 0,  # Extra commands caused by splitting long messages
+            "throttled": 0  # Times we've had to wait for a token
+        }
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self.queues.itervalues())
+
+    def get_stats(self):
+        stats = dict(self.counters)
+
+        stats["depth"] = self.depth
+        stats["targets"] = dict(
+            ("%s:%s" % key, len(q)) for key, q in self.queues.iteritems()
+        )
+
+        return stats
+
+    def put(self, mode, target, message):
+        key = (str(mode), str(target))
+        chunks = utils.split_message(message, self.limit)
+
+        self.counters["queued"] += 1
+        self.counters["split"] += len(chunks) - 1
+
+        if key not in self.queues:
+            self.queues[key] = deque()
+
+        self.queues[key].extend(
+            (chunk, utils.escaped_length(chunk)) for chunk in chunks
+        )
+
+        if self.delayed_call is None or not self.delayed_call.active():
+            # Wait until the next reactor iteration, so that several lines
+            # sent by the same callback can be merged
+            self.delayed_call = reactor.callLater(0, self.drain)
+
+    def clear(self):
+        self.queues.clear()
+
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+    def drain(self):
+        self.delayed_call = None
+
+        for key in list(self.queues):
+            if key in self.sending:
+                continue  # We'll be back when its last message is sent
+
+            if not self.bucket.try_take():
+                self.counters["throttled"] += 1
+                self.delayed_call = reactor.callLater(
+                    self.bucket.delay(), self.drain
+                )
+                return
+
+            queue = self.queues.pop(key)
+            message = self._next_message(queue)
+
+            if queue:
+                self.queues[key] = queue  # Back of the line
+
+            self.counters["sent"] += 1
+            self.sending.add(key)
+
+            d = self.protocol.send_text(key[0], key[1], message)
+            d.addBoth(self._sent, key)
+
+    def _sent(self, _, key):
+        self.sending.discard(key)
+
+        if key in self.queues and (
+            self.delayed_call is None or not self.delayed_call.active()
+        ):
+            self.delayed_call = reactor.callLater(0, self.drain)
+
+    def _next_message(self, queue):
+        message, size = queue.popleft()
+        parts = [message]
+
+        # Escaped newline separator is two bytes
+        while queue and size + 2 + queue[0][1] <= self.limit:
+            message, length = queue.popleft()
+
+            parts.append(message)
+            size += 2 + length
+            self.counters["merged"] += 1
+
+        return "\n".join(parts)
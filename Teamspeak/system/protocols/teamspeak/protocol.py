@@ -2,13 +2,18 @@
 
 import utils.teamspeak as utils
 
-from collections import deque
+from collections import OrderedDict
 from system.logging.logger import getLogger
 from system.decorators.threads import run_async_threadpool
 
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from system.protocols.generic.protocol import Protocol as GenericProtocol
-from threading import Lock
+from system.protocols.teamspeak.connection import ConnectionPool, \
+    QueryConnection, QueryFactory
+from system.protocols.teamspeak.outbound import TokenBucket
+from system.protocols.teamspeak.server import VirtualServer
+from system.protocols.teamspeak.state import CHANNELLIST, CLIENTLIST
 
 
 class Protocol(GenericProtocol):
@@ -18,17 +23,18 @@ class Protocol(GenericProtocol):
     log = None
     event_manger = None
 
-    command_responses = deque()
-    command_mutex = Lock()
+    primary = None  # Connection made through Ultros' factory
+    pool = None  # All logged-in connections, including the primary
 
-    receive_mutex = Lock()
+    servers = None  # sid -> VirtualServer
+    state_task = None  # Periodic reconciliation of server states
+    keepalive_task = None  # Checks for idle connections
 
-    channels = {}
-    users = []
+    flood_bucket = None  # Shared by every command we send
 
     user = ""
     passw = ""
-    sid = 1
+    sid = 1  # Default virtual server
 
     name = "teamspeak"
 
@@ -44,7 +50,32 @@ class Protocol(GenericProtocol):
 
         self.user = self.identity["username"]
         self.passw = self.identity["password"]
-        self.sid = self.server["sid"]
+
+        sids = [str(x) for x in
+                self.server.get("sids", None) or [self.server["sid"]]]
+        listen = [str(x) for x in self.server.get("listen", None) or sids[:1]]
+        self.sid = sids[0]
+
+        flood = config.get("flood", {})
+
+        self.flood_bucket = TokenBucket(
+            flood.get("commands", 10), flood.get("time", 3)
+        )
+
+        self.servers = OrderedDict()
+
+        for sid in sids:
+            self.servers[sid] = VirtualServer(
+                self, sid, self.flood_bucket, sid in listen
+            )
+
+        # Each server we're listening to needs a connection of its own, as
+        # ServerQuery only sends notifications for the selected server
+        self.pool = ConnectionPool()
+        self.pool_size = max(self.server.get("connections", 1), len(listen))
+
+        self.state_task = LoopingCall(self.reconcile_all)
+        self.keepalive_task = LoopingCall(self.check_idle)
 
         reactor.connectTCP(
             self.server["address"],
@@ -53,90 +84,180 @@ class Protocol(GenericProtocol):
             120
         )
 
+    ## Default server, for code that doesn't care about the others
+
+    @property
+    def default_server(self):
+        return self.servers[self.sid]
+
+    @property
+    def state(self):
+        return self.default_server.state
+
+    @property
+    def channels(self):
+        return self.default_server.state.channels
+
+    @property
+    def users(self):
+        return self.default_server.state.clients
+
+    @property
+    def client_id(self):
+        return self.default_server.client_id
+
+    @property
+    def client_channel_id(self):
+        return self.default_server.client_channel_id
+
+    def get_server(self, sid=None):
+        if sid is None:
+            return self.default_server
+        return self.servers.get(str(sid), None)
+
+    ## Connection management
+
     def shutdown(self):
-        self.send_message(2, 0, "Disconnecting: Protocol shutdown")
-        self.send_command("quit")
-        self.transport.loseConnection()
+        for task in [self.state_task, self.keepalive_task]:
+            if task.running:
+                task.stop()
+
+        for conn in self.pool:
+            if conn.home is not None:
+                # No waiting for a response, we're leaving anyway
+                conn.write_line(
+                    "sendtextmessage targetmode=3 target=%s msg=%s"
+                    % (conn.home, utils.escape("Disconnecting: Protocol "
+                                               "shutdown"))
+                )
+            conn.write_line("quit")
+            reactor.callFromThread(conn.transport.loseConnection)
 
     def connectionMade(self):
-        pass
-
-    def send_command(self, command, args=None, output=True):
-        with self.command_mutex:
-            if not args:
-                args = {}
-            done = "%s" % command
-
-            for pair in args.items():
-                done = "%s %s=%s" % (done, pair[0], utils.escape(pair[1]))
-
-            if output:  # Check this and debug output if false
-                self.log.info("-> %s" % done)
-            else:
-                self.log.trace("-> %s" % done)
-
-            self.send(done)
-
-            lines = []
-            error_line = ""
-
-            while True:
-                if not len(self.command_responses):
-                    continue
-
-                element = self.command_responses.popleft()
-                if element.lower().startswith("error"):
-                    error_line = element
-                    break
-                lines.append(element)
-
-            parsed_lines = []
-            for line in lines:
-                if "|" in line:  # We've got an array of data
-                    chunks = []
-                    for chunk in line.split("|"):
-                        chunks.append(self.parse_words(chunk.split()))
-                    parsed_lines.append(chunks)
-                    continue
-                parsed_lines.append(self.parse_words(line.split()))
-            parsed_error = self.parse_words(error_line.split()[1:])
-            done_lines = parsed_lines
-
-            if command.lower().strip() == "clientlist":
-                done_lines = parsed_lines
-            elif len(parsed_lines) == 1:
-                done_lines = parsed_lines[0]
-
-            return {"error_msg": parsed_error["msg"],
-                    "error_id": parsed_error["id"],
-                    "data": done_lines,
-                    "result": True if parsed_error["id"] == "0" else False}
+        self.primary = QueryConnection(self, 0)
+        self.primary.makeConnection(self.transport)
 
-    @run_async_threadpool
-    def send(self, data):
-        self.transport.write("%s\n" % data)
+    def connectionLost(self, reason=None):
+        if self.primary is not None:
+            self.primary.connectionLost(reason)
+
+        GenericProtocol.connectionLost(self, reason)
+
+    def dataReceived(self, data):
+        self.primary.dataReceived(data)
+
+    def connection_ready(self, connection):
+        self.log.debug("%s: Welcome message received, setting up.."
+                       % connection)
+        self.do_login(connection)
+
+    def connection_lost(self, connection, reason=None):
+        self.log.warn("%s lost: %s" % (connection, reason))
+        self.pool.remove(connection)
+
+        for server in self.servers.itervalues():
+            if server.connection is connection:
+                server.connection = None
+
+    def count(self, sid, counter, amount=1):
+        server = self.servers.get(str(sid), None) if sid is not None else None
+
+        if server is not None:
+            server.count(counter, amount)
+
+    def get_stats(self):
+        """
+        Resource usage, broken down per virtual server.
+        """
+
+        return {
+            "connections": [
+                {"index": c.index, "home": c.home, "selected": c.selected,
+                 "busy": c.busy, "idle": c.idle_time}
+                for c in self.pool
+            ],
+            "servers": dict(
+                (sid, server.get_stats())
+                for sid, server in self.servers.iteritems()
+            )
+        }
+
+    def check_idle(self):
+        # ServerQuery disconnects idle clients, but there's no point in
+        # keeping a connection alive that's already busy
+        interval = self.server.get("keepalive", 180)
+
+        for conn in self.pool:
+            if not conn.busy and conn.idle_time >= interval:
+                self.keepalive(conn)
 
     @run_async_threadpool
-    def whoami_heartbeat(self):
-        self.send_command("whoami", output=False)
-        reactor.callLater(5, self.whoami_heartbeat)
+    def keepalive(self, connection):
+        connection.send_command("whoami", output=False)
+
+    ## Commands
+
+    def send_command(self, command, args=None, output=True, take_token=True,
+                     sid=None):
+        """
+        Run a command on whichever connection suits it best, switching
+        virtual server if needed. This blocks, so it must only be called
+        from the threadpool.
+        """
+
+        if sid is None:
+            sid = self.sid
+
+        connection = self.pool.pick(sid)
+
+        if connection is None:
+            return {"error_msg": "Not connected", "error_id": "-1",
+                    "data": [], "result": False}
+
+        return connection.send_command(command, args, output, take_token, sid)
 
     @run_async_threadpool
-    def do_login(self):
-        result = self.send_command("login",
+    def do_login(self, conn):
+        result = conn.send_command("login",
                                    {"client_login_name": self.user,
                                     "client_login_password": self.passw},
                                    output=False)
         if not result["result"]:
             self.log.warn("Unable to login: %s" % result["error_msg"])
+            return
+
+        conn.logged_in = True
+
+        # Each connection is registered for at most one server's
+        # notifications - other servers are only reconciled periodically,
+        # and spare connections are used for commands
+
+        server = None
+
+        for s in self.servers.itervalues():
+            if s.listen and s.connection is None:
+                server = s
+                break
 
-        self.log.debug("Selecting server..")
-        r = self.send_command("use", {"sid": self.sid}, output=False)
+        if server is not None:
+            server.connection = conn
+            self.setup_server(conn, server)
+
+        self.pool.add(conn)
+        reactor.callFromThread(self.connection_setup_done, conn)
+
+    def setup_server(self, conn, server):
+        self.log.debug("%s: Selecting server %s.." % (conn, server.sid))
+        r = conn.send_command("use", {"sid": server.sid}, output=False)
 
         if not r["result"]:
             self.log.warn("Unable to select server: %s" % r["error_msg"])
+            return
 
-        r = self.send_command("clientupdate", {"client_nickname":
+        conn.selected = server.sid
+        conn.home = server.sid
+
+        r = conn.send_command("clientupdate", {"client_nickname":
                                                self.identity["nickname"]},
                               output=False)
 
@@ -144,108 +265,137 @@ class Protocol(GenericProtocol):
             self.log.warn("Unable to set nickname: %s"
                           % r["error_msg"])
 
-        self.log.debug("Starting anti-timeout kick heartbeat..")
+        self.log.debug("Subscribing to events..")
 
-        self.whoami_heartbeat()
+        for event, title in [("textserver", "server text"),
+                             ("textchannel", "channel text"),
+                             ("textprivate", "private text"),
+                             ("server", "server notifications")]:
+            r = conn.send_command("servernotifyregister", {"event": event},
+                                  output=False)
 
-        self.log.debug("Subscribing to events..")
+            if not r["result"]:
+                self.log.warn("Unable to subscribe to %s: %s"
+                              % (title, r["error_msg"]))
 
-        r = self.send_command("servernotifyregister", {"event": "textserver"},
+        # Channel ID 0 subscribes to events from all channels, which we
+        # need to keep track of clients moving around
+        r = conn.send_command("servernotifyregister", {"event": "channel",
+                                                       "id": 0},
                               output=False)
 
         if not r["result"]:
-            self.log.warn("Unable to subscribe to server text: %s"
+            self.log.warn("Unable to subscribe channel notifications: %s"
                           % r["error_msg"])
 
-        r = self.send_command("servernotifyregister", {"event": "textchannel"},
-                              output=False)
+        r = conn.send_command("whoami")
 
-        if not r["result"]:
-            self.log.warn("Unable to subscribe to channel text: %s"
-                          % r["error_msg"])
+        if r["result"]:
+            server.client_channel_id = r["data"]["client_channel_id"]
+            server.client_id = r["data"]["client_id"]
 
-        r = self.send_command("servernotifyregister", {"event": "textprivate"},
-                              output=False)
+        self.log.info("Logged in to server %s." % server.sid)
 
-        if not r["result"]:
-            self.log.warn("Unable to subscribe to private text: %s"
-                          % r["error_msg"])
+    def connection_setup_done(self, conn):
+        if conn is not self.primary:
+            return
 
-        r = self.send_command("servernotifyregister", {"event": "server"},
-                              output=False)
+        # Everything else waits for the primary connection, so we know the
+        # login details work before we open any more
 
-        if not r["result"]:
-            self.log.warn("Unable to subscribe server notifications: %s"
-                          % r["error_msg"])
+        for index in xrange(1, self.pool_size):
+            reactor.connectTCP(
+                self.server["address"],
+                self.server["port"],
+                QueryFactory(self, index),
+                120
+            )
 
-        r = self.send_command("whoami", output=False)
+        self.log.debug("Fetching channel and client lists..")
 
-        if not r["result"]:
-            self.log.warn("Unable to see who I am: %s"
-                          % r["error_msg"])
-        else:
-            cid = r["data"]["client_channel_id"]
-            r = self.send_command("servernotifyregister", {"event": "channel",
-                                                           "id": cid},
-                                  output=False)
+        self.reconcile_all(initial=True)
 
-            if not r["result"]:
-                self.log.warn("Unable to subscribe channel notifications: %s"
-                              % r["error_msg"])
+        interval = self.config.get("state", {}).get("reconcile_interval", 600)
 
-        r = self.send_command("whoami")
+        if interval and not self.state_task.running:
+            self.state_task.start(interval, False)
 
-        if r["result"]:
-            self.client_channel_id = r["data"]["client_channel_id"]
-            self.client_id = r["data"]["client_id"]
+        if not self.keepalive_task.running:
+            self.keepalive_task.start(30, False)
 
-        self.log.info("Logged in.")
+        self.log.info("Ready!")
 
-        #######################################################################
+    def reconcile_all(self, initial=False):
+        for server in self.servers.itervalues():
+            self.reconcile_state(server, initial)
 
-        self.log.debug("===== CHANNEL LIST =====")
+    @run_async_threadpool
+    def reconcile_state(self, server, initial=False):
+        """
+        Re-list all channels and clients, and replace the state cache with
+        the result. This runs at a low frequency to catch anything that the
+        notifications didn't tell us about.
+        """
+
+        channels = self.send_command(CHANNELLIST, output=False,
+                                     sid=server.sid)
+
+        if not channels["result"]:
+            self.log.warn("Unable to list channels on server %s: %s"
+                          % (server.sid, channels["error_msg"]))
+            return
 
-        r = self.send_command("channellist", output=False)
+        clients = self.send_command(CLIENTLIST, output=False, sid=server.sid)
 
-        channel_ids = {}
+        if not clients["result"]:
+            self.log.warn("Unable to list clients on server %s: %s"
+                          % (server.sid, clients["error_msg"]))
+            return
 
-        for channel in r["data"]:
-            channel_ids[channel["cid"]] = channel["channel_name"]
-            self.log.debug("> %s: %s (%s clients)"
-                           % (channel["cid"], channel["channel_name"],
-                              channel["total_clients"]))
+        reactor.callFromThread(
+            self._apply_state, server, channels["data"], clients["data"],
+            initial
+        )
 
-        self.log.debug("===== CLIENT LIST =====")
+    def _apply_state(self, server, channels, clients, initial=False):
+        changed_channels, changed_clients = server.state.seed(
+            channels, clients
+        )
 
-        r = self.send_command("clientlist", output=False)
+        if initial:
+            self.log.debug("Server %s: Tracking %s channels and %s clients"
+                           % (server.sid, len(server.state.channels),
+                              len(server.state.clients)))
+        elif changed_channels or changed_clients:
+            self.log.debug("Server %s: State reconciled: %s channels and %s "
+                           "clients were out of date"
+                           % (server.sid, changed_channels, changed_clients))
 
-        self.log.debug(r)
+    def parse_words(self, words):
+        return utils.parse_words(words)
 
-        for client in r["data"][0]:
-            self.log.debug("> %s: %s in %s"
-                           % (client["clid"], client["client_nickname"],
-                              channel_ids[client["cid"]]))
+    def handle_notify(self, conn, data):
+        server = self.get_server(conn.home or conn.selected)
 
-        self.log.info("Ready!")
+        if server is None:
+            return
 
-    def parse_words(self, words):
-        done = {}
+        server.count("notifications")
 
-        for pair in words:
-            double = pair.split("=", 1)
-            if len(double) != 2:
-                continue
-            done[double[0]] = utils.unescape(double[1])
+        name, _, rest = data.partition(" ")
+        notify_type = name[len("notify"):]
 
-        return done
+        # Some notifications (eg, several clients leaving at once) carry
+        # multiple rows, only the first of which is prefixed with the name
+        rows = [utils.parse_row(chunk) for chunk in rest.split("|")]
+        parsed = rows[0]
 
-    def handle_notify(self, data):
-        words = data.split()
-        parsed = self.parse_words(words[1:])
-        notify_type = words[0].split("notify")[1]
+        if server.state.handle_notify(notify_type, rows):
+            self.log.trace("State updated: %s %s" % (notify_type, rows))
+            return
 
-        invoker = parsed["invokerid"]
-        if invoker == self.client_id:
+        invoker = parsed.get("invokerid", None)
+        if invoker == server.client_id:
             return
 
         if notify_type == "textmessage":
@@ -261,55 +411,75 @@ class Protocol(GenericProtocol):
 
             #TODO: Finish testing
             #self.send_message(parsed["targetmode"], parsed["invokerid"],
-            #                  "Echo test: %s" % parsed["msg"])
+            #                  "Echo test: %s" % parsed["msg"],
+            #                  sid=server.sid)
 
-            self.log.info("%s | <%s> %s"
-                          % (mode, parsed["invokername"], parsed["msg"]))
+            self.log.info("[%s] %s | <%s> %s"
+                          % (server.sid, mode, parsed["invokername"],
+                             parsed["msg"]))
         else:
             self.log.debug("Received notification: %s %s"
                            % (notify_type, parsed))
 
-    @run_async_threadpool
-    def do_parse(self, data):
-        if data.lower().startswith("ts3"):
-            self.log.info("Connected.")
-            return
-        elif data.lower().startswith("welcome to the"):
-            self.log.debug("Welcome message received, setting up..")
-            self.do_login()
-            return
-        elif data.lower().startswith("notify"):
-            self.handle_notify(data)
+    def send_message(self, mode, target, message, sid=None):
+        server = self.get_server(sid)
+
+        if server is None:  # Not one of the servers we're configured for
+            self.log.warn("Unable to send message to unknown server %s: %s"
+                          % (sid, message))
             return
 
-        self.command_responses.append(data)
+        if str(mode) == "2":
+            target = server.client_channel_id
+
+            if target is None:  # We haven't logged in yet
+                self.log.warn("Unable to send message to server %s before "
+                              "joining a channel: %s" % (server.sid, message))
+                return
+        elif str(mode) == "3":
+            target = server.sid
+
+        # The queue isn't thread-safe, and this may be called from anywhere
+        reactor.callFromThread(server.outbound.put, mode, target, message)
+
+    @run_async_threadpool
+    def send_text(self, mode, target, message, sid=None):
+        self._send_text(mode, target, message, sid)
+
+    def _send_text(self, mode, target, message, sid=None):
+        """
+        Send a message right away, blocking until it's been sent. Never call
+        this on the reactor thread.
+        """
 
-    def dataReceived(self, data):
-        with self.receive_mutex:
-            splitdata = data.split("\n\r")
-            if "" in splitdata:
-                splitdata.remove("")
-            for x in splitdata:
-                self.log.trace("<- %s" % x)
-                self.do_parse(x)
-
-    def send_message(self, mode, target, message):
         _mode = ""
 
         if str(mode) == "1":
             _mode = "PRIVATE"
         elif str(mode) == "2":
             _mode = "CHANNEL"
-            target = self.client_channel_id
         elif str(mode) == "3":
-            target = self.sid
             _mode = "SERVER "
 
-        r = self.send_command("sendtextmessage", {"targetmode": mode,
-                                                  "target": target,
-                                                  "msg": message},
-                              output=False)
+        if sid is None:
+            sid = self.sid
+
+        # Channel messages go to the channel we're in, so they have to be
+        # sent from the connection that's in it
+        server = self.get_server(sid)
+
+        if str(mode) == "2" and server.connection is not None:
+            r = server.connection.send_command(
+                "sendtextmessage", {"targetmode": mode, "target": target,
+                                    "msg": message},
+                output=False, take_token=False
+            )
+        else:
+            r = self.send_command("sendtextmessage", {"targetmode": mode,
+                                                      "target": target,
+                                                      "msg": message},
+                                  output=False, take_token=False, sid=sid)
         if r["result"]:
-            self.log.info("%s | -> %s" % (_mode, message))
+            self.log.info("[%s] %s | -> %s" % (sid, _mode, message))
         else:
             self.log.warn("Unable to send message: %s" % r["error_msg"])
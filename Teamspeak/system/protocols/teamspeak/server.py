@@ -0,0 +1,93 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+A virtual server, as seen by the Teamspeak protocol.
+
+Each one has its own state cache and outbound message queue, and keeps
+count of what it's costing us, so that the cost of running against a
+host with many virtual servers can be broken down.
+"""
+
+import time
+
+from twisted.internet import threads
+
+from system.protocols.teamspeak.outbound import MessageQueue
+from system.protocols.teamspeak.state import ServerState
+
+
+class VirtualServer(object):
+
+    protocol = None
+    sid = None
+
+    listen = False  # Whether this server should get its own connection
+    connection = None  # Connection registered for this server's events
+
+    client_id = None  # Our client ID on this server
+    client_channel_id = None  # The channel we're in on this server
+
+    def __init__(self, protocol, sid, bucket, listen=False):
+        self.protocol = protocol
+        self.sid = str(sid)
+        self.listen = listen
+
+        self.state = ServerState(protocol, self.sid)
+        self.outbound = MessageQueue(self, bucket)
+
+        self.started = time.time()
+        self.counters = {
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "commands": 0,
+            "command_time": 0.0,  # Seconds spent waiting for responses
+            "notifications": 0,
+            "switches": 0  # Times a connection had to "use" this server
+        }
+
+    def __str__(self):
+        return "Server %s" % self.sid
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def send_text(self, mode, target, message):
+        """
+        Send a message in the threadpool, returning a Deferred that fires
+        once it's been sent - or failed to be.
+        """
+
+        d = threads.deferToThread(
+            self.protocol._send_text, mode, target, message, self.sid
+        )
+        d.addErrback(
+            lambda f: self.protocol.log.error(
+                "Error sending message: %s" % f.getErrorMessage()
+            )
+        )
+
+        return d
+
+    def get_stats(self):
+        """
+        Resource usage for this server, with per-minute rates so servers
+        that have been running for different lengths of time compare.
+        """
+
+        stats = dict(self.counters)
+        minutes = max((time.time() - self.started) / 60.0, 1 / 60.0)
+
+        stats["commands_per_minute"] = self.counters["commands"] / minutes
+        stats["notifications_per_minute"] = (
+            self.counters["notifications"] / minutes
+        )
+        stats["channels"] = len(self.state.channels)
+        stats["clients"] = len(self.state.clients)
+        stats["outbound"] = self.outbound.get_stats()
+        stats["listen"] = self.listen
+        stats["connection"] = (
+            self.connection.index if self.connection is not None else None
+        )
+
+        return stats
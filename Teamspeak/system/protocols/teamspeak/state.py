@@ -0,0 +1,240 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Live model of a virtual server's channels and clients.
+
+This is seeded once with the list commands after login, and then kept up to
+date from notifications, so looking up who is where doesn't need a
+ServerQuery round-trip. The protocol reconciles it against a fresh listing
+every so often, in case a notification was missed.
+"""
+
+import utils.teamspeak as utils
+
+from system.protocols.teamspeak.channel import Channel
+from system.protocols.teamspeak.user import User
+
+#: Flags used when seeding, so the cached rows are as complete as possible
+CHANNELLIST = "channellist -topic -flags -limits"
+CLIENTLIST = "clientlist -uid -away -voice -groups -info"
+
+#: Fields that only the first row of a notification has, but that apply to
+#: every row - a group move names the target channel once, for example
+SHARED_FIELDS = ("ctid", "cfid", "reasonid", "reasonmsg", "invokerid",
+                 "invokername", "invokeruid")
+
+
+class ServerState(object):
+
+    protocol = None
+    sid = None
+
+    channels = None  # cid -> Channel
+    clients = None  # clid -> User
+
+    def __init__(self, protocol, sid=None):
+        self.protocol = protocol
+        self.sid = sid
+
+        self.channels = {}
+        self.clients = {}
+
+    ## Lookups
+
+    def get_channel(self, cid):
+        return self.channels.get(str(cid), None)
+
+    def get_client(self, clid):
+        return self.clients.get(str(clid), None)
+
+    def find_client(self, nickname):
+        nickname = nickname.lower()
+
+        for client in self.clients.itervalues():
+            if client.nickname.lower() == nickname:
+                return client
+        return None
+
+    def find_channel(self, name):
+        name = name.lower()
+
+        for channel in self.channels.itervalues():
+            if channel.name.lower() == name:
+                return channel
+        return None
+
+    def get_clients_in(self, cid):
+        channel = self.get_channel(cid)
+
+        if channel is None:
+            return set()
+        return set(channel.users)
+
+    ## Seeding and reconciliation
+
+    def seed(self, channel_rows, client_rows):
+        """
+        Replace the whole model with the given list rows.
+
+        Existing Channel and User objects are kept (and updated) where their
+        IDs still exist, so anything holding a reference to them keeps
+        seeing current data.
+
+        :returns: A tuple of how many channels and clients were added or
+                  removed compared to the previous model - anything other
+                  than zeroes after the first seed means notifications were
+                  missed.
+        """
+
+        old_channels, old_clients = self.channels, self.clients
+        self.channels, self.clients = {}, {}
+
+        for row in utils.rows(channel_rows):
+            channel = old_channels.get(row["cid"], None)
+
+            if channel is None:
+                channel = Channel(self.protocol, row.get("channel_name", ""),
+                                  row["cid"], sid=self.sid)
+            channel.users.clear()
+
+            self._update_channel(channel, row)
+            self.channels[channel.cid] = channel
+
+        for row in utils.rows(client_rows):
+            client = old_clients.get(row["clid"], None)
+
+            if client is None:
+                client = self._make_client(row)
+            client.channels.clear()
+
+            self._update_client(client, row)
+            self.clients[client.clid] = client
+            self._place_client(client, row.get("cid", None))
+
+        return (
+            len(set(old_channels) ^ set(self.channels)),
+            len(set(old_clients) ^ set(self.clients))
+        )
+
+    def clear(self):
+        self.channels.clear()
+        self.clients.clear()
+
+    ## Notifications
+
+    def handle_notify(self, notify_type, rows):
+        """
+        Apply a notification to the model, if it's one that we track.
+
+        :returns: True if the notification was applied, False otherwise
+        """
+
+        handler = getattr(self, "on_%s" % notify_type, None)
+
+        if handler is None:
+            return False
+
+        shared = None
+
+        for row in rows:
+            if shared is None:
+                shared = dict(
+                    (key, value) for key, value in row.iteritems()
+                    if key in SHARED_FIELDS
+                )
+            elif shared:
+                row = dict(shared, **row)
+
+            handler(row)
+
+        return True
+
+    def on_cliententerview(self, row):
+        client = self.get_client(row["clid"])
+
+        if client is None:
+            client = self._make_client(row)
+            self.clients[client.clid] = client
+
+        self._update_client(client, row)
+        self._place_client(client, row.get("ctid", None))
+
+    def on_clientleftview(self, row):
+        client = self.clients.pop(row["clid"], None)
+
+        if client is not None:
+            self._place_client(client, None)
+
+    def on_clientmoved(self, row):
+        client = self.get_client(row["clid"])
+
+        if client is not None:
+            self._place_client(client, row["ctid"])
+
+    def on_channelcreated(self, row):
+        channel = Channel(self.protocol, row.get("channel_name", ""),
+                          row["cid"], sid=self.sid)
+
+        self._update_channel(channel, row)
+        self.channels[channel.cid] = channel
+
+    def on_channeledited(self, row):
+        channel = self.get_channel(row["cid"])
+
+        if channel is not None:
+            self._update_channel(channel, row)
+
+    def on_channelmoved(self, row):
+        channel = self.get_channel(row["cid"])
+
+        if channel is not None:
+            self._update_channel(channel, row)
+
+    def on_channeldeleted(self, row):
+        channel = self.channels.pop(row["cid"], None)
+
+        if channel is not None:
+            for client in list(channel.users):
+                client.remove_channel(channel)
+
+    ## Internal functions
+
+    def _make_client(self, row):
+        return User(
+            self.protocol, row.get("client_nickname", ""),
+            row.get("client_unique_identifier", None), None,
+            clid=row["clid"], sid=self.sid
+        )
+
+    def _update_channel(self, channel, row):
+        for key, value in row.iteritems():
+            if key.startswith("invoker") or key == "reasonid":
+                continue
+            channel.data[key] = value
+
+        if "channel_name" in row:
+            channel.name = row["channel_name"]
+
+    def _update_client(self, client, row):
+        client.data.update(row)
+
+        if "client_nickname" in row:
+            client.nickname = row["client_nickname"]
+        if "client_unique_identifier" in row:
+            client.ident = row["client_unique_identifier"]
+
+    def _place_client(self, client, cid):
+        for channel in list(client.channels):
+            channel.remove_user(client)
+            client.remove_channel(channel)
+
+        if cid is None:
+            return
+
+        client.data["cid"] = cid
+        channel = self.get_channel(cid)
+
+        if channel is not None:
+            channel.add_user(client)
+            client.add_channel(channel)
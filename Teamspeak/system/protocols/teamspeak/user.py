@@ -5,11 +5,16 @@ from system.protocols.generic import user
 
 
 class User(user.User):
-    def __init__(self, protocol, nickname, ident, host):
+    def __init__(self, protocol, nickname, ident, host, clid=None,
+                 sid=None):
         self.protocol = protocol
         self.nickname = nickname
+        self.ident = ident
         self.host = host
+        self.clid = clid
+        self.sid = sid  # Virtual server this client is on
         self.channels = set()
+        self.data = {}  # Latest clientlist properties for this client
 
     def __str__(self):
         return self.nickname
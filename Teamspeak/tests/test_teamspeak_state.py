@@ -0,0 +1,135 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Tests for applying notifications to the state model in
+system/protocols/teamspeak/state.py.
+
+In an Ultros checkout with this package installed, the real modules are
+used. Otherwise, the modules are loaded straight from this package, with
+plain base classes standing in for Ultros' generic Channel and User - the
+Teamspeak ones override everything the state model uses.
+
+    nosetests -v path/to/Teamspeak/tests/
+"""
+
+import imp
+import os
+import sys
+import types
+import unittest
+
+import nose.tools as nosetools
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load_modules():
+    def module(name, **attrs):
+        mod = sys.modules.get(name, None)
+
+        if mod is None:
+            mod = sys.modules[name] = types.ModuleType(name)
+
+            parent, _, child = name.rpartition(".")
+
+            if parent:
+                setattr(sys.modules[parent], child, mod)
+
+        mod.__dict__.update(attrs)
+        return mod
+
+    def load(name, *path):
+        mod = imp.load_source(name, os.path.join(ROOT, *path))
+        parent, _, child = name.rpartition(".")
+
+        setattr(sys.modules[parent], child, mod)
+        return mod
+
+    module("utils")
+    load("utils.teamspeak", "utils", "teamspeak.py")
+
+    module("system")
+    module("system.protocols")
+    module("system.protocols.generic")
+    module("system.protocols.generic.channel",
+           Channel=type("Channel", (object,), {}))
+    module("system.protocols.generic.user", User=type("User", (object,), {}))
+
+    module("system.protocols.teamspeak")
+    load("system.protocols.teamspeak.channel",
+         "system", "protocols", "teamspeak", "channel.py")
+    load("system.protocols.teamspeak.user",
+         "system", "protocols", "teamspeak", "user.py")
+
+    return load("system.protocols.teamspeak.state",
+                "system", "protocols", "teamspeak", "state.py")
+
+
+try:
+    from system.protocols.teamspeak import state
+except ImportError:
+    state = load_modules()
+
+teamspeak = sys.modules["utils.teamspeak"]
+
+
+def parse_notify(line):
+    # The same split protocol.handle_notify() does
+    _, rest = line.split(" ", 1)
+    return [teamspeak.parse_row(chunk) for chunk in rest.split("|")]
+
+
+class TestNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.state = state.ServerState(None, "1")
+        self.state.seed(
+            teamspeak.parse_line("cid=1 channel_name=Lobby|"
+                                 "cid=5 channel_name=Away"),
+            teamspeak.parse_line(
+                "clid=1 cid=1 client_nickname=one|"
+                "clid=2 cid=1 client_nickname=two|"
+                "clid=3 cid=1 client_nickname=three"
+            )
+        )
+
+    def test_group_move(self):
+        # Only the first row names the channel they were moved to
+        rows = parse_notify(
+            "notifyclientmoved ctid=5 reasonid=1 invokerid=9 clid=1|clid=2"
+        )
+
+        nosetools.ok_(self.state.handle_notify("clientmoved", rows))
+
+        nosetools.eq_(self.state.get_clients_in("5"),
+                      set([self.state.get_client("1"),
+                           self.state.get_client("2")]))
+        nosetools.eq_(self.state.get_clients_in("1"),
+                      set([self.state.get_client("3")]))
+
+    def test_group_enter(self):
+        rows = parse_notify(
+            "notifycliententerview cfid=0 ctid=5 reasonid=0 clid=7 "
+            "client_nickname=seven|clid=8 client_nickname=eight"
+        )
+
+        self.state.handle_notify("cliententerview", rows)
+
+        nosetools.eq_(
+            set(c.nickname for c in self.state.get_clients_in("5")),
+            set(["seven", "eight"])
+        )
+        nosetools.eq_(self.state.get_client("8").data["ctid"], "5")
+
+    def test_rows_keep_their_own_fields(self):
+        rows = parse_notify(
+            "notifyclientmoved ctid=5 reasonid=1 clid=1|ctid=1 clid=2"
+        )
+
+        self.state.handle_notify("clientmoved", rows)
+
+        nosetools.ok_(self.state.get_client("1") in
+                      self.state.get_clients_in("5"))
+        nosetools.ok_(self.state.get_client("2") in
+                      self.state.get_clients_in("1"))
@@ -0,0 +1,179 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Tests for the ServerQuery codec and line framing in utils/teamspeak.py.
+
+These load the module straight from this package, so they can be run from
+anywhere with nose:
+
+    nosetests -v path/to/Teamspeak/tests/
+"""
+
+import imp
+import os
+import random
+import unittest
+
+import nose.tools as nosetools
+
+teamspeak = imp.load_source(
+    "teamspeak_utils",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "..", "utils", "teamspeak.py")
+)
+
+
+class TestLineBuffer(unittest.TestCase):
+
+    def make_stream(self, count, rng):
+        lines = []
+
+        for i in xrange(count):
+            # Responses, notifications and the odd empty line
+            length = rng.choice([0, 1, 5, 40, 300, 5000])
+            line = "".join(rng.choice("abc=\\| \n\r") for _ in xrange(length))
+
+            while "\n\r" in line:  # Never the delimiter itself
+                line = line.replace("\n\r", "\n")
+
+            lines.append(line)
+
+        return lines, "".join(line + "\n\r" for line in lines)
+
+    def feed_in_chunks(self, data, rng, max_size):
+        buf = teamspeak.LineBuffer()
+        received = []
+        position = 0
+
+        while position < len(data):
+            size = rng.randint(1, max_size)
+            received.extend(buf.feed(data[position:position + size]))
+            position += size
+
+        return buf, received
+
+    def test_random_chunks(self):
+        """
+        Lines come out whole and in order, however the stream is cut up
+        """
+
+        rng = random.Random(1234)
+
+        for max_size in (1, 2, 3, 7, 64, 1500, 100000):
+            lines, data = self.make_stream(200, rng)
+            buf, received = self.feed_in_chunks(data, rng, max_size)
+
+            nosetools.eq_(received, lines)
+            nosetools.eq_(len(buf), 0)
+
+    def test_split_delimiter(self):
+        """
+        A delimiter split across two reads is still found
+        """
+
+        buf = teamspeak.LineBuffer()
+
+        nosetools.eq_(buf.feed("error id=0 msg=ok\n"), [])
+        nosetools.eq_(buf.feed("\rnotifytextmessage"), ["error id=0 msg=ok"])
+        nosetools.eq_(buf.feed(" msg=hi\n\r\n"), ["notifytextmessage msg=hi"])
+        nosetools.eq_(len(buf), 1)
+
+    def test_partial_line(self):
+        """
+        Incomplete lines are kept until the rest arrives, or we clear them
+        """
+
+        buf = teamspeak.LineBuffer()
+
+        nosetools.eq_(buf.feed("clientlist"), [])
+        nosetools.eq_(len(buf), len("clientlist"))
+
+        buf.clear()
+
+        nosetools.eq_(len(buf), 0)
+        nosetools.eq_(buf.feed("whoami\n\r"), ["whoami"])
+
+
+class TestEscaping(unittest.TestCase):
+
+    def test_known_sequences(self):
+        nosetools.eq_(teamspeak.escape("a b|c/d\\e"), "a\\sb\\pc\\/d\\\\e")
+        nosetools.eq_(teamspeak.unescape("a\\sb\\pc\\/d\\\\e"), "a b|c/d\\e")
+        nosetools.eq_(teamspeak.escape("\x07\x08\x0c\n\r\t\x0b"),
+                      "\\a\\b\\f\\n\\r\\t\\v")
+
+    def test_round_trip(self):
+        """
+        Anything escaped unescapes back to what it was
+        """
+
+        rng = random.Random(5678)
+        alphabet = "ab \\/|\x07\x08\x0c\n\r\t\x0b=s"
+
+        for _ in xrange(1000):
+            text = "".join(
+                rng.choice(alphabet) for _ in xrange(rng.randint(0, 50))
+            )
+            escaped = teamspeak.escape(text)
+
+            nosetools.eq_(teamspeak.unescape(escaped), text)
+            nosetools.eq_(teamspeak.escaped_length(text), len(escaped))
+
+            # Escaped text never has anything that would break a line apart
+            for char in " |\n\r":
+                nosetools.ok_(char not in escaped)
+
+    def test_unknown_sequence(self):
+        nosetools.eq_(teamspeak.unescape("a\\qb"), "aqb")
+
+    def test_split_message(self):
+        rng = random.Random(9012)
+
+        for _ in xrange(200):
+            text = "".join(
+                rng.choice("ab \\|\n") for _ in xrange(rng.randint(0, 400))
+            )
+            limit = rng.randint(2, 50)
+            chunks = teamspeak.split_message(text, limit)
+
+            nosetools.eq_("".join(chunks), text)
+
+            for chunk in chunks:
+                nosetools.ok_(teamspeak.escaped_length(chunk) <= limit)
+
+
+class TestParseWords(unittest.TestCase):
+
+    def test_values(self):
+        nosetools.eq_(
+            teamspeak.parse_words(["clid=1", "client_nickname=Some\\sone"]),
+            {"clid": "1", "client_nickname": "Some one"}
+        )
+
+    def test_value_with_equals(self):
+        nosetools.eq_(
+            teamspeak.parse_words(["msg=a=b\\sc"]), {"msg": "a=b c"}
+        )
+
+    def test_flags(self):
+        """
+        Words without a value are kept, with an empty string - they used to
+        be left out
+        """
+
+        nosetools.eq_(
+            teamspeak.parse_words(["-away", "client_away_message", "clid=5"]),
+            {"-away": "", "client_away_message": "", "clid": "5"}
+        )
+
+    def test_empty_key(self):
+        nosetools.eq_(teamspeak.parse_words(["=x", ""]), {})
+
+    def test_rows(self):
+        rows = teamspeak.parse_line("clid=1 a=x|clid=2 -flag|clid=3")
+
+        nosetools.eq_(len(rows), 3)
+        nosetools.eq_(rows[1], {"clid": "2", "-flag": ""})
+        nosetools.eq_([row["clid"] for row in rows], ["1", "2", "3"])
+        nosetools.eq_(teamspeak.parse_line("clid=1"), {"clid": "1"})
@@ -6,34 +6,270 @@ Various utilities for use with the Teamspeak protocol.
 This file could change as the ServerQuery spec is updated.
 """
 
+import re
+
+# Character -> escape sequence, as defined by the ServerQuery spec
+ESCAPES = (
+    ("\\", "\\\\"),
+    ("/", "\\/"),
+    (" ", "\\s"),
+    ("|", "\\p"),
+    ("\x07", "\\a"),
+    ("\x08", "\\b"),
+    ("\x0c", "\\f"),
+    ("\n", "\\n"),
+    ("\r", "\\r"),
+    ("\t", "\\t"),
+    ("\x0b", "\\v"),
+)
+
+_escape_map = dict(ESCAPES)
+_unescape_map = dict((v[1], k) for k, v in ESCAPES)
+
+_escape_re = re.compile(
+    "[%s]" % "".join(re.escape(k) for k, _ in ESCAPES)
+)
+_unescape_re = re.compile(r"\\(.)", re.DOTALL)
+
+
+def _escape_char(match):
+    return _escape_map[match.group(0)]
+
+
+def _unescape_char(match):
+    char = match.group(1)
+    # Unknown sequences are left as the escaped character itself
+    return _unescape_map.get(char, char)
+
 
 def unescape(instr):
-    instr = str(instr)
-    instr = instr.replace("\\s", " ")
-    instr = instr.replace("\\n", "\n")
-    instr = instr.replace("\\r", "\r")
-    instr = instr.replace("\\t", "\t")
-    instr = instr.replace("\\p", "|")
-    instr = instr.replace("\\a", "\7")
-    instr = instr.replace("\\b", "\8")
-    instr = instr.replace("\\f", "\12")
-    instr = instr.replace("\\v", "\11")
-    instr = instr.replace("\\/", "/")
-    instr = instr.replace("\\\\", "\\")
-    return instr
+    if not isinstance(instr, basestring):
+        instr = str(instr)
+    if "\\" not in instr:
+        return instr
+    return _unescape_re.sub(_unescape_char, instr)
 
 
 def escape(instr):
-    instr = str(instr)
-    instr = instr.replace("\\", "\\\\")
-    instr = instr.replace(" ", "\\s")
-    instr = instr.replace("\n", "\\n")
-    instr = instr.replace("\r", "\\r")
-    instr = instr.replace("\t", "\\t")
-    instr = instr.replace("|", "\\p")
-    instr = instr.replace("\7", "\\a")
-    instr = instr.replace("\8", "\\b")
-    instr = instr.replace("\12", "\\f")
-    instr = instr.replace("\11", "\\v")
-    instr = instr.replace("/", "\\/")
-    return instr
+    if not isinstance(instr, basestring):
+        instr = str(instr)
+    return _escape_re.sub(_escape_char, instr)
+
+
+def escaped_length(instr):
+    """
+    Length of a string once it's been escaped, without building it.
+    """
+
+    return len(instr) + len(_escape_re.findall(instr))
+
+
+def split_message(message, limit=1024):
+    """
+    Split a message into chunks whose escaped length is at most `limit`.
+
+    Splits happen between characters, so an escape sequence is never cut
+    in half, and we prefer to split after a newline or a space within the
+    chunk if there is one.
+    """
+
+    if escaped_length(message) <= limit:
+        return [message]
+
+    chunks = []
+    start = 0
+    size = 0
+    last_break = -1
+
+    for index, char in enumerate(message):
+        width = 2 if char in _escape_map else 1
+
+        if size + width > limit:
+            end = last_break + 1 if last_break >= start else index
+            chunks.append(message[start:end])
+
+            start = end
+            size = escaped_length(message[start:index])
+            last_break = -1
+
+        size += width
+
+        if char in "\n ":
+            last_break = index
+
+    if start < len(message):
+        chunks.append(message[start:])
+
+    return chunks
+
+
+def parse_words(words):
+    """
+    Parse a list of "key=value" words into a dict, unescaping the values.
+
+    Words without a value (flags such as "-away", or empty properties) are
+    stored with an empty string.
+    """
+
+    done = {}
+
+    for word in words:
+        key, sep, value = word.partition("=")
+
+        if not key:
+            continue
+        if not sep:
+            done[key] = ""
+        elif "\\" in value:
+            done[key] = _unescape_re.sub(_unescape_char, value)
+        else:
+            done[key] = value
+
+    return done
+
+
+def parse_row(data):
+    """
+    Parse a single space-separated row of "key=value" pairs.
+    """
+
+    return parse_words(data.split())
+
+
+class Rows(object):
+    """
+    Lazily-parsed list of rows from a "|"-separated response line.
+
+    The line is only split when the rows are first touched, and each row is
+    only parsed (and cached) when it's accessed. Iterating over a large
+    clientlist to find one client therefore doesn't parse the rest of it.
+    """
+
+    __slots__ = ["_line", "_chunks", "_parsed"]
+
+    def __init__(self, line):
+        self._line = line
+        self._chunks = None
+        self._parsed = None
+
+    def _split(self):
+        if self._chunks is None:
+            self._chunks = self._line.split("|")
+            self._parsed = [None] * len(self._chunks)
+        return self._chunks
+
+    def __len__(self):
+        return len(self._split())
+
+    def __getitem__(self, index):
+        chunks = self._split()
+
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(chunks)))]
+
+        row = self._parsed[index]
+
+        if row is None:
+            row = parse_row(chunks[index])
+            self._parsed[index] = row
+
+        return row
+
+    def __iter__(self):
+        for i in xrange(len(self._split())):
+            yield self[i]
+
+    def raw(self):
+        """
+        Iterate over the unparsed rows, for callers that only need to look
+        for a substring before paying for a full parse.
+        """
+
+        return iter(self._split())
+
+    def __repr__(self):
+        return "<Rows: %s>" % len(self)
+
+
+def parse_line(line):
+    """
+    Parse a response line - returns a lazy `Rows` object if it contains
+    several rows, or a dict if it's a single row.
+    """
+
+    if "|" in line:
+        return Rows(line)
+    return parse_row(line)
+
+
+def rows(data):
+    """
+    Normalise a parsed response into a sequence of rows - a response with
+    just one row is parsed as a plain dict, which callers iterating over a
+    list command don't want to special-case.
+    """
+
+    if isinstance(data, dict):
+        return [data] if data else []
+    return data
+
+
+class LineBuffer(object):
+    """
+    Framing buffer for the ServerQuery stream.
+
+    TCP doesn't care about our line boundaries, so a single read may hold
+    several lines, part of one, or end halfway through the delimiter. Data is
+    appended to a bytearray and only complete lines are returned; the search
+    for the next delimiter resumes where the previous one left off, so a long
+    response arriving in many small reads isn't rescanned from the start each
+    time.
+    """
+
+    delimiter = b"\n\r"
+
+    def __init__(self, delimiter=None):
+        if delimiter is not None:
+            self.delimiter = delimiter
+
+        self._buffer = bytearray()
+        self._searched = 0  # Offset we've already searched up to
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Add some received data, returning a list of any complete lines.
+        """
+
+        buf = self._buffer
+        buf.extend(data)
+
+        delimiter = self.delimiter
+        size = len(delimiter)
+        lines = []
+        start = 0
+
+        # Back up in case the delimiter was split across two reads
+        position = max(self._searched - size + 1, 0)
+
+        while True:
+            index = buf.find(delimiter, position)
+
+            if index < 0:
+                break
+
+            lines.append(bytes(buf[start:index]))
+            start = position = index + size
+
+        if start:
+            del buf[:start]
+
+        self._searched = len(buf)
+
+        return lines
+
+    def clear(self):
+        del self._buffer[:]
+        self._searched = 0
@@ -0,0 +1,362 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Runs the Web plugin on its own, for load.py.
+
+The plugin is booted against stand-ins for Ultros' storage, command, event
+and plugin managers, in a temporary directory, listening on a random port
+on 127.0.0.1. There's one user, who may do anything, with an API key.
+
+This is meant to be started by load.py, which talks to it over stdin and
+stdout, one JSON object per line:
+
+* On startup, we print the port, username, password and API key
+* "begin" starts measuring reactor lag and CPU time
+* "end" prints what was measured since "begin"
+* "quit" stops the plugin and exits
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.getcwd())
+
+from twisted.internet import reactor, stdio, task
+from twisted.protocols.basic import LineReceiver
+
+import plugins.web
+
+from plugins.web import WebPlugin
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+
+CONFIG = {
+    "hostname": "127.0.0.1",
+    "port": 0,  # Any free port
+    "output_requests": False,
+    "logging": {
+        "access_log": "logs/web-access.log",
+        "api_log": "logs/api.log"
+    },
+    # Every request comes from one address, so this would only get in the way
+    "rate_limits": {"enabled": False},
+    # A snapshot looks at every object, which would show up as lag
+    "heap": {"interval": 0}
+}
+
+
+def cpu_time():
+    return sum(os.times()[:2])
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+## Stand-ins for Ultros' managers
+
+class FakeFile(dict):
+    """
+    A storage file, with the bits of the API the Web plugin uses.
+    """
+
+    exists = True
+
+    def add_callback(self, callback):
+        pass
+
+    def remove_callback(self, callback):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeStorageManager(object):
+
+    def __init__(self, config):
+        self.files = {"plugins/web.yml": FakeFile(config)}
+        self.data_files = {}
+
+    def get_file(self, plugin, kind, fmt, path):
+        if path not in self.files:
+            self.files[path] = FakeFile()
+        return self.files[path]
+
+
+class FakeAuthHandler(object):
+
+    def check_login(self, username, password):
+        return username.lower() == USERNAME and password == PASSWORD
+
+
+class FakePermissionsHandler(object):
+
+    def check(self, permission, username, protocol, source):
+        return username is not None and username.lower() == USERNAME
+
+
+class FakeCommandManager(object):
+
+    def __init__(self):
+        self.auth_handler = FakeAuthHandler()
+        self.auth_handlers = [self.auth_handler]
+        self.perm_handler = FakePermissionsHandler()
+
+
+class FakeEventManager(object):
+
+    def add_callback(self, *args, **kwargs):
+        pass
+
+    def remove_callback(self, *args, **kwargs):
+        pass
+
+    def run_callback(self, *args, **kwargs):
+        pass
+
+
+class FakePluginInfo(object):
+
+    def __init__(self, i):
+        self.name = "Plugin %s" % i
+        self.version = "1.0.%s" % i
+        self.website = "http://example.com/plugins/%s" % i
+
+
+class FakePluginObject(object):
+
+    def __init__(self, i):
+        self.info = FakePluginInfo(i)
+
+
+class FakePluginManager(object):
+
+    def __init__(self):
+        self.plugin_objects = dict(
+            ("Plugin %s" % i, FakePluginObject(i)) for i in xrange(30)
+        )
+
+
+class FakePackages(object):
+
+    def __init__(self, *args):
+        pass
+
+    def get_installed_packages(self):
+        return dict(("package-%s" % i, "1.0.%s" % i) for i in xrange(20))
+
+
+class FakeFactoryManager(object):
+    running = True  # So the plugin starts as soon as it's set up
+    factories = {}
+
+
+class BenchmarkPlugin(WebPlugin):
+    """
+    The Web plugin, without the parts Ultros' plugin manager would set up.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("Web")
+        self.logger.trace = lambda *args, **kwargs: None
+        self.factory_manager = FakeFactoryManager()
+
+    def _disable_self(self):
+        raise RuntimeError("The Web plugin disabled itself - see the log")
+
+
+def boot(config=None):
+    """
+    Set up and start the Web plugin in the current directory, returning it.
+    """
+
+    if config is None:
+        config = CONFIG
+
+    storage = FakeStorageManager(dict(config))
+
+    plugins.web.StorageManager = lambda: storage
+    plugins.web.CommandManager = FakeCommandManager
+    plugins.web.EventManager = FakeEventManager
+    plugins.web.PluginManager = FakePluginManager
+    plugins.web.Packages = FakePackages
+
+    for directory in ("data/plugins/web", "logs"):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    plugin = BenchmarkPlugin()
+    plugin.setup()
+
+    return plugin
+
+
+## Measuring
+
+class LagProbe(object):
+    """
+    Measures how late the reactor runs a call that's due every `interval`
+    seconds. A chat message arriving at the same time would have waited
+    about as long.
+    """
+
+    interval = 0.01
+
+    looping_callback = None
+    last_beat = 0
+
+    def __init__(self):
+        self.lags = []
+
+    def start(self):
+        self.last_beat = time.time()
+        self.looping_callback = task.LoopingCall(self.beat)
+        self.looping_callback.start(self.interval, False)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+    def beat(self):
+        now = time.time()
+        self.lags.append(max(0, now - self.last_beat - self.interval))
+        self.last_beat = now
+
+    def reset(self):
+        self.lags = []
+
+    def get_results(self):
+        lags = [lag * 1000 for lag in self.lags] or [0]
+
+        return {
+            "beats": len(self.lags),
+            "p50_ms": percentile(lags, 50),
+            "p99_ms": percentile(lags, 99),
+            "max_ms": max(lags)
+        }
+
+
+class ControlProtocol(LineReceiver):
+    """
+    Takes commands from load.py on stdin.
+    """
+
+    delimiter = "\n"
+
+    def __init__(self, plugin, probe):
+        self.plugin = plugin
+        self.probe = probe
+
+        self.started = 0
+        self.cpu = 0
+        self.counters = {}
+
+    def connectionMade(self):
+        self.send({
+            "port": self.plugin.port.getHost().port,
+            "username": USERNAME,
+            "password": PASSWORD,
+            "api_key": self.plugin.api_keys.create_key(USERNAME)
+        })
+
+    def send(self, data):
+        self.sendLine(json.dumps(data))
+
+    def get_counters(self):
+        monitor = self.plugin.lag_monitor
+
+        if monitor is None:
+            return {}
+        return dict(monitor.counters)
+
+    def lineReceived(self, line):
+        command = line.strip()
+
+        if command == "begin":
+            self.probe.reset()
+            self.started = time.time()
+            self.cpu = cpu_time()
+            self.counters = self.get_counters()
+
+            self.send({"ok": True})
+        elif command == "end":
+            seconds = time.time() - self.started
+            counters = self.get_counters()
+
+            self.send({
+                "seconds": seconds,
+                "cpu_percent": (cpu_time() - self.cpu) / seconds * 100,
+                "lag": dict(self.probe.get_results(), **dict(
+                    (key, counters[key] - self.counters.get(key, 0))
+                    for key in ("late_beats", "stalls") if key in counters
+                ))
+            })
+        elif command == "quit":
+            self.probe.stop()
+
+            d = self.plugin.stop()
+            d.addBoth(lambda _: reactor.stop())
+
+    def connectionLost(self, reason=None):
+        if reactor.running:  # load.py went away without telling us
+            self.lineReceived("quit")
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING, stream=sys.stderr,
+        format="[fake_ultros] %(levelname)s %(name)s: %(message)s"
+    )
+
+    root = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="ultros-web-load-")
+
+    try:
+        # The plugin looks for its templates and static files here
+        shutil.copytree(os.path.join(root, "web"),
+                        os.path.join(directory, "web"))
+        os.chdir(directory)
+
+        def start():
+            try:
+                plugin = boot()
+            except Exception:
+                logging.exception("Unable to start the Web plugin")
+                reactor.stop()
+                return
+
+            probe = LagProbe()
+            probe.start()
+
+            stdio.StandardIO(ControlProtocol(plugin, probe))
+
+        reactor.callWhenRunning(start)
+        reactor.run()
+
+        # Give the plugin's threads a chance to notice they've been stopped,
+        # rather than dying noisily when the interpreter exits
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(1)
+    finally:
+        os.chdir(root)
+        shutil.rmtree(directory, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Load test for the Web plugin.
+
+This starts the Web plugin in another process (see fake_ultros.py), then
+hits the index, login, admin, static file and API routes with a number of
+concurrent clients over keep-alive connections, for a few seconds at each
+concurrency level. For each level, it reports requests per second, latency
+percentiles per route, the server's CPU use, and how late the server's
+reactor ran things - which is how long chat would have waited, had the bot
+been connected anywhere.
+
+The server gets its own process so the client's work doesn't count against
+it. The client is one process as well, though - if the server's CPU use
+stays well under 100% at every level, the client is what's holding the
+numbers back. Run it from your Ultros directory, with this package installed:
+
+    python path/to/Web/benchmarks/load.py [options]
+
+Save the results with -o, and compare a later run against them with -b.
+"""
+
+import cookielib
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.getcwd())
+
+import twisted
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredList, inlineCallbacks, returnValue
+)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import deferLater
+from twisted.web.client import (
+    Agent, CookieAgent, FileBodyProducer, HTTPConnectionPool, readBody
+)
+from twisted.web.http_headers import Headers
+
+from StringIO import StringIO
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "fake_ultros.py")
+
+#: Name, path, and whether the request needs a session. Clients go through
+#: these in turn, each starting at a different one.
+ROUTES = [
+    ("index", "/", False),
+    ("login", "/login", False),
+    ("admin", "/admin", True),
+    ("static", "/static/custom.css", False),
+    ("api", "/api/v1/%(api_key)s/plugins/web/get_username", False)
+]
+
+USER_AGENT = "Ultros Web load test"
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def summarise(times):
+    if not times:
+        return {"requests": 0}
+
+    return {
+        "requests": len(times),
+        "mean_ms": sum(times) / len(times),
+        "p50_ms": percentile(times, 50),
+        "p90_ms": percentile(times, 90),
+        "p99_ms": percentile(times, 99),
+        "max_ms": max(times)
+    }
+
+
+class ServerProtocol(ProcessProtocol):
+    """
+    Talks to fake_ultros.py over its stdin and stdout.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.waiting = []  # Deferreds for replies, oldest first
+        self.ended = Deferred()
+
+    def outReceived(self, data):
+        self.buffer += data
+
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+
+            if self.waiting:
+                self.waiting.pop(0).callback(json.loads(line))
+
+    def processEnded(self, reason):
+        for d in self.waiting:
+            d.errback(RuntimeError("The server process went away"))
+
+        self.waiting = []
+        self.ended.callback(None)
+
+    def wait(self):
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def command(self, command):
+        d = self.wait()
+        self.transport.write(command + "\n")
+        return d
+
+    def quit(self):
+        self.transport.write("quit\n")
+        return self.ended
+
+
+def start_server():
+    protocol = ServerProtocol()
+    d = protocol.wait()  # It starts by telling us its port and API key
+
+    reactor.spawnProcess(
+        protocol, sys.executable, [sys.executable, SERVER],
+        env=os.environ, path=os.getcwd(), childFDs={0: "w", 1: "r", 2: 2}
+    )
+
+    d.addCallback(lambda info: (protocol, info))
+    return d
+
+
+class Client(object):
+    """
+    Makes requests over a pool of keep-alive connections, with one cookie
+    jar for the logged-in routes.
+    """
+
+    def __init__(self, info, connections):
+        # Twisted wants URLs as byte strings
+        self.info = dict(
+            (key, value.encode("utf-8") if isinstance(value, unicode)
+             else value)
+            for key, value in info.iteritems()
+        )
+        self.base = "http://127.0.0.1:%s" % info["port"]
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = connections
+        self.pool.retryAutomatically = False
+
+        self.agent = Agent(reactor, pool=self.pool)
+        self.cookies = cookielib.CookieJar()
+        self.session_agent = CookieAgent(self.agent, self.cookies)
+
+    def get_cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    @inlineCallbacks
+    def request(self, path, session=False, method="GET", body=None):
+        agent = self.session_agent if session else self.agent
+        headers = Headers({"User-Agent": [USER_AGENT]})
+        producer = None
+
+        if body is not None:
+            headers.addRawHeader(
+                "Content-Type", "application/x-www-form-urlencoded"
+            )
+            producer = FileBodyProducer(StringIO(urllib.urlencode(body)))
+
+        response = yield agent.request(
+            method, self.base + path, headers, producer
+        )
+        yield readBody(response)
+
+        returnValue(response.code)
+
+    @inlineCallbacks
+    def login(self):
+        # The login page sets the XSRF cookie we need to post the form
+        yield self.request("/login", True)
+
+        yield self.request("/login", True, "POST", {
+            "_xsrf": self.get_cookie("_xsrf"),
+            "username": self.info["username"],
+            "password": self.info["password"],
+            "remember": "on"
+        })
+
+        if self.get_cookie("session") is None:
+            raise RuntimeError("Unable to log in")
+
+    @inlineCallbacks
+    def worker(self, deadline, offset, times, statuses, errors):
+        n = offset
+
+        while time.time() < deadline:
+            name, path, session = ROUTES[n % len(ROUTES)]
+            n += 1
+
+            started = time.time()
+
+            try:
+                status = yield self.request(path % self.info, session)
+            except Exception as e:
+                errors[name] = errors.get(name, 0) + 1
+                errors["_last"] = str(e)
+                continue
+
+            times[name].append((time.time() - started) * 1000)
+            counts = statuses[name]
+            counts[status] = counts.get(status, 0) + 1
+
+    @inlineCallbacks
+    def run(self, concurrency, seconds):
+        times = dict((name, []) for name, _, _ in ROUTES)
+        statuses = dict((name, {}) for name, _, _ in ROUTES)
+        errors = {}
+
+        started = time.time()
+        deadline = started + seconds
+
+        yield DeferredList([
+            self.worker(deadline, i, times, statuses, errors)
+            for i in xrange(concurrency)
+        ])
+
+        taken = time.time() - started
+        everything = []
+
+        for name in times:
+            everything.extend(times[name])
+
+        routes = {}
+
+        for name, _, _ in ROUTES:
+            routes[name] = summarise(times[name])
+            routes[name]["statuses"] = dict(
+                (str(status), count)
+                for status, count in statuses[name].iteritems()
+            )
+
+        last_error = errors.pop("_last", None)
+
+        returnValue({
+            "concurrency": concurrency,
+            "seconds": taken,
+            "requests_per_second": len(everything) / taken,
+            "errors": sum(errors.values()),
+            "last_error": last_error,
+            "latency": summarise(everything),
+            "routes": routes
+        })
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+@inlineCallbacks
+def run(options):
+    levels = [int(level) for level in options.levels.split(",")]
+
+    server, info = yield start_server()
+    client = Client(info, max(levels))
+
+    results = {
+        "options": vars(options),
+        "started": time.time(),
+        "python": platform.python_version(),
+        "twisted": twisted.__version__,
+        "routes": [path for _, path, _ in ROUTES],
+        "levels": []
+    }
+
+    try:
+        yield client.login()
+
+        print "%6s %10s %9s %9s %9s %9s %9s %7s" % (
+            "Conns", "Req/s", "p50 ms", "p99 ms", "Lag p50", "Lag p99",
+            "Lag max", "CPU %"
+        )
+
+        for concurrency in levels:
+            # Open the connections and warm the caches first
+            yield client.run(concurrency, options.warmup)
+
+            yield server.command("begin")
+            level = yield client.run(concurrency, options.seconds)
+            level["server"] = yield server.command("end")
+
+            results["levels"].append(level)
+
+            lag = level["server"]["lag"]
+
+            print "%6s %10.1f %9.2f %9.2f %9.2f %9.2f %9.2f %7.1f" % (
+                concurrency, level["requests_per_second"],
+                level["latency"]["p50_ms"], level["latency"]["p99_ms"],
+                lag["p50_ms"], lag["p99_ms"], lag["max_ms"],
+                level["server"]["cpu_percent"]
+            )
+
+            if level["errors"]:
+                print "       %s errors - the last was: %s" % (
+                    level["errors"], level["last_error"]
+                )
+
+            # Let the server settle down between levels
+            yield deferLater(reactor, 1, lambda: None)
+    finally:
+        yield client.close()
+        yield server.quit()
+
+    returnValue(results)
+
+
+def compare(baseline, results):
+    """
+    Print how each concurrency level changed since a previous run.
+    """
+
+    old_levels = dict(
+        (level["concurrency"], level) for level in baseline["levels"]
+    )
+
+    def change(old, new):
+        if not old:
+            return "     n/a"
+        return "%+7.1f%%" % ((new - old) * 100.0 / old)
+
+    print
+    print "Compared with the baseline:"
+    print "%6s %10s %9s %9s %9s" % (
+        "Conns", "Req/s", "p50 ms", "p99 ms", "Lag p99"
+    )
+
+    for level in results["levels"]:
+        old = old_levels.get(level["concurrency"], None)
+
+        if old is None:
+            continue
+
+        print "%6s %10s %9s %9s %9s" % (
+            level["concurrency"],
+            change(old["requests_per_second"], level["requests_per_second"]),
+            change(old["latency"]["p50_ms"], level["latency"]["p50_ms"]),
+            change(old["latency"]["p99_ms"], level["latency"]["p99_ms"]),
+            change(old["server"]["lag"]["p99_ms"],
+                   level["server"]["lag"]["p99_ms"])
+        )
+
+
+def main():
+    parser = optparse.OptionParser()
+
+    parser.add_option("-l", "--levels", default="1,10,50,100",
+                      help="Concurrency levels, separated by commas")
+    parser.add_option("-s", "--seconds", type="float", default=10,
+                      help="Seconds to measure each level for")
+    parser.add_option("-w", "--warmup", type="float", default=2,
+                      help="Seconds to warm up for before each level")
+    parser.add_option("-o", "--output", default=None,
+                      help="Write the results to this file as JSON")
+    parser.add_option("-b", "--baseline", default=None,
+                      help="Compare with results saved by an earlier run")
+
+    options, _ = parser.parse_args()
+    results = {}
+
+    baseline = None
+
+    if options.baseline:
+        with open(options.baseline, "r") as fh:
+            baseline = json.load(fh)
+
+    def done(result):
+        results.update(result)
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: run(options).addCallbacks(done, failed)
+    )
+    reactor.run()
+
+    if not results:
+        sys.exit(1)
+
+    if options.output:
+        with open(options.output, "w") as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+
+    if baseline is not None:
+        compare(baseline, results)
+
+
+if __name__ == "__main__":
+    main()
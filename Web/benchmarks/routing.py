@@ -0,0 +1,119 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Benchmark for the Web plugin's route table.
+
+This registers the Web plugin's own routes along with a number of made-up
+plugin routes, then times matching a mix of request paths - first the way
+Cyclone does it (trying every regex in order), then through the Router.
+It also times adding and removing a route, which rebuilds the table. Run it
+from your Ultros directory, with this package installed:
+
+    python path/to/Web/benchmarks/routing.py [extra routes] [matches]
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from cyclone.web import RequestHandler, URLSpec
+
+from plugins.web.routing import Router
+
+#: The Web plugin's own routes, in the order it adds them
+WEB_ROUTES = [
+    r"/", r"/login", r"/logout", r"/login/reset", r"/account",
+    r"/account/password/change", r"/account/apikeys/create",
+    r"/account/apikeys/delete", r"/account/users/logout",
+    r"/admin", r"/admin/files", r"/admin/files/(config|data)/(.*)",
+    r"/admin/lag", r"/api/admin/get_stats", r"/api/admin/metrics",
+    r"/api/admin/files/(config|data)/(.*)"
+]
+
+PATHS = [
+    "/", "/login", "/admin", "/admin/files/config/plugins/web.yml",
+    "/api/admin/get_stats", "/account/apikeys/create",
+    "/plugin49/items/1234", "/api/v1/abcdef0123456789/plugin49/status",
+    "/does/not/exist"
+]
+
+
+class Handler(RequestHandler):
+    pass
+
+
+def make_patterns(extra):
+    patterns = list(WEB_ROUTES)
+
+    for i in xrange(extra):
+        # What a typical plugin adds: a page, a page with an ID, an API call
+        patterns.append(r"/plugin%s" % i)
+        patterns.append(r"/plugin%s/items/([0-9]+)" % i)
+        patterns.append(r"/api/v1/([A-Za-z0-9]+)/plugin%s/status" % i)
+
+    return patterns
+
+
+def linear_match(specs, path):
+    for spec in specs:
+        if spec.regex.match(path):
+            return spec
+
+
+def routed_match(router, path):
+    for spec in router.match(path):
+        if spec.regex.match(path):
+            return spec
+
+
+def bench(name, func, number):
+    taken = min(timeit.repeat(func, number=number, repeat=3))
+    print "%-48s %9.3f us %9.0f/s" % (
+        name, taken / number * 1000000, number / taken
+    )
+
+
+def main():
+    extra = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    patterns = make_patterns(extra)
+    specs = [URLSpec(p, Handler) for p in patterns]
+
+    router = Router()
+
+    started = time.time()
+
+    for pattern in patterns:
+        router.add(pattern, Handler)
+
+    print "%s routes, added in %.1f ms" % (
+        len(router), (time.time() - started) * 1000
+    )
+    print
+
+    for path in PATHS:
+        linear, routed = linear_match(specs, path), routed_match(router, path)
+        assert (linear and linear.regex.pattern) == \
+            (routed and routed.regex.pattern), path
+
+        bench("%s (linear)" % path,
+              lambda: linear_match(specs, path), number)
+        bench("%s (router)" % path,
+              lambda: routed_match(router, path), number)
+
+    print
+
+    def add_and_remove():
+        router.add(r"/hot/route/([0-9]+)", Handler)
+        router.remove(r"/hot/route/([0-9]+)")
+
+    bench("Add and remove a route", add_and_remove, 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+__author__ = "Gareth Coles"
+
+"""
+Benchmark for the Web plugin's template loader.
+
+This times compiling every template with an empty and a warm module cache,
+then renders index.html and admin/index.html over and over, both through
+the loader and through a plain Mako lookup with no module cache and
+filesystem checks on (how the loader used to work). Run it from your Ultros
+directory, with this package installed:
+
+    python path/to/Web/benchmarks/templates.py [renders]
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from mako.lookup import TemplateLookup
+
+from plugins.web.template_loader import TemplateLoader
+
+
+class FakePlugin(object):
+    namespace = {}
+
+    def __init__(self):
+        self.logger = logging.getLogger("Web benchmark")
+
+
+class FakePluginInfo(object):
+
+    def __init__(self, i):
+        self.name = "Plugin %s" % i
+        self.version = "1.0.%s" % i
+        self.website = "http://example.com/plugins/%s" % i
+
+
+def make_namespace(plugin_ref):
+    now = int(time.time() * 1000)
+    points = json.dumps([
+        {"x": now - i * 5000, "y": 10.0 + i} for i in xrange(20)
+    ])
+
+    # What RequestHandler.render_string() adds for every page
+    base = {
+        "plugin": plugin_ref,
+        "extra_css": ["/static/custom.css"],
+        "extra_js": [],
+        "headers": [],
+        "nav_items": {
+            "admin": {"url": "/admin", "active": False, "icon": "settings"}
+        },
+        "session": {"username": "benchmark", "remember": False,
+                    "time": time.time()},
+        "sessions": None,
+        "xsrf": lambda: "",
+        "_message": None,
+        "_message_type": "green"
+    }
+
+    index = dict(base)
+    index.update({
+        "nav_name": "home",
+        "packages": dict(("package-%s" % i, "1.0.%s" % i)
+                         for i in xrange(20)),
+        "plugins": [FakePluginInfo(i) for i in xrange(30)],
+        "factories": None
+    })
+
+    admin = dict(base)
+    admin.update({
+        "nav_name": "admin",
+        "ram": points,
+        "cpu": points,
+        "total_mem": 8192.0
+    })
+
+    return {"index.html": index, "admin/index.html": admin}
+
+
+def bench(name, func, number):
+    taken = min(timeit.repeat(func, number=number, repeat=3))
+    print "%-40s %9.3f ms %9.0f/s" % (
+        name, taken / number * 1000, number / taken
+    )
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cache_dir = tempfile.mkdtemp(prefix="ultros-web-templates-")
+
+    plugin = FakePlugin()
+    TemplateLoader.cache_dir = cache_dir
+
+    try:
+        started = time.time()
+        loader = TemplateLoader(plugin)
+        print "Compile all, empty cache: %.1f ms (%s templates)" % (
+            (time.time() - started) * 1000, len(loader.templates)
+        )
+
+        started = time.time()
+        loader = TemplateLoader(plugin)
+        print "Compile all, warm cache:  %.1f ms" % (
+            (time.time() - started) * 1000
+        )
+
+        started = time.time()
+        loader.check()
+        print "Check for changes:        %.3f ms" % (
+            (time.time() - started) * 1000
+        )
+        print
+
+        namespaces = make_namespace(loader.namespace["plugin"])
+        plain = TemplateLookup([loader.root])
+
+        for name, namespace in sorted(namespaces.items()):
+            bench("%s (loader)" % name,
+                  lambda: loader.load(name).render(**namespace), number)
+            bench("%s (plain lookup)" % name,
+                  lambda: plain.get_template(name).render(**namespace),
+                  number)
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+
+if __name__ == "__main__":
+    main()
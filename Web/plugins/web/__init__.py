@@ -9,15 +9,25 @@ We're at 1.0.0! Cyclone <3
 __author__ = "Gareth Coles"
 
 import os
-import re
-
-from cyclone.web import Application
 
+from plugins.web.access_log import AccessLog
 from plugins.web.apikeys import APIKeys
 from plugins.web.events import ServerStartedEvent, ServerStoppedEvent
+from plugins.web.file_view import FileViews
+from plugins.web.heap import HeapCensus
+from plugins.web.lag import LagMonitor
+from plugins.web.permissions import PermissionCache
+from plugins.web.profiler import SamplingProfiler
+from plugins.web.push import PushHub
+from plugins.web.ratelimit import RateLimiter
+from plugins.web.registry import AddressList, MetricsRegistry, WebCollector
+from plugins.web.response_cache import ResponseCache
+from plugins.web.routing import Router, RoutedApplication
 from plugins.web.template_loader import TemplateLoader
 from plugins.web.sessions import Sessions
+from plugins.web.static import StaticAssets, StaticHandler
 from plugins.web.stats import Stats
+from plugins.web.workers import RenderPool
 
 from system.command_manager import CommandManager
 from system.event_manager import EventManager
@@ -41,16 +51,27 @@ class WebPlugin(PluginObject):
     Web plugin object
     """
 
-    api_log = None
+    access_log = None
     api_keys = None
+    file_views = None
+    heap_census = None
+    lag_monitor = None
+    metrics = None
+    metrics_allow = None  # Addresses that may scrape /metrics, if enabled
+    permission_cache = None
+    profiler = None
+    push_hub = None
+    rate_limiter = None
+    render_pool = None
+    response_cache = None
+    trusted_proxies = None  # Proxies whose X-Real-Ip headers we believe
 
-    api_key_data = {}
     config = {}
     data = {}
 
     namespace = {}  # Global, not used right now
 
-    handlers = {}  # Cyclone handlers
+    router = None  # Our routes, which can change while we're running
 
     interface = ""  # Listening interface
     listen_port = 8080
@@ -71,6 +92,7 @@ class WebPlugin(PluginObject):
     packages = None
     plugins = None
     sessions = None
+    static_assets = None
     stats = None
 
     ## Internal(ish) functions
@@ -108,33 +130,27 @@ class WebPlugin(PluginObject):
             return self._disable_self()
 
         try:
-            self.api_log = open("logs/api.log", "w")
-        except Exception:
-            self.logger.exception("Unable to open api log file!")
-            return self._disable_self()
-
-        try:
-            self.api_key_data = self.storage.get_file(
+            _api_keys = self.storage.get_file(
                 self, "data", JSON, "plugins/web/apikeys.json"
             )
-            self.logger.debug("Sessions loaded")
+            self.logger.debug("API keys loaded")
         except Exception:
             self.logger.exception("Error loading API keys!")
             return self._disable_self()
 
-        try:
-            self.api_log = open("logs/api.log", "w")
-        except Exception:
-            self.logger.exception("Unable to open api log file!")
-            return self._disable_self()
-
         self.config.add_callback(self.restart)
         self.data.add_callback(self.restart)
 
+        self.router = Router()
+
         # Index page
 
         self.add_handler(r"/", "plugins.web.routes.index.Route")
 
+        # Prometheus metrics
+
+        self.add_handler(r"/metrics", "plugins.web.routes.metrics.Route")
+
         # Login-related
 
         self.add_handler(r"/login", "plugins.web.routes.login.Route")
@@ -178,10 +194,48 @@ class WebPlugin(PluginObject):
             r"/admin/files/(config|data)/(.*)",
             "plugins.web.routes.admin.file.Route"
         )
+        self.add_handler(
+            r"/admin/heap",
+            "plugins.web.routes.admin.heap.Route"
+        )
+        self.add_handler(
+            r"/admin/lag",
+            "plugins.web.routes.admin.lag.Route"
+        )
+        self.add_handler(
+            r"/admin/logs",
+            "plugins.web.routes.admin.logs.Route"
+        )
+        self.add_handler(
+            r"/admin/profiler",
+            "plugins.web.routes.admin.profiler.Route"
+        )
+        self.add_handler(
+            r"/admin/profiler/([0-9]+)\.folded",
+            "plugins.web.routes.admin.profiler.Download"
+        )
         self.add_handler(
             r"/api/admin/get_stats",
             "plugins.web.routes.api.admin.get_stats.Route"
         )
+        self.add_handler(
+            r"/api/admin/metrics",
+            "plugins.web.routes.api.admin.metrics.Route"
+        )
+        self.add_handler(
+            r"/api/admin/push",
+            "plugins.web.routes.api.admin.push.Route"
+        )
+
+        self.add_handler(
+            r"/api/admin/files/(config|data)/(.*)",
+            "plugins.web.routes.api.admin.files.Route"
+        )
+
+        self.add_handler(
+            r"/api/admin/rate_limits",
+            "plugins.web.routes.api.admin.rate_limits.Route"
+        )
 
         self.add_navbar_entry("admin", "/admin", "settings")
 
@@ -192,15 +246,26 @@ class WebPlugin(PluginObject):
             "plugins.web.routes.api.plugins.web.get_username.Route"
         )
 
+        self.add_api_handler(
+            r"/batch",
+            "plugins.web.routes.api.plugins.web.batch.Route"
+        )
+
         # Stuff routes might find useful
 
-        self.api_keys = APIKeys(self, self.api_key_data)
+        self.api_keys = APIKeys(
+            self, "data/plugins/web/apikeys.sqlite", _api_keys
+        )
         self.commands = CommandManager()
         self.events = EventManager()
         self.packages = Packages(False)
         self.plugins = PluginManager()
-        self.sessions = Sessions(self, _sessions)
+        self.sessions = Sessions(
+            self, "data/plugins/web/sessions.sqlite", _sessions
+        )
         self.stats = Stats()
+        self.stats.logger = self.logger
+        self.metrics = MetricsRegistry()
 
         # Load 'er up!
 
@@ -210,6 +275,14 @@ class WebPlugin(PluginObject):
             self._disable_self()
             return
 
+        # Cached pages that list plugins, packages or files
+        self.events.add_callback(
+            "PluginLoaded", self, self.plugins_changed, 0
+        )
+        self.events.add_callback(
+            "PluginUnloaded", self, self.plugins_changed, 0
+        )
+
         if not self.factory_manager.running:
             self.events.add_callback(
                 "ReactorStarted", self, self.start, 0
@@ -226,18 +299,102 @@ class WebPlugin(PluginObject):
                 self.data["secret"] = mkpasswd(60, 20, 20, 20)
 
         self.template_loader = TemplateLoader(self)
+        self.static_assets = StaticAssets("web/static")
+        self.file_views = FileViews()
+        self.permission_cache = PermissionCache(
+            self, self.config.get("permission_cache", {})
+        )
+
+        log_config = dict(self.config.get("logging", {}))
+        log_config["output_requests"] = self.config.get(
+            "output_requests", True
+        )
+
+        self.access_log = AccessLog(self, log_config)
+
+        lag_config = self.config.get("lag_monitor", {})
+
+        if lag_config.get("enabled", True):
+            self.lag_monitor = LagMonitor(self, lag_config)
+        else:
+            self.lag_monitor = None
+
+        pool_config = self.config.get("render_pool", {})
 
-        if self.config.get("output_requests", True):
-            log_function = self.log_request
+        if pool_config.get("enabled", True):
+            self.render_pool = RenderPool(self, pool_config)
         else:
-            log_function = self.null_log
+            self.render_pool = None
 
-        self.application = Application(
-            list(self.handlers.items()),  # Handler list
+        profiler_config = self.config.get("profiler", {})
+
+        if profiler_config.get("enabled", True):
+            self.profiler = SamplingProfiler(self, profiler_config)
+        else:
+            self.profiler = None
+
+        heap_config = self.config.get("heap", {})
+
+        if heap_config.get("enabled", True):
+            self.heap_census = HeapCensus(self, heap_config)
+        else:
+            self.heap_census = None
+
+        push_config = self.config.get("push", {})
+
+        if push_config.get("enabled", True):
+            self.push_hub = PushHub(self, push_config)
+        else:
+            self.push_hub = None
+
+        try:
+            self.trusted_proxies = AddressList(
+                self.config.get("trusted_proxies", None) or []
+            )
+        except ValueError as e:
+            self.logger.error("Trusted proxies: %s" % e)
+            self.trusted_proxies = AddressList([])
+
+        metrics_config = self.config.get("metrics", {})
+
+        if metrics_config.get("enabled", False):
+            try:
+                self.metrics_allow = AddressList(
+                    metrics_config.get("allow", ["127.0.0.1", "::1"]) or []
+                )
+            except ValueError as e:
+                self.logger.error("Metrics allow-list: %s" % e)
+                self.metrics_allow = AddressList([])
+
+            self.metrics.add_collector("web", WebCollector(self))
+        else:
+            self.metrics_allow = None
+            self.metrics.remove_collector("web")
+
+        cache_config = self.config.get("response_cache", {})
+
+        if cache_config.get("enabled", True):
+            self.response_cache = ResponseCache(
+                cache_config.get("size", 256)
+            )
+        else:
+            self.response_cache = None
+
+        limit_config = self.config.get("rate_limits", {})
+
+        if limit_config.get("enabled", True):
+            self.rate_limiter = RateLimiter(self, limit_config)
+        else:
+            self.rate_limiter = None
+
+        self.application = RoutedApplication(
+            self.router,
 
             ## General settings
             xheaders=True,
-            log_function=log_function,
+            log_function=self.log_request,
+            # Static files are compressed ahead of time, so this only
+            # applies to pages and API responses
             gzip=True,  # Are there browsers that don't support this now?
             # error_handler=ErrorHandler,
 
@@ -249,7 +406,9 @@ class WebPlugin(PluginObject):
             template_loader=self.template_loader,
 
             ## Static file settings
-            static_path="web/static"
+            static_path="web/static",
+            static_handler_class=StaticHandler,
+            static_assets=self.static_assets
         )
 
         if self.config.get("hosted", False):
@@ -302,6 +461,26 @@ class WebPlugin(PluginObject):
 
     def start(self, _=None):
         self.stats.start()
+        self.sessions.start()
+        self.api_keys.start()
+        self.access_log.start()
+        self.template_loader.start()
+        self.permission_cache.start()
+
+        if self.lag_monitor is not None:
+            self.lag_monitor.start()
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.start()
+
+        if self.render_pool is not None:
+            self.render_pool.start()
+
+        if self.push_hub is not None:
+            self.push_hub.start()
+
+        if self.heap_census is not None:
+            self.heap_census.start()
 
         self.port = reactor.listenTCP(
             self.listen_port, self.application, interface=self.interface
@@ -328,6 +507,29 @@ class WebPlugin(PluginObject):
         d.addErrback(lambda f: self.logger.error("Failed to stop: %s" % f))
 
         self.stats.stop()
+        self.sessions.stop()
+        self.api_keys.stop()
+        self.access_log.stop()
+        self.template_loader.stop()
+        self.permission_cache.stop()
+
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop()
+
+        if self.render_pool is not None:
+            self.render_pool.stop()
+
+        if self.push_hub is not None:
+            self.push_hub.stop()
+
+        if self.profiler is not None:
+            self.profiler.stop()
+
+        if self.heap_census is not None:
+            self.heap_census.stop()
 
         return d
 
@@ -339,48 +541,18 @@ class WebPlugin(PluginObject):
     def deactivate(self):
         d = self.stop()
 
-        self.handlers.clear()
+        self.router.clear()
         self.navbar_items.clear()
 
         return d
 
     def log_request(self, request):
-        log = self.logger.info
-
-        status_code = request.get_status()
-
-        if status_code >= 500:
-            log = self.logger.error
-        elif status_code >= 400:
-            log = self.logger.warn
-
-        path = request.request.path
-
-        # Check if this is an API method and hide the key if so
-
-        matched = re.match(r"/api/v[0-9]/([a-zA-Z0-9]+)/.*", path)
+        self.access_log.log_request(request)
 
-        if matched:
-            key = matched.groups()[0]
-            user = self.api_keys.get_username(key)
-
-            if user:
-                path = path.replace(key, "<API: %s>" % user)
-            else:
-                path = path.replace(key, "<API: Invalid key>")
-
-        log(
-            "[%s] %s %s -> HTTP %s"
-            % (
-                request.request.remote_ip,
-                request.request.method,
-                path,
-                request.get_status()
-            )
-        )
-
-    def null_log(self, *args, **kwargs):
-        pass
+    def plugins_changed(self, _=None):
+        # Loading a plugin can also mean new packages and storage files
+        if self.response_cache is not None:
+            self.response_cache.invalidate("plugins", "packages", "storage")
 
     ## Public API functions
 
@@ -394,16 +566,17 @@ class WebPlugin(PluginObject):
     def add_handler(self, pattern, handler):
         self.logger.debug("Adding route: %s -> %s" % (pattern, handler))
 
-        if pattern in self.handlers:
-            self.logger.debug("Route already exists.")
+        try:
+            if not self.router.add(pattern, handler):
+                self.logger.debug("Route already exists.")
+                return False
+        except ImportError:
+            self.logger.exception("Unable to load handler: %s" % handler)
             return False
 
-        self.handlers[pattern] = handler
-
-        if self.application is not None:
-            self.application.add_handlers(r".*$", [(pattern, handler)])
-
-        self.logger.debug("Handlers list: %s" % list(self.handlers.values()))
+        self.logger.debug("Route table is now at version %s, with %s routes"
+                          % (self.router.version, len(self.router)))
+        return True
 
     def add_navbar_entry(self, title, url, icon="question"):
         if title in self.navbar_items:
@@ -420,9 +593,7 @@ class WebPlugin(PluginObject):
         else:
             username = session["username"]
 
-        return self.commands.perm_handler.check(
-            perm, username, "web", "plugin-web"
-        )
+        return self.permission_cache.check(perm, username)
 
     def remove_api_handlers(self, *names, **kwargs):
         """
@@ -444,17 +615,12 @@ class WebPlugin(PluginObject):
         return self.remove_handlers(*patterns)
 
     def remove_handlers(self, *names):
-        found = False
-
-        for name in names:
-            if name in self.handlers:
-                found = True
-                del self.handlers[name]
+        removed = self.router.remove(*names)
 
-        if found:
-            self.restart()
+        if removed:
+            self.logger.debug("Removed %s routes - route table is now at "
+                              "version %s" % (removed, self.router.version))
+        return removed > 0
 
     def write_api_log(self, address, key, username, message):
-        self.api_log.write(
-            "%s | %s (%s) | %s\n" % (address, key, username, message)
-        )
+        self.access_log.log_api(address, key, username, message)
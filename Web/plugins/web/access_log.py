@@ -0,0 +1,432 @@
+"""
+Access and API logging.
+
+Requests are turned into small structured records on the reactor and put
+on a queue; a background thread takes them off in batches, redacts API keys,
+writes them to rotating log files and passes them to the plugin's logger.
+Per-route latency histograms are kept up to date for every request, whether
+or not it's sampled for the log.
+"""
+
+__author__ = 'Gareth Coles'
+
+import json
+import os
+import random
+import re
+import threading
+import time
+import weakref
+
+from bisect import bisect_left
+from Queue import Queue, Empty, Full
+
+from plugins.web.apikeys import hash_key, HINT_LENGTH
+from plugins.web.request_handler import get_client_address
+
+#: Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (
+    1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000
+)
+
+#: Seconds to wait for the writer thread when stopping
+STOP_TIMEOUT = 10
+
+API_PATH = re.compile(r"^/api/v[0-9]+/([a-zA-Z0-9]+)(/.*)?$")
+
+
+class LatencyHistogram(object):
+    """
+    Fixed-bucket latency histogram - the last bucket catches everything
+    slower than LATENCY_BUCKETS[-1].
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, p):
+        """
+        Estimate a percentile (0-100), as the upper bound of the bucket it
+        falls in.
+        """
+
+        if not self.count:
+            return 0
+
+        wanted = self.count * p / 100.0
+        seen = 0
+
+        for i, n in enumerate(self.buckets):
+            seen += n
+
+            if seen >= wanted:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                return self.max
+
+        return self.max
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": dict(
+                zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"],
+                    self.buckets)
+            )
+        }
+
+
+class RotatingFile(object):
+    """
+    Append-only log file that rotates itself when it gets too big or too
+    old, keeping a number of numbered backups (path.1 is the newest).
+
+    This is only used from the writer thread.
+    """
+
+    def __init__(self, path, max_size=0, interval=0, backups=5):
+        self.path = path
+        self.max_size = max_size
+        self.interval = interval
+        self.backups = backups
+
+        directory = os.path.dirname(path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "a")
+        self.size = self.file.tell()
+
+        try:
+            self.opened = os.path.getmtime(self.path) if self.size else \
+                time.time()
+        except OSError:
+            self.opened = time.time()
+
+    def should_rotate(self):
+        if self.max_size and self.size >= self.max_size:
+            return True
+        if self.interval and time.time() - self.opened >= self.interval:
+            return self.size > 0
+        return False
+
+    def rotate(self):
+        self.file.close()
+
+        if self.backups > 0:
+            for i in xrange(self.backups - 1, 0, -1):
+                source = "%s.%s" % (self.path, i)
+
+                if os.path.exists(source):
+                    target = "%s.%s" % (self.path, i + 1)
+
+                    if os.path.exists(target):
+                        os.remove(target)
+                    os.rename(source, target)
+
+            target = "%s.1" % self.path
+
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(self.path, target)
+        else:
+            os.remove(self.path)
+
+        self.open()
+
+    def write_lines(self, lines):
+        if self.should_rotate():
+            self.rotate()
+
+        data = "".join("%s\n" % line for line in lines)
+
+        self.file.write(data)
+        self.file.flush()
+
+        self.size += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class AccessLog(object):
+    """
+    The logging pipeline itself.
+
+    `log_request()` is used as Cyclone's log function, and `log_api()`
+    backs `WebPlugin.write_api_log()`. Both only build a record and put it
+    on the queue - if the queue is full, the record is dropped and counted
+    rather than holding up the reactor.
+    """
+
+    _plugin_object = None
+
+    queue = None
+    thread = None
+
+    histograms = None  # Route name -> LatencyHistogram
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.access_path = config.get("access_log", "logs/web-access.log")
+        self.api_path = config.get("api_log", "logs/api.log")
+        self.max_size = config.get("max_size", 10 * 1024 * 1024)
+        self.interval = config.get("rotate_interval", 24 * 60 * 60)
+        self.backups = config.get("backups", 5)
+        self.sample_rate = float(config.get("sample_rate", 1.0))
+        self.batch_size = config.get("batch_size", 500)
+        self.flush_interval = config.get("flush_interval", 1.0)
+
+        self.output = config.get("output_requests", True)
+
+        self.queue = Queue(config.get("queue_size", 10000))
+        self.histograms = {}
+
+        self.counters = {
+            "requests": 0,  # Requests seen
+            "batched": 0,  # Requests that were part of an API batch
+            "queued": 0,  # Records put on the queue
+            "sampled_out": 0,  # Requests not logged due to sampling
+            "dropped": 0,  # Records dropped because the queue was full
+            "written": 0,  # Records written by the writer thread
+            "batches": 0,  # Batches written
+            "rotations": 0  # Times a log file was rotated
+        }
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(
+            target=self.run, name="Web access log writer"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        # Wait for room, so the sentinel isn't lost if the queue is full -
+        # but not forever, in case the writer has died
+        try:
+            self.queue.put(None, timeout=STOP_TIMEOUT)
+        except Full:
+            self.plugin.logger.warn(
+                "Access log writer isn't keeping up - %s records lost"
+                % self.queue.qsize()
+            )
+        else:
+            self.thread.join(STOP_TIMEOUT)
+
+        self.thread = None
+
+    def get_stats(self):
+        stats = dict(self.counters)
+
+        stats["depth"] = self.queue.qsize()
+        stats["sample_rate"] = self.sample_rate
+        stats["routes"] = dict(
+            (route, h.get_stats()) for route, h in self.histograms.items()
+        )
+
+        return stats
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.counters["dropped"] += 1
+        else:
+            self.counters["queued"] += 1
+
+    ## Reactor side
+
+    def log_request(self, handler):
+        request = handler.request
+        status = handler.get_status()
+        duration = request.request_time() * 1000
+        route = handler.__class__.__module__
+
+        histogram = self.histograms.get(route, None)
+
+        if histogram is None:
+            histogram = self.histograms[route] = LatencyHistogram()
+
+        histogram.add(duration)
+        self.counters["requests"] += 1
+
+        if getattr(request, "batch", None) is not None:
+            # The batch it was part of gets logged instead
+            self.counters["batched"] += 1
+            return
+
+        # Errors are always logged, whatever the sample rate
+        if status < 400 and self.sample_rate < 1 and \
+                random.random() >= self.sample_rate:
+            self.counters["sampled_out"] += 1
+            return
+
+        self._put({
+            "type": "access",
+            "time": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": status,
+            "duration": round(duration, 3),
+            "bytes": int(handler._headers.get("Content-Length", 0) or 0),
+            # Not every handler is one of ours, with get_client_address()
+            "remote_ip": get_client_address(
+                request, self.plugin.trusted_proxies
+            )
+        })
+
+    def log_api(self, address, key, username, message):
+        self._put({
+            "type": "api",
+            "time": time.time(),
+            "remote_ip": address,
+            "key": key,
+            "username": username,
+            "message": message
+        })
+
+    ## Writer thread
+
+    def run(self):
+        access_file = RotatingFile(
+            self.access_path, self.max_size, self.interval, self.backups
+        )
+        api_file = RotatingFile(
+            self.api_path, self.max_size, self.interval, self.backups
+        )
+
+        running = True
+
+        try:
+            while running:
+                try:
+                    records = [self.queue.get(True, self.flush_interval)]
+                except Empty:
+                    continue
+
+                while len(records) < self.batch_size:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+
+                if None in records:
+                    running = False
+                    records = [r for r in records if r is not None]
+
+                try:
+                    self.write_batch(records, access_file, api_file)
+                except Exception:
+                    self.plugin.logger.exception("Error writing access log")
+        finally:
+            access_file.close()
+            api_file.close()
+
+    def write_batch(self, records, access_file, api_file):
+        access_lines = []
+        api_lines = []
+
+        for record in records:
+            if record["type"] == "api":
+                record["key"] = self.redact_key(record["key"])
+                api_lines.append(json.dumps(record, sort_keys=True))
+            else:
+                record["path"] = self.redact_path(record["path"])
+                access_lines.append(json.dumps(record, sort_keys=True))
+
+                if self.output:
+                    self.output_record(record)
+
+        for f, lines in ((access_file, access_lines), (api_file, api_lines)):
+            if lines:
+                rotating = f.should_rotate()
+                f.write_lines(lines)
+
+                if rotating:
+                    self.counters["rotations"] += 1
+
+        self.counters["written"] += len(records)
+        self.counters["batches"] += 1
+
+    def redact_key(self, key):
+        if not key:
+            return key
+        return "%s..." % key[:HINT_LENGTH]
+
+    def redact_path(self, path):
+        matched = API_PATH.match(path)
+
+        if not matched:
+            return path
+
+        key = matched.group(1)
+        api_keys = self.plugin.api_keys
+
+        # Only a dict lookup, so this is safe to do from here
+        user = api_keys.get_username_by_hash(hash_key(key))
+
+        if user:
+            replacement = "<API: %s>" % user
+        else:
+            replacement = "<API: Invalid key>"
+
+        return "%s%s%s" % (
+            path[:matched.start(1)], replacement, path[matched.end(1):]
+        )
+
+    def output_record(self, record):
+        log = self.plugin.logger.info
+
+        if record["status"] >= 500:
+            log = self.plugin.logger.error
+        elif record["status"] >= 400:
+            log = self.plugin.logger.warn
+
+        log(
+            "[%s] %s %s -> HTTP %s (%.2fms)"
+            % (
+                record["remote_ip"],
+                record["method"],
+                record["path"],
+                record["status"],
+                record["duration"]
+            )
+        )
@@ -21,3 +21,10 @@ def invalid_key_error():
         "error": "invalid_key",
         "error_msg": "Invalid API key"
     }
+
+
+def bad_request_error(message):
+    return {
+        "error": "bad_request",
+        "error_msg": message
+    }
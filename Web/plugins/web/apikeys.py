@@ -1,75 +1,271 @@
 __author__ = 'Gareth Coles'
 
+import hashlib
+import sqlite3
 import time
 import weakref
 
+from twisted.internet import task
+
 from utils.password import mkpasswd
 
+#: How often pending last-used times are written to the database
+FLUSH_INTERVAL = 60
+
+#: How many characters of each key we keep, so users can tell them apart
+HINT_LENGTH = 4
+
+
+def hash_key(key):
+    """
+    Hash an API key for storage. Keys are long and random, so a plain
+    SHA-256 is enough here - there's nothing to brute-force.
+    """
+
+    if isinstance(key, unicode):
+        key = key.encode("UTF-8")
+
+    return hashlib.sha256(key).hexdigest()
+
 
 class APIKeys(object):
+    """
+    API key store, backed by SQLite.
+
+    Only the hashes of keys are stored - the key itself is shown to the user
+    once, when it's created. All keys are kept in memory by hash, with a
+    reverse index of username to hashes, so looking up a key or a user's
+    keys never has to scan anything.
+
+    Last-used times are only updated in memory, and written to the database
+    in one batch every FLUSH_INTERVAL seconds.
+
+    This is only used from the reactor thread.
+    """
 
     _plugin_object = None
-    data = {}
+
+    db = None
+    path = None
+
+    keys = None  # hash -> key dict
+    users = None  # username -> set of hashes
+    pending = None  # hash -> last-used time not yet in the database
+    uses = 0  # Times any key has been used since we started
+
+    looping_callback = None
 
     @property
     def plugin(self):
         return self._plugin_object()
 
-    def __init__(self, plugin, data):
+    def __init__(self, plugin, path, legacy=None):
         self._plugin_object = weakref.ref(plugin)
-        self.data = data
+        self.path = path
 
-    def create_key(self, username, tries=0):
-        username = username.lower()
+        self.keys = {}
+        self.users = {}
+        self.pending = {}
+
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS api_keys ("
+                "hash TEXT PRIMARY KEY, "
+                "username TEXT NOT NULL, "
+                "hint TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS api_keys_username "
+                "ON api_keys (username)"
+            )
+
+        if legacy is not None and list(legacy.keys()):
+            self.migrate(legacy)
+
+        for row in self.db.execute("SELECT * FROM api_keys"):
+            self._add(dict(row))
+
+    def _add(self, k):
+        self.keys[k["hash"]] = k
+        self.users.setdefault(k["username"], set()).add(k["hash"])
+
+    def _remove(self, key_hash):
+        k = self.keys.pop(key_hash)
+        self.pending.pop(key_hash, None)
+
+        hashes = self.users.get(k["username"], set())
+        hashes.discard(key_hash)
+
+        if not hashes:
+            self.users.pop(k["username"], None)
+
+    def migrate(self, legacy):
+        """
+        Import keys from the old apikeys.json storage file, and then empty
+        it so the plain keys aren't left lying around.
+        """
+
+        keys = list(legacy.keys())
+        now = time.time()
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO api_keys VALUES (?, ?, ?, ?, NULL)",
+                [
+                    (hash_key(key), legacy[key].lower(), key[:HINT_LENGTH],
+                     now)
+                    for key in keys
+                ]
+            )
+
+        with legacy:
+            for key in keys:
+                del legacy[key]
 
-        if tries > 4:
-            raise KeyError("Unable to generate a unique API key!")
+        self.plugin.logger.info(
+            "Migrated %s API keys from apikeys.json" % len(keys)
+        )
+
+    def start(self):
+        self.looping_callback = task.LoopingCall(self.flush)
+        self.looping_callback.start(FLUSH_INTERVAL, False)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+        self.flush()
+
+    def flush(self):
+        """
+        Write any pending last-used times to the database.
+        """
+
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE api_keys SET last_used = ? WHERE hash = ?",
+                [(t, key_hash) for key_hash, t in pending.iteritems()]
+            )
+
+    def create_key(self, username):
+        """
+        Create a new key for a user, returning the key itself. This is the
+        only time the key is available - we only keep its hash.
+        """
+
+        username = username.lower()
 
         key = mkpasswd(32, 12, 10, 10)
+        key_hash = hash_key(key)
 
-        if key in self.data:
-            time.sleep(0.01)
-            return self.create_key(username, tries=tries + 1)
+        while key_hash in self.keys:
+            key = mkpasswd(32, 12, 10, 10)
+            key_hash = hash_key(key)
 
-        with self.data:
-            self.data[key] = username
+        k = {
+            "hash": key_hash,
+            "username": username,
+            "hint": key[:HINT_LENGTH],
+            "created": time.time(),
+            "last_used": None
+        }
+
+        with self.db:
+            self.db.execute(
+                "INSERT INTO api_keys VALUES (?, ?, ?, ?, ?)",
+                (key_hash, username, k["hint"], k["created"], None)
+            )
+
+        self._add(k)
 
         return key
 
     def delete_key(self, key):
-        with self.data:
-            if key in self.data:
-                del self.data[key]
-                return True
+        return self.delete_hash(hash_key(key))
+
+    def delete_hash(self, key_hash):
+        if key_hash not in self.keys:
             return False
 
+        self._remove(key_hash)
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM api_keys WHERE hash = ?", (key_hash,)
+            )
+
+        return True
+
     def delete_username(self, username):
-        keys = self.get_keys(username)
+        username = username.lower()
+        hashes = list(self.users.get(username, ()))
 
-        results = []
+        for key_hash in hashes:
+            self._remove(key_hash)
 
-        for key in keys:
-            results.append(self.delete_key(key))
+        with self.db:
+            self.db.execute(
+                "DELETE FROM api_keys WHERE username = ?", (username,)
+            )
 
-        return results
+        return [True] * len(hashes)
 
     def get_keys(self, username):
+        """
+        Get information on a user's keys, oldest first. Each one is a dict
+        with "hash", "username", "hint", "created" and "last_used" keys.
+        """
+
         username = username.lower()
 
-        keys = []
+        return sorted(
+            (dict(self.keys[key_hash])
+             for key_hash in self.users.get(username, ())),
+            key=lambda k: k["created"]
+        )
 
-        for key, value in self.data.iteritems():
-            if value == username:
-                keys.append(key)
+    def get_username(self, key):
+        return self.get_username_by_hash(hash_key(key))
 
-        return keys
+    def get_username_by_hash(self, key_hash):
+        k = self.keys.get(key_hash, None)
 
-    def get_username(self, key):
-        if key in self.data:
-            return self.data[key]
-        return None
+        if k is None:
+            return None
+        return k["username"]
+
+    def use_key(self, key):
+        """
+        Get the username for a key, and mark the key as used.
+        """
+
+        key_hash = hash_key(key)
+        k = self.keys.get(key_hash, None)
+
+        if k is None:
+            return None
+
+        k["last_used"] = time.time()
+        self.pending[key_hash] = k["last_used"]
+        self.uses += 1
+
+        return k["username"]
 
     def is_owner(self, username, key):
+        return self.owns_hash(username, hash_key(key))
+
+    def owns_hash(self, username, key_hash):
         username = username.lower()
 
-        return self.get_username(key) == username
+        return self.get_username_by_hash(key_hash) == username
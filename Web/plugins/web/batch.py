@@ -0,0 +1,171 @@
+"""
+Running several API requests in one - see routes/api/plugins/web/batch.py.
+
+Each sub-request is given to the application as a normal request, with a
+connection that collects the response instead of sending it anywhere, so
+API routes don't need to know they're being batched. They can tell from
+`self.request.batch`, though - that's how the API key is only looked up
+once, and how the rate limiter, sessions and access log know to leave
+sub-requests alone.
+"""
+
+__author__ = 'Gareth Coles'
+
+import json
+import urllib
+
+from cyclone.httpserver import HTTPRequest
+from cyclone.httputil import HTTPHeaders, parse_body_arguments
+
+from twisted.internet import defer
+
+#: Most sub-requests allowed in one batch
+DEFAULT_MAX_ITEMS = 25
+
+#: Seconds to wait for sub-requests before giving up on them
+DEFAULT_TIMEOUT = 30
+
+METHODS = ("GET", "POST", "PUT", "DELETE")
+
+
+class BatchError(Exception):
+    """
+    A sub-request that can't be run, with the status to report for it.
+    """
+
+    def __init__(self, status, message):
+        super(BatchError, self).__init__(message)
+        self.status = status
+
+
+class Batch(object):
+    """
+    What sub-requests know about the batch they're part of.
+    """
+
+    def __init__(self, api_key, username):
+        self.api_key = api_key
+        self.username = username
+
+
+class ResponseCollector(object):
+    """
+    Stands in for the HTTP connection of a sub-request, keeping the
+    response and firing `finished` when it's done.
+    """
+
+    xheaders = False
+    transport = None
+
+    def __init__(self):
+        self.chunks = []
+        self.finished = defer.Deferred()
+        self._closed = defer.Deferred()  # Never fires - we never disconnect
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def finish(self):
+        if not self.finished.called:
+            self.finished.callback(self.get_response())
+
+    def notifyFinish(self):
+        return self._closed
+
+    def get_response(self):
+        """
+        Parse what the handler wrote into a dict with the status, content
+        type and body - decoded, if it's JSON.
+        """
+
+        head, _, body = "".join(self.chunks).partition("\r\n\r\n")
+        lines = head.split("\r\n")
+        status = int(lines[0].split(" ", 2)[1])
+        headers = HTTPHeaders()
+
+        for line in lines[1:]:
+            if line:
+                headers.parse_line(line)
+
+        content_type = headers.get("Content-Type", "")
+        result = {"status": status}
+
+        if content_type.startswith("application/json"):
+            try:
+                result["body"] = json.loads(body)
+            except ValueError:
+                result["body"] = body.decode("utf-8", "replace")
+        else:
+            result["body"] = body.decode("utf-8", "replace")
+
+        return result
+
+
+def build_request(item, prefix, parent, batch, address):
+    """
+    Turn a sub-request from the batch's JSON into a request for the
+    application. `prefix` is the batch's path without "/batch", like
+    "/api/v1/<key>", and `address` is where the batch came from, from
+    RequestHandler.get_client_address().
+    """
+
+    if not isinstance(item, dict):
+        raise BatchError(400, "Sub-requests must be objects")
+
+    path = item.get("path", None)
+    method = str(item.get("method", "GET")).upper()
+
+    if not isinstance(path, basestring) or not path.startswith("/"):
+        raise BatchError(400, "Sub-requests need a path starting with /")
+
+    if method not in METHODS:
+        raise BatchError(405, "Unsupported method: %s" % method)
+
+    path, _, query = path.encode("utf-8").partition("?")
+    args = item.get("args", None)
+
+    if args:
+        if not isinstance(args, dict):
+            raise BatchError(400, "Sub-request args must be an object")
+
+        extra = urllib.urlencode([
+            (unicode(k).encode("utf-8"), unicode(v).encode("utf-8"))
+            for k, v in args.iteritems()
+        ])
+        query = "%s&%s" % (query, extra) if query else extra
+
+    uri = prefix + path
+
+    if query:
+        uri += "?" + query
+
+    headers = HTTPHeaders()
+    body = item.get("body", None)
+
+    if body is None:
+        body = ""
+    elif isinstance(body, basestring):
+        body = body.encode("utf-8")
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    else:
+        body = json.dumps(body)
+        headers["Content-Type"] = "application/json"
+
+    collector = ResponseCollector()
+    request = HTTPRequest(
+        method, uri, version="HTTP/1.0", headers=headers, body=body,
+        remote_ip=address, host=parent.host, connection=collector
+    )
+    request.batch = batch
+
+    # Cyclone ignores the protocol we give it without a real connection
+    request.protocol = parent.protocol
+
+    if method in ("POST", "PUT") and body:
+        # Done by the connection for normal requests
+        parse_body_arguments(
+            headers.get("Content-Type", ""), body, request.arguments,
+            request.files
+        )
+
+    return request, collector
@@ -11,7 +11,13 @@ def check_xsrf(func):
 
 def check_api(func):
     def inner(self, api_key, *args, **kwargs):
-        username = self.plugin.api_keys.get_username(api_key)
+        batch = getattr(self.request, "batch", None)
+
+        if batch is not None and batch.api_key == api_key:
+            # Already looked up, once for the whole batch
+            username = batch.username
+        else:
+            username = self.plugin.api_keys.use_key(api_key)
 
         return func(self, username, *args, **kwargs)
     return inner
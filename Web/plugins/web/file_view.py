@@ -0,0 +1,279 @@
+"""
+Paged access to config and data files, for the admin file editor.
+
+Files are indexed by line once, off the reactor, so any window of lines can
+be read by seeking straight to it. Edits are sent as line-range patches
+against a known version of the file, rather than as the whole file.
+"""
+
+__author__ = 'Gareth Coles'
+
+import os
+import shutil
+import tempfile
+import threading
+
+from array import array
+from collections import OrderedDict
+
+#: Lines between each offset we keep in a file's index
+INDEX_STEP = 1000
+
+#: How many bytes to read at a time while indexing
+CHUNK_SIZE = 64 * 1024
+
+#: How many file indexes to keep around
+CACHE_SIZE = 16
+
+
+class VersionConflict(Exception):
+    """
+    Raised when a patch was made against an older version of a file.
+    """
+
+
+def get_version(path):
+    stat = os.stat(path)
+    return "%s-%s" % (int(stat.st_mtime * 1000), stat.st_size)
+
+
+def find_file(plugin, filetype, filename):
+    """
+    Find a loaded config or data file, returning a (file object, path on
+    disk, error message) tuple.
+    """
+
+    files = {
+        "config": plugin.storage.config_files,
+        "data": plugin.storage.data_files
+    }
+
+    filetype = filetype.lower()
+
+    if filetype not in files:
+        return None, None, "Unknown filetype: %s" % filetype
+
+    files = files[filetype]
+
+    if filename not in files:
+        return None, None, "This file cannot be found. Is it loaded?"
+
+    fh = files[filename].get()
+
+    if fh.representation is None:
+        return None, None, "This file cannot be viewed or edited."
+
+    return fh, os.path.join(filetype, filename), None
+
+
+class LineIndex(object):
+    """
+    Byte offsets of every INDEX_STEP'th line of a file, built by reading the
+    file in chunks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = get_version(path)
+
+        self.offsets = array("L", [0])  # Offset of line n * INDEX_STEP
+        self.total = 0  # Number of lines
+        self.size = 0
+        self.trailing_newline = False
+
+        self.build()
+
+    def build(self):
+        line = 0
+        position = 0
+        last = ""
+
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+
+                if not chunk:
+                    break
+
+                index = chunk.find("\n")
+
+                while index != -1:
+                    line += 1
+
+                    if line % INDEX_STEP == 0:
+                        self.offsets.append(position + index + 1)
+
+                    index = chunk.find("\n", index + 1)
+
+                position += len(chunk)
+                last = chunk[-1]
+
+        self.size = position
+        self.trailing_newline = last == "\n"
+        self.total = line if (self.trailing_newline or not position) \
+            else line + 1
+
+    def offset_of(self, f, line):
+        """
+        Byte offset of the start of `line` (zero-based), using an open file.
+        """
+
+        if line >= self.total:
+            return self.size
+
+        step, skip = divmod(line, INDEX_STEP)
+        f.seek(self.offsets[step])
+
+        for _ in xrange(skip):
+            f.readline()
+
+        return f.tell()
+
+    def read(self, start, count):
+        start = max(0, min(start, self.total))
+        count = max(0, min(count, self.total - start))
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset_of(f, start))
+
+            return [
+                f.readline().rstrip("\n").rstrip("\r").decode(
+                    "UTF-8", "replace"
+                )
+                for _ in xrange(count)
+            ]
+
+
+class FileViews(object):
+    """
+    Cache of line indexes, shared between threads. Everything else here is
+    meant to be called from the threadpool, not the reactor.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.path_locks = {}  # Path: lock held while patching that file
+
+    def get_index(self, path):
+        version = get_version(path)
+
+        with self.lock:
+            index = self.indexes.pop(path, None)
+
+        if index is None or index.version != version:
+            index = LineIndex(path)
+
+        with self.lock:
+            self.indexes[path] = index
+
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+
+        return index
+
+    def invalidate(self, path):
+        with self.lock:
+            self.indexes.pop(path, None)
+
+    def get_path_lock(self, path):
+        """
+        The lock to hold while checking a file's version and writing it, so
+        two patches against the same version can't both be saved.
+        """
+
+        with self.lock:
+            lock = self.path_locks.get(path, None)
+
+            if lock is None:
+                lock = self.path_locks[path] = threading.Lock()
+
+            return lock
+
+    def write(self, path, data):
+        """
+        Replace a file's contents. The data is written to a temporary file
+        next to it first, so a failed write can't leave it truncated.
+        """
+
+        fd, temp_path = tempfile.mkstemp(
+            prefix=".%s." % os.path.basename(path),
+            dir=os.path.dirname(path) or "."
+        )
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+
+            shutil.copymode(path, temp_path)
+
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Windows won't rename over an existing file
+                os.remove(path)
+                os.rename(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.invalidate(path)
+
+    def read_lines(self, path, start, count):
+        """
+        Get a window of lines, as a dict with "start", "lines", "total" and
+        "version" keys.
+        """
+
+        index = self.get_index(path)
+        start = max(0, min(start, index.total))
+
+        return {
+            "start": start,
+            "lines": index.read(start, count),
+            "total": index.total,
+            "version": index.version
+        }
+
+    def build_patch(self, path, version, start, end, lines):
+        """
+        Get the contents of a file with lines `start` to `end` (zero-based,
+        end exclusive) replaced with `lines`. Raises VersionConflict if the
+        file isn't at the given version any more.
+        """
+
+        index = self.get_index(path)
+
+        if index.version != version:
+            raise VersionConflict(
+                "This file has changed since you loaded it."
+            )
+
+        start = max(0, min(start, index.total))
+        end = max(start, min(end, index.total))
+
+        with open(path, "rb") as f:
+            before_end = index.offset_of(f, start)
+            after_start = index.offset_of(f, end)
+
+            f.seek(0)
+            before = f.read(before_end)
+
+            f.seek(after_start)
+            after = f.read()
+
+        middle = "\n".join(
+            line.encode("UTF-8") if isinstance(line, unicode) else line
+            for line in lines
+        )
+
+        if lines:
+            if before and not before.endswith("\n"):
+                before += "\n"  # Adding lines after a missing final newline
+            if after or index.trailing_newline:
+                middle += "\n"
+
+        return before + middle + after
@@ -0,0 +1,448 @@
+"""
+Object census, for hunting memory leaks.
+
+Every so often, we count the objects the garbage collector knows about by
+type, with their approximate sizes, and keep the last few counts so they
+can be compared - a type whose count only ever goes up is a good suspect.
+Objects are also totalled up by the plugin module that owns them: a plugin
+owns instances of its own classes, and the containers directly held by
+those instances and classes. That catches state kept on a class, which
+lives on across plugin reloads.
+
+Sizes come from sys.getsizeof(), so they're shallow - a list's size doesn't
+include what's in it, for example. They're good for comparing, not for
+adding up to the process's memory use.
+
+For a suspicious type, we can also find out what's keeping some of its
+instances alive, by following referrers back to a module.
+"""
+
+__author__ = 'Gareth Coles'
+
+import gc
+import sys
+import time
+import types
+import weakref
+
+from collections import deque
+
+from twisted.internet import task, threads
+
+from plugins.web.lag import BLAME_DIRS
+
+#: Seconds between snapshots
+DEFAULT_INTERVAL = 15 * 60
+
+#: Snapshots to keep
+DEFAULT_HISTORY = 24
+
+#: Containers counted towards their owner's size
+CONTAINERS = (dict, list, set, frozenset, tuple, deque)
+
+#: Module prefixes that can own objects
+OWNER_PREFIXES = tuple(
+    d.replace("/", ".").replace("\\", ".") + "." for d in BLAME_DIRS
+)
+
+#: Referrers to look at before giving up on a chain
+MAX_STEPS = 100
+
+#: Longest chain to look for
+MAX_DEPTH = 12
+
+
+def get_type_name(t):
+    module = getattr(t, "__module__", None)
+
+    if not isinstance(module, basestring) or module == "__builtin__":
+        return t.__name__
+    return "%s.%s" % (module, t.__name__)
+
+
+def get_owner(module):
+    """
+    The plugin module that owns things defined in `module` - the package
+    directly under plugins (or system.protocols), like "plugins.feeds" - or
+    None.
+    """
+
+    if not module or not isinstance(module, basestring):
+        return None
+
+    for prefix in OWNER_PREFIXES:
+        if module.startswith(prefix):
+            return ".".join(module.split(".")[:prefix.count(".") + 1])
+    return None
+
+
+def get_class(obj):
+    if isinstance(obj, types.InstanceType):  # Old-style instance
+        return obj.__class__
+    return type(obj)
+
+
+def get_owned_size(obj):
+    """
+    The size of an object, its __dict__ and the containers directly in it.
+    """
+
+    size = sys.getsizeof(obj, 0)
+
+    try:
+        d = object.__getattribute__(obj, "__dict__")
+    except Exception:
+        try:
+            d = obj.__dict__ if type(obj) in (
+                types.InstanceType, types.ClassType
+            ) else None
+        except Exception:
+            d = None
+
+    if isinstance(d, (dict, types.DictProxyType)):  # Classes have proxies
+        size += sys.getsizeof(d, 0)
+
+        for value in d.values():
+            if isinstance(value, CONTAINERS):
+                size += sys.getsizeof(value, 0)
+
+    return size
+
+
+class Snapshot(object):
+    """
+    Counts and sizes of the objects alive at one point in time.
+    """
+
+    def __init__(self, snapshot_id):
+        self.id = snapshot_id
+        self.time = time.time()
+        self.duration = 0.0
+
+        self.objects = 0
+        self.size = 0
+        self.types = {}  # Type name: [count, size]
+        self.owners = {}  # Plugin module: [count, size]
+
+    def take(self):
+        started = time.time()
+        type_names = {}  # Type: (name, owner), as there are far fewer types
+
+        objects = gc.get_objects()
+
+        try:
+            for obj in objects:
+                cls = get_class(obj)
+                info = type_names.get(cls, None)
+
+                if info is None:
+                    info = type_names[cls] = (
+                        get_type_name(cls),
+                        get_owner(getattr(cls, "__module__", None))
+                    )
+
+                name, owner = info
+                size = sys.getsizeof(obj, 0)
+
+                entry = self.types.get(name, None)
+
+                if entry is None:
+                    entry = self.types[name] = [0, 0]
+
+                entry[0] += 1
+                entry[1] += size
+
+                self.objects += 1
+                self.size += size
+
+                if owner is None and isinstance(obj, (type, types.ClassType)):
+                    # A class, which may keep state for its plugin
+                    owner = get_owner(getattr(obj, "__module__", None))
+
+                if owner is not None:
+                    entry = self.owners.get(owner, None)
+
+                    if entry is None:
+                        entry = self.owners[owner] = [0, 0]
+
+                    entry[0] += 1
+                    entry[1] += get_owned_size(obj)
+        finally:
+            del objects
+
+        self.duration = time.time() - started
+
+    def get_info(self):
+        return {
+            "id": self.id,
+            "time": self.time,
+            "duration": self.duration,
+            "objects": self.objects,
+            "size": self.size
+        }
+
+    def top(self, which, count=50):
+        entries = getattr(self, which)
+
+        return sorted(
+            ([name, n, size] for name, (n, size) in entries.iteritems()),
+            key=lambda e: e[2], reverse=True
+        )[:count]
+
+    def diff(self, older, which, count=50):
+        """
+        How counts and sizes changed since an older snapshot, biggest
+        growth first.
+        """
+
+        new = getattr(self, which)
+        old = getattr(older, which)
+        rows = []
+
+        for name in set(new) | set(old):
+            n, size = new.get(name, (0, 0))
+            old_n, old_size = old.get(name, (0, 0))
+
+            if n != old_n or size != old_size:
+                rows.append([name, n, n - old_n, size, size - old_size])
+
+        rows.sort(key=lambda r: (r[4], r[2]), reverse=True)
+        return rows[:count]
+
+
+## Referrer chains
+
+def describe(obj):
+    t = type(obj)
+
+    if isinstance(obj, types.ModuleType):
+        return "module %s" % obj.__name__
+    elif isinstance(obj, (type, types.ClassType)):
+        return "class %s" % get_type_name(obj)
+    elif t in (types.FunctionType, types.MethodType):
+        return "%s %s" % (t.__name__, getattr(obj, "__name__", "?"))
+    elif isinstance(obj, (dict, list, set, frozenset, tuple, deque)):
+        return "%s of %s" % (get_type_name(t), len(obj))
+    return "%s instance" % get_type_name(get_class(obj))
+
+
+def describe_edge(parent, child):
+    """
+    How `parent` refers to `child`, if we can tell.
+    """
+
+    try:
+        if isinstance(parent, dict):
+            for key, value in parent.iteritems():
+                if value is child:
+                    return "[%r]" % (key,)
+                if key is child:
+                    return "(key)"
+        elif isinstance(parent, (list, tuple, deque)):
+            for i, value in enumerate(parent):
+                if value is child:
+                    return "[%s]" % i
+        elif getattr(parent, "__dict__", None) is child:
+            return ".__dict__"
+        elif isinstance(parent, type) and isinstance(child, dict):
+            return ".__dict__"  # We only get a proxy for a class's dict
+    except Exception:
+        pass
+    return ""
+
+
+def find_chain(target, ignore):
+    """
+    Follow referrers back from `target` until we get to a module, returning
+    a list of (description, edge) from the module to the target - or the
+    longest chain we found, if we don't get to one.
+    """
+
+    start = [target]
+    ignore = set(ignore) | set([id(start)])
+
+    paths = deque([start])
+    seen = set([id(target)])
+    longest = start
+    steps = 0
+
+    ignore.add(id(paths))
+
+    while paths and steps < MAX_STEPS:
+        path = paths.popleft()
+        obj = path[-1]
+        steps += 1
+
+        referrers = gc.get_referrers(obj)
+        ignore.add(id(referrers))
+
+        try:
+            for referrer in referrers:
+                if id(referrer) in ignore or id(referrer) in seen:
+                    continue
+
+                if isinstance(referrer, types.FrameType):
+                    continue  # Someone's local variables - likely ours
+
+                seen.add(id(referrer))
+                new_path = path + [referrer]
+                ignore.add(id(new_path))
+
+                if isinstance(referrer, types.ModuleType):
+                    return _format_chain(new_path)
+
+                if len(new_path) <= MAX_DEPTH:
+                    paths.append(new_path)
+
+                    if len(new_path) > len(longest):
+                        longest = new_path
+        finally:
+            del referrers
+
+    return _format_chain(longest)
+
+
+def _format_chain(path):
+    chain = []
+
+    for i in xrange(len(path) - 1, -1, -1):
+        edge = describe_edge(path[i], path[i - 1]) if i else ""
+        chain.append((describe(path[i]), edge))
+
+    return chain
+
+
+def find_referrers(type_name, count=3):
+    """
+    Find chains for up to `count` live objects of the named type.
+    """
+
+    objects = gc.get_objects()
+    found = []
+
+    try:
+        for obj in objects:
+            if get_type_name(get_class(obj)) == type_name:
+                found.append(obj)
+
+                if len(found) >= count:
+                    break
+    finally:
+        del objects
+
+    ignore = set([id(found)])
+    chains = []
+
+    try:
+        for obj in found:
+            chains.append(find_chain(obj, ignore))
+    finally:
+        del found[:]
+
+    return chains
+
+
+class HeapCensus(object):
+    """
+    Takes snapshots on a timer, or when asked. The counting is done in a
+    thread, and the results kept on the reactor.
+    """
+
+    _plugin_object = None
+
+    looping_callback = None
+    taking = None  # Deferred for a snapshot that's being taken
+    last_id = 0
+
+    referrers = None  # The last referrer search - type, time and chains
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.snapshots = deque(maxlen=config.get("history", DEFAULT_HISTORY))
+
+    def start(self):
+        self.plugin.stats.register_series(
+            "heap_objects", unit="objects",
+            description="Objects tracked by the garbage collector"
+        )
+
+        if self.interval:
+            self.looping_callback = task.LoopingCall(self.take_snapshot)
+            self.looping_callback.start(self.interval)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+    def take_snapshot(self):
+        """
+        Take a snapshot in a thread, returning a Deferred that fires with
+        it. Only one is taken at a time.
+        """
+
+        if self.taking is not None:
+            return self.taking
+
+        self.last_id += 1
+        snapshot = Snapshot(self.last_id)
+
+        def done(_):
+            self.taking = None
+            self.snapshots.append(snapshot)
+            self.plugin.stats.record("heap_objects", snapshot.objects)
+            return snapshot
+
+        def failed(failure):
+            self.taking = None
+            self.plugin.logger.error(
+                "Unable to take heap snapshot: %s" % failure.getErrorMessage()
+            )
+
+        self.taking = threads.deferToThread(snapshot.take)
+        self.taking.addCallbacks(done, failed)
+
+        return self.taking
+
+    def find_referrers(self, type_name, count=3):
+        """
+        Look for what's keeping objects of a type alive, in a thread,
+        returning a Deferred that fires with the result - or None, if the
+        search failed. This may hold up the reactor for a moment, each time
+        it looks at every object.
+        """
+
+        def done(chains):
+            self.referrers = {
+                "type": type_name,
+                "time": time.time(),
+                "chains": chains
+            }
+            return self.referrers
+
+        def failed(failure):
+            self.plugin.logger.error(
+                "Unable to find referrers for %s: %s" % (
+                    type_name, failure.getErrorMessage()
+                )
+            )
+
+        d = threads.deferToThread(find_referrers, type_name, count)
+        d.addCallbacks(done, failed)
+
+        return d
+
+    def get_snapshot(self, snapshot_id):
+        for snapshot in self.snapshots:
+            if snapshot.id == snapshot_id:
+                return snapshot
+        return None
@@ -0,0 +1,235 @@
+"""
+Reactor lag monitoring.
+
+A heartbeat on the reactor measures how late it gets to run, and a watchdog
+thread notices when the heartbeat has stopped for too long and grabs the
+reactor thread's stack. Whatever plugin code is on that stack is the likely
+culprit - usually blocking I/O that should be in a thread.
+"""
+
+__author__ = 'Gareth Coles'
+
+import os
+import sys
+import thread
+import threading
+import time
+import traceback
+import weakref
+
+from collections import deque
+
+from twisted.internet import task
+
+#: Directories that contain code we'd like to blame, relative to Ultros
+BLAME_DIRS = ("plugins", os.path.join("system", "protocols"))
+
+
+def get_module_name(filename, root=None):
+    """
+    Get the dotted module name for a file under one of BLAME_DIRS, or None
+    if it isn't one of ours.
+    """
+
+    if root is None:
+        root = os.getcwd()
+
+    path = os.path.relpath(os.path.abspath(filename), root)
+
+    if path.startswith(os.pardir):
+        return None
+
+    for directory in BLAME_DIRS:
+        if path.startswith(directory + os.sep):
+            break
+    else:
+        return None
+
+    path = os.path.splitext(path)[0]
+
+    if path.endswith(os.sep + "__init__"):
+        path = path[:-len(os.sep + "__init__")]
+
+    return path.replace(os.sep, ".")
+
+
+class LagMonitor(object):
+    """
+    The heartbeat, the watchdog and the history of stalls they've caught.
+
+    Each stall is a dict with "time", "duration" (seconds, updated until the
+    stall ends), "module" (the innermost plugin module on the stack, or None)
+    and "stack" (formatted stack lines, outermost first).
+    """
+
+    _plugin_object = None
+
+    interval = 0.05  # Seconds between heartbeats
+    threshold = 0.25  # Lag, in seconds, before we capture the stack
+
+    looping_callback = None
+    watchdog = None
+    stopping = None  # Event that tells the watchdog to stop
+
+    reactor_thread = None  # Thread ID of the reactor
+    last_beat = 0
+
+    current = None  # The stall that's happening right now, if any
+    stalls = None  # Recent stalls, newest last
+    max_lag = 0  # Largest lag since stats last sampled it
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.interval = config.get("interval", self.interval)
+        self.threshold = config.get("threshold", self.threshold)
+        self.stalls = deque(maxlen=config.get("history", 200))
+
+        self.lock = threading.Lock()
+
+        self.counters = {
+            "beats": 0,
+            "late_beats": 0,  # Beats later than the threshold
+            "stalls": 0  # Stalls the watchdog caught
+        }
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def start(self):
+        # We're on the reactor thread here
+        self.reactor_thread = thread.get_ident()
+        self.last_beat = time.time()
+
+        self.plugin.stats.register_series(
+            "reactor_lag", self.sample_lag, "ms",
+            "Largest reactor lag in each sample"
+        )
+
+        self.looping_callback = task.LoopingCall(self.beat)
+        self.looping_callback.start(self.interval, False)
+
+        self.stopping = threading.Event()
+        self.watchdog = threading.Thread(
+            target=self.watch, args=(self.stopping,),
+            name="Web reactor watchdog"
+        )
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+        self.watchdog = None
+
+    def sample_lag(self):
+        lag, self.max_lag = self.max_lag, 0
+        return lag * 1000
+
+    ## Reactor side
+
+    def beat(self):
+        now = time.time()
+
+        with self.lock:
+            lag = max(0, now - self.last_beat - self.interval)
+            self.last_beat = now
+
+            if self.current is not None:
+                self.current["duration"] = lag
+                self.current["ongoing"] = False
+                self.current = None
+
+        self.counters["beats"] += 1
+        self.max_lag = max(self.max_lag, lag)
+
+        if lag >= self.threshold:
+            self.counters["late_beats"] += 1
+
+    ## Watchdog thread
+
+    def watch(self, stopping):
+        poll = max(0.01, self.threshold / 5)
+
+        while not stopping.wait(poll):
+            with self.lock:
+                waited = time.time() - self.last_beat - self.interval
+
+                if self.current is not None:
+                    self.current["duration"] = waited
+                    continue
+
+                if waited < self.threshold:
+                    continue
+
+                frame = sys._current_frames().get(self.reactor_thread, None)
+
+                if frame is None:
+                    continue
+
+                self.current = self.capture(frame, waited)
+                self.stalls.append(self.current)
+                self.counters["stalls"] += 1
+
+    def capture(self, frame, waited):
+        stack = traceback.extract_stack(frame)
+        module = None
+
+        for filename, _, _, _ in reversed(stack):
+            module = get_module_name(filename)
+
+            if module is not None:
+                break
+
+        return {
+            "time": time.time() - waited,
+            "duration": waited,
+            "ongoing": True,
+            "module": module,
+            "stack": traceback.format_list(stack)
+        }
+
+    ## Results
+
+    def get_stalls(self):
+        with self.lock:
+            return [dict(s) for s in self.stalls]
+
+    def get_summary(self):
+        """
+        Stalls grouped by module, worst total first.
+        """
+
+        modules = {}
+
+        for stall in self.get_stalls():
+            name = stall["module"] or "(unknown)"
+
+            if name not in modules:
+                modules[name] = {
+                    "module": name, "count": 0, "total": 0.0, "max": 0.0,
+                    "last": 0
+                }
+
+            entry = modules[name]
+            entry["count"] += 1
+            entry["total"] += stall["duration"]
+            entry["max"] = max(entry["max"], stall["duration"])
+            entry["last"] = max(entry["last"], stall["time"])
+
+        return sorted(
+            modules.values(), key=lambda e: e["total"], reverse=True
+        )
+
+    def clear(self):
+        with self.lock:
+            self.stalls.clear()
@@ -0,0 +1,248 @@
+"""
+Multi-resolution time-series storage for statistics.
+
+Each series is stored at several resolutions - raw samples, and rollups
+over one minute, one hour and one day - in fixed-size ring buffers backed
+by arrays, so a series never takes more memory than it did when it was
+created, however long the bot runs.
+"""
+
+__author__ = 'Gareth Coles'
+
+import time
+
+from array import array
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+#: (name, bucket length in seconds, number of buckets) for every series;
+#: a length of 0 keeps every sample as it comes in
+RESOLUTIONS = (
+    ("raw", 0, 720),  # An hour, at the default 5 second sample interval
+    ("1m", MINUTE, 1440),  # A day
+    ("1h", HOUR, 24 * 14),  # Two weeks
+    ("1d", DAY, 365)  # A year
+)
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of (time, min, avg, max) points, oldest overwritten
+    first. Times are stored as doubles and values as single-precision
+    floats.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array("d", [0.0] * size)
+        self.mins = array("f", [0.0] * size)
+        self.avgs = array("f", [0.0] * size)
+        self.maxes = array("f", [0.0] * size)
+
+        self.next = 0  # Where the next point goes
+        self.count = 0  # How many points we're holding
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, low, avg, high):
+        i = self.next
+
+        self.times[i] = t
+        self.mins[i] = low
+        self.avgs[i] = avg
+        self.maxes[i] = high
+
+        self.next = (i + 1) % self.size
+
+        if self.count < self.size:
+            self.count += 1
+
+    def _indexes(self):
+        start = (self.next - self.count) % self.size
+
+        for offset in xrange(self.count):
+            yield (start + offset) % self.size
+
+    @property
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.times[(self.next - self.count) % self.size]
+
+    @property
+    def latest(self):
+        if not self.count:
+            return None
+
+        i = (self.next - 1) % self.size
+        return self.times[i], self.mins[i], self.avgs[i], self.maxes[i]
+
+    def points(self, start=None, end=None):
+        """
+        Points between `start` and `end` (inclusive), oldest first.
+        """
+
+        result = []
+
+        for i in self._indexes():
+            t = self.times[i]
+
+            if start is not None and t < start:
+                continue
+            if end is not None and t > end:
+                break
+
+            result.append((t, self.mins[i], self.avgs[i], self.maxes[i]))
+
+        return result
+
+
+class Resolution(object):
+    """
+    One resolution of a series - a ring buffer, plus the bucket that's
+    still being filled.
+    """
+
+    def __init__(self, name, step, size):
+        self.name = name
+        self.step = step
+        self.buffer = RingBuffer(size)
+
+        self.bucket = None  # Start time of the bucket being filled
+        self.low = self.high = self.total = 0.0
+        self.samples = 0
+
+    def add(self, t, value):
+        if not self.step:
+            self.buffer.append(t, value, value, value)
+            return
+
+        bucket = t - (t % self.step)
+
+        if bucket != self.bucket:
+            self.commit()
+            self.bucket = bucket
+
+        if not self.samples:
+            self.low = self.high = value
+        else:
+            self.low = min(self.low, value)
+            self.high = max(self.high, value)
+
+        self.total += value
+        self.samples += 1
+
+    def commit(self):
+        if self.samples:
+            self.buffer.append(
+                self.bucket, self.low, self.total / self.samples, self.high
+            )
+
+        self.low = self.high = self.total = 0.0
+        self.samples = 0
+
+    def points(self, start=None, end=None):
+        result = self.buffer.points(start, end)
+
+        if self.samples:  # Include the unfinished bucket
+            if (start is None or self.bucket >= start) and \
+                    (end is None or self.bucket <= end):
+                result.append((
+                    self.bucket, self.low, self.total / self.samples,
+                    self.high
+                ))
+
+        return result
+
+
+class Series(object):
+    """
+    A named series of values, stored at every resolution in RESOLUTIONS.
+    """
+
+    def __init__(self, name, unit="", description="", func=None,
+                 interval=5):
+        self.name = name
+        self.unit = unit
+        self.description = description
+        self.func = func  # Called to take a sample, if this isn't pushed to
+        self.interval = interval  # Seconds between raw samples
+
+        self.resolutions = [
+            Resolution(res_name, step, size)
+            for res_name, step, size in RESOLUTIONS
+        ]
+
+    def get_info(self):
+        return {
+            "name": self.name,
+            "unit": self.unit,
+            "description": self.description,
+            "resolutions": [r.name for r in self.resolutions]
+        }
+
+    def add(self, value, t=None):
+        if t is None:
+            t = time.time()
+
+        value = float(value)
+
+        for resolution in self.resolutions:
+            resolution.add(t, value)
+
+    @property
+    def latest(self):
+        return self.resolutions[0].buffer.latest
+
+    def get_resolution(self, name):
+        for resolution in self.resolutions:
+            if resolution.name == name:
+                return resolution
+        raise KeyError("Unknown resolution: %s" % name)
+
+    def pick_resolution(self, start, end, max_points=None):
+        """
+        Pick the finest resolution that keeps enough history to reach back
+        to `start`, and, if `max_points` is given, covers the range in no
+        more points than that.
+        """
+
+        now = time.time()
+
+        for resolution in self.resolutions:
+            step = resolution.step or self.interval
+
+            # One step of slack, for the bucket that's still being filled
+            if now - start > step * (resolution.buffer.size + 1):
+                continue
+            if max_points and (end - start) / step > max_points:
+                continue
+
+            return resolution
+
+        return self.resolutions[-1]
+
+    def query(self, start=None, end=None, resolution=None, max_points=None):
+        """
+        Get points between `start` and `end`, as [time in milliseconds, min,
+        avg, max] lists. If no resolution is given, a suitable one is
+        picked. Returns a (resolution name, points) tuple.
+        """
+
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - HOUR
+
+        if resolution is None:
+            res = self.pick_resolution(start, end, max_points)
+        else:
+            res = self.get_resolution(resolution)
+
+        return res.name, [
+            [int(t * 1000), round(low, 3), round(avg, 3), round(high, 3)]
+            for t, low, avg, high in res.points(start, end)
+        ]
@@ -0,0 +1,192 @@
+"""
+A short-lived cache of permission decisions.
+
+Almost every route checks a permission, and polling routes do it every few
+seconds for every open tab. Decisions are cached per (username, permission)
+for a few seconds, and dropped early when the permissions file is reloaded,
+the permissions handler is replaced, or the user logs out.
+"""
+
+__author__ = 'Gareth Coles'
+
+import time
+import weakref
+
+#: Seconds to keep a decision for
+DEFAULT_TTL = 5.0
+
+#: Entries to allow before we go looking for expired ones
+MAX_SIZE = 1000
+
+#: Where the auth plugin keeps its permissions, relative to data/
+PERMISSIONS_FILE = "plugins/auth/permissions.yml"
+
+
+class PermissionCache(object):
+    """
+    Cache for WebPlugin.check_permission(). This is only used from the
+    reactor thread.
+    """
+
+    _plugin_object = None
+
+    ttl = DEFAULT_TTL
+    permissions_file = PERMISSIONS_FILE
+
+    handler = None  # The permissions handler our decisions came from
+    watching = None  # The storage file we've added a callback to
+
+    _sampled = (0, 0)  # Hits and misses at the last stats sample
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.ttl = config.get("ttl", self.ttl)
+        self.permissions_file = config.get(
+            "permissions_file", self.permissions_file
+        )
+
+        self.decisions = {}  # (username, permission): (allowed, expires)
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def start(self):
+        self.plugin.stats.register_series(
+            "permission_cache_hit_rate", self.sample_hit_rate, "%",
+            "Permission checks answered from the cache"
+        )
+
+        self.watch()
+
+    def stop(self):
+        if self.watching is not None:
+            remove = getattr(self.watching, "remove_callback", None)
+
+            if remove is not None:
+                try:
+                    remove(self.reloaded)
+                except ValueError:
+                    pass
+
+            self.watching = None
+
+        self.clear()
+
+    def watch(self):
+        """
+        Add a callback to the permissions file, if it's loaded, so we know
+        when it changes.
+        """
+
+        files = self.plugin.storage.data_files
+
+        if self.permissions_file not in files:
+            return False
+
+        fh = files[self.permissions_file].get()
+
+        if fh is None or fh is self.watching:
+            return False
+
+        fh.add_callback(self.reloaded)
+        self.watching = fh
+
+        return True
+
+    def reloaded(self):
+        self.plugin.logger.debug("Permissions reloaded, clearing cache")
+        self.clear()
+
+    def check(self, perm, username):
+        handler = self.plugin.commands.perm_handler
+
+        if handler is not self.handler:
+            # The auth plugin was reloaded, or this is our first check
+            self.clear()
+            self.handler = handler
+            self.watch()
+
+        key = (username, perm)
+        now = time.time()
+        decision = self.decisions.get(key, None)
+
+        if decision is not None and decision[1] > now:
+            self.hits += 1
+            return decision[0]
+
+        self.misses += 1
+        allowed = handler.check(perm, username, "web", "plugin-web")
+
+        if len(self.decisions) >= MAX_SIZE:
+            self.expire(now)
+
+        self.decisions[key] = (allowed, now + self.ttl)
+        return allowed
+
+    def clear(self):
+        if self.decisions:
+            self.invalidations += 1
+        self.decisions = {}
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+
+        self.decisions = dict(
+            (key, decision) for key, decision in self.decisions.iteritems()
+            if decision[1] > now
+        )
+
+    def invalidate(self, username):
+        """
+        Forget every decision for a user, for when they log out.
+        """
+
+        username = username.lower()
+        keys = [
+            key for key in self.decisions
+            if key[0] is not None and key[0].lower() == username
+        ]
+
+        for key in keys:
+            del self.decisions[key]
+
+        if keys:
+            self.invalidations += 1
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+
+        if not total:
+            return 0.0
+        return self.hits * 100.0 / total
+
+    def sample_hit_rate(self):
+        hits, misses = self.hits, self.misses
+        old_hits, old_misses = self._sampled
+        self._sampled = (hits, misses)
+
+        total = (hits - old_hits) + (misses - old_misses)
+
+        if not total:
+            return 0.0
+        return (hits - old_hits) * 100.0 / total
+
+    def get_stats(self):
+        return {
+            "entries": len(self.decisions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.get_hit_rate(),
+            "invalidations": self.invalidations,
+            "ttl": self.ttl
+        }
@@ -0,0 +1,369 @@
+"""
+A sampling profiler for the running bot.
+
+A thread wakes up every few milliseconds and looks at the stack of every
+other thread - the reactor, the thread pools and anything plugins started -
+and counts how often each stack comes up. That's much cheaper than tracing
+every call like cProfile does, and it can be turned on and off while the
+bot is running.
+
+The sampler keeps its own cost down to a fraction of one CPU by sleeping
+for longer when taking samples gets expensive, and every profile stops by
+itself after a while. Results are collapsed stacks, ready for
+flamegraph.pl or speedscope, and tables of the busiest plugin modules and
+functions.
+"""
+
+__author__ = 'Gareth Coles'
+
+import os
+import re
+import sys
+import thread
+import threading
+import time
+import weakref
+
+from collections import deque
+
+from plugins.web.lag import get_module_name
+
+#: Seconds between samples, unless sampling is too expensive for that
+DEFAULT_INTERVAL = 0.01
+
+#: Longest a profile may run for, in seconds
+DEFAULT_MAX_DURATION = 120
+
+#: Most of one CPU the sampler may use, as a fraction
+DEFAULT_MAX_OVERHEAD = 0.05
+
+#: Frames to keep from the top of each stack
+MAX_DEPTH = 128
+
+#: Different stacks to keep - samples of any others are counted separately
+MAX_STACKS = 20000
+
+#: Pool threads are numbered - we group them together
+THREAD_NUMBER = re.compile(r"-[0-9]+$")
+
+_module_names = {}  # Filename: module name, for get_frame_label()
+
+
+def get_frame_label(filename, function):
+    """
+    Turn a code location into a "dotted.module:function" label, as short as
+    we can make it.
+    """
+
+    module = _module_names.get(filename, None)
+
+    if module is None:
+        path = os.path.abspath(filename)
+        module = get_module_name(path)
+
+        if module is None:
+            # Not one of ours, so find the sys.path entry it's under
+            best = ""
+
+            for entry in sys.path:
+                entry = os.path.abspath(entry or os.curdir)
+
+                if path.startswith(entry + os.sep) and len(entry) > len(best):
+                    best = entry
+
+            if best:
+                path = os.path.relpath(path, best)
+            else:
+                path = os.path.basename(path)
+
+            module = os.path.splitext(path)[0].replace(os.sep, ".")
+
+            if module.endswith(".__init__"):
+                module = module[:-len(".__init__")]
+
+        _module_names[filename] = module
+
+    return "%s:%s" % (module, function)
+
+
+class Profile(object):
+    """
+    One profiling session, and its results.
+
+    `stacks` maps (thread name, stack) to a sample count, where the stack is
+    a tuple of frame labels, outermost first. It's only written to by the
+    sampler thread, under `lock`.
+    """
+
+    def __init__(self, profile_id, duration, interval):
+        self.id = profile_id
+        self.duration = duration
+        self.interval = interval
+
+        self.started = time.time()
+        self.finished = None  # Set when it stops
+
+        self.samples = 0  # Times we looked at every thread
+        self.stacks = {}
+        self.dropped = 0  # Stacks not kept, because we had too many
+        self.sample_time = 0.0  # Seconds spent taking samples
+
+        self.blame = {}  # Frame label: plugin module, or None
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.finished is None
+
+    def get_stacks(self):
+        with self.lock:
+            return dict(self.stacks)
+
+    def get_overhead(self):
+        """
+        The fraction of one CPU taken by sampling.
+        """
+
+        elapsed = (self.finished or time.time()) - self.started
+
+        if elapsed <= 0:
+            return 0.0
+        return self.sample_time / elapsed
+
+    def get_collapsed(self):
+        """
+        The stacks in the "collapsed" format used by flamegraph.pl and
+        friends - one line per stack, frames separated by semicolons and
+        the thread name first, followed by the number of samples.
+        """
+
+        lines = []
+
+        for (name, stack), count in sorted(self.get_stacks().iteritems()):
+            frames = [name] + [label.replace(";", ":") for label in stack]
+            lines.append("%s %s" % (";".join(frames), count))
+
+        return "\n".join(lines) + "\n"
+
+    def get_top(self, count=20):
+        """
+        The busiest plugin modules and functions.
+
+        A module's "self" samples are those where it was the innermost of
+        our modules on the stack - the same way the lag monitor assigns
+        blame - and its "total" samples are those where it was anywhere on
+        the stack. Functions are counted the same way, by frame.
+        """
+
+        modules = {}
+        functions = {}
+        total = 0
+
+        for (name, stack), n in self.get_stacks().iteritems():
+            total += n
+
+            blamed = None
+            seen = set()
+
+            for label in reversed(stack):
+                module = self.blame.get(label, None)
+
+                if module is None or module in seen:
+                    continue
+
+                if blamed is None:
+                    blamed = module
+
+                seen.add(module)
+                entry = modules.setdefault(module, [module, 0, 0])
+                entry[2] += n
+
+            if blamed is not None:
+                modules[blamed][1] += n
+
+            for label in set(stack):
+                entry = functions.setdefault(label, [label, 0, 0])
+                entry[2] += n
+
+            if stack:
+                functions[stack[-1]][1] += n
+
+        def top(entries):
+            entries = sorted(
+                entries.itervalues(), key=lambda e: (e[1], e[2]),
+                reverse=True
+            )
+
+            return [
+                {"name": e[0], "self": e[1], "total": e[2]}
+                for e in entries[:count]
+            ]
+
+        return {
+            "samples": total,
+            "modules": top(modules),
+            "functions": top(functions)
+        }
+
+    def get_info(self):
+        return {
+            "id": self.id,
+            "started": self.started,
+            "finished": self.finished,
+            "running": self.running,
+            "duration": self.duration,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "dropped": self.dropped,
+            "overhead": self.get_overhead()
+        }
+
+
+class SamplingProfiler(object):
+    """
+    Runs one profile at a time, keeping the last few around.
+    """
+
+    _plugin_object = None
+
+    current = None  # The profile that's running, if any
+    thread = None
+    stopping = None  # Event that tells the sampler to stop early
+
+    last_id = 0
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.max_duration = config.get("max_duration", DEFAULT_MAX_DURATION)
+        self.max_overhead = config.get("max_overhead", DEFAULT_MAX_OVERHEAD)
+        self.profiles = deque(maxlen=config.get("history", 5))
+
+    def start(self, duration, interval=None):
+        """
+        Start profiling for `duration` seconds, returning the new Profile -
+        or None if there's one running already.
+        """
+
+        if self.current is not None and self.current.running:
+            return None
+
+        if interval is None:
+            interval = self.interval
+
+        duration = max(1, min(duration, self.max_duration))
+        interval = max(0.001, interval)
+
+        self.last_id += 1
+        profile = Profile(self.last_id, duration, interval)
+
+        self.current = profile
+        self.profiles.append(profile)
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self.sample, args=(profile, self.stopping),
+            name="Web profiler"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.plugin.logger.info(
+            "Profiling for %s seconds, every %sms"
+            % (duration, int(interval * 1000))
+        )
+
+        return profile
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+        self.thread = None
+
+    def get_profile(self, profile_id):
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    ## Sampler thread
+
+    def sample(self, profile, stopping):
+        me = thread.get_ident()
+        names = {}
+        names_updated = 0
+        end = profile.started + profile.duration
+        wait = profile.interval
+
+        try:
+            while not stopping.wait(wait):
+                started = time.time()
+
+                if started >= end:
+                    break
+
+                if started - names_updated > 1:
+                    names = dict(
+                        (t.ident, THREAD_NUMBER.sub("", t.name))
+                        for t in threading.enumerate()
+                    )
+                    names_updated = started
+
+                self.take_sample(profile, me, names)
+
+                cost = time.time() - started
+                profile.sample_time += cost
+
+                # Sleep long enough that sampling stays under max_overhead
+                wait = max(profile.interval, cost / self.max_overhead - cost)
+        finally:
+            profile.finished = time.time()
+
+    def take_sample(self, profile, me, names):
+        frames = sys._current_frames()
+        frame = None
+        samples = []
+
+        for ident, frame in frames.iteritems():
+            if ident == me:
+                continue
+
+            stack = []
+
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                label = get_frame_label(code.co_filename, code.co_name)
+
+                if label not in profile.blame:
+                    profile.blame[label] = get_module_name(code.co_filename)
+
+                stack.append(label)
+                frame = frame.f_back
+
+            stack.reverse()
+            samples.append(
+                ((names.get(ident, "Thread %s" % ident), tuple(stack)))
+            )
+
+        del frames, frame  # Don't keep the frames alive
+
+        with profile.lock:
+            profile.samples += 1
+
+            for key in samples:
+                if key in profile.stacks:
+                    profile.stacks[key] += 1
+                elif len(profile.stacks) < MAX_STACKS:
+                    profile.stacks[key] = 1
+                else:
+                    profile.dropped += 1
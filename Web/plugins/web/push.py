@@ -0,0 +1,391 @@
+"""
+Live updates for the admin pages, pushed with Server-Sent Events.
+
+Clients subscribe to any number of stats series, and to the log. Once per
+tick, the hub reads the latest point of each series that has subscribers
+and the log lines added since the last tick, encodes each of those once,
+and writes the same frames to every subscriber that wants them - so fifty
+open dashboards cost one read and fifty writes, not fifty requests.
+
+Each subscriber is registered as a producer on its connection, so we find
+out when its send buffer is full. Frames for a paused subscriber are
+dropped (it's told how many when it catches up), and a subscriber that
+stays paused for too long is disconnected.
+"""
+
+__author__ = 'Gareth Coles'
+
+import json
+import logging
+import threading
+import time
+import weakref
+
+from collections import deque
+
+from twisted.internet import task
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+#: Seconds between ticks
+DEFAULT_INTERVAL = 1.0
+
+#: How many log lines to keep
+DEFAULT_LOG_SIZE = 1000
+
+#: Seconds a subscriber may stay paused before we give up on it
+MAX_PAUSE = 30
+
+#: Seconds between keepalive comments, for proxies that time out idle
+#: connections
+KEEPALIVE_INTERVAL = 15
+
+#: Seconds between checking that subscribers still have permission
+RECHECK_INTERVAL = 60
+
+
+def make_frame(event, data, event_id=None):
+    frame = "event: %s\n" % event
+
+    if event_id is not None:
+        frame += "id: %s\n" % event_id
+
+    return frame + "data: %s\n\n" % json.dumps(data)
+
+
+class LogBuffer(logging.Handler):
+    """
+    A logging handler that keeps the last `size` records in memory, each
+    with an increasing ID. Records may come from any thread.
+    """
+
+    def __init__(self, size=DEFAULT_LOG_SIZE):
+        logging.Handler.__init__(self)
+
+        self.records = deque(maxlen=size)
+        self.last_id = 0
+        self.buffer_lock = threading.Lock()
+
+        self.loggers = set()  # Loggers we've been added to
+
+    def attach(self):
+        """
+        Add ourselves to the root logger, and to every logger that doesn't
+        propagate to it - a logger with handlers of its own may not, so we
+        can't count on every record getting to the root. Loggers created
+        later are only picked up the next time this is called.
+        """
+
+        loggers = [logging.getLogger()] + [
+            logger for logger in logging.Logger.manager.loggerDict.values()
+            if isinstance(logger, logging.Logger) and not logger.propagate
+        ]
+
+        for logger in loggers:
+            if logger not in self.loggers:
+                logger.addHandler(self)
+                self.loggers.add(logger)
+
+    def detach(self):
+        for logger in self.loggers:
+            logger.removeHandler(self)
+
+        self.loggers.clear()
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+
+            if isinstance(message, str):
+                # Anything that isn't UTF-8 would break json.dumps() later
+                message = message.decode("utf-8", "replace")
+
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "name": record.name,
+                "message": message
+            }
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self.buffer_lock:
+            self.last_id += 1
+            entry["id"] = self.last_id
+            self.records.append(entry)
+
+    def since(self, last_id):
+        """
+        Get every record with an ID after `last_id`.
+        """
+
+        with self.buffer_lock:
+            if not self.records or self.records[-1]["id"] <= last_id:
+                return []
+            return [r for r in self.records if r["id"] > last_id]
+
+
+@implementer(IPushProducer)
+class Subscriber(object):
+    """
+    One open event stream.
+    """
+
+    def __init__(self, handler, username, series, logs):
+        self.handler = handler
+        self.username = username
+        self.series = frozenset(series)
+        self.logs = logs
+
+        self.paused_since = None
+        self.dropped = 0  # Frames dropped while paused
+        self.sent = 0
+
+        transport = handler.request.connection.transport
+        transport.registerProducer(self, True)
+
+    ## IPushProducer - called by the transport
+
+    def pauseProducing(self):
+        self.paused_since = time.time()
+
+    def resumeProducing(self):
+        self.paused_since = None
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.send(make_frame("dropped", {"frames": dropped}))
+
+    def stopProducing(self):
+        self.paused_since = None
+
+    ## Hub side
+
+    def send(self, frame):
+        if self.paused_since is not None:
+            self.dropped += 1
+            return
+
+        self.handler.write(frame)
+        self.handler.flush()
+        self.sent += 1
+
+    def close(self, finish=True):
+        try:
+            self.handler.request.connection.transport.unregisterProducer()
+        except Exception:
+            pass  # Already gone
+
+        if finish and not self.handler._finished:
+            self.handler.finish()
+
+
+class PushHub(object):
+    """
+    Keeps track of subscribers, and broadcasts to them once per tick. This
+    is only used from the reactor thread.
+    """
+
+    _plugin_object = None
+
+    looping_callback = None
+
+    last_log_id = 0
+    last_keepalive = 0
+    last_recheck = 0
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.log_buffer = LogBuffer(config.get("log_lines", DEFAULT_LOG_SIZE))
+
+        self.subscribers = {}  # Handler: Subscriber
+        self.last_points = {}  # Series name: time of the last point we sent
+
+        self.ticks = 0
+        self.frames = 0  # Frames encoded
+        self.writes = 0  # Frames written, over all subscribers
+        self.kicked = 0  # Subscribers disconnected for being too slow
+
+    def start(self):
+        self.log_buffer.attach()
+        self.last_log_id = self.log_buffer.last_id
+
+        self.looping_callback = task.LoopingCall(self.tick)
+        self.looping_callback.start(self.interval, False)
+
+    def stop(self):
+        self.log_buffer.detach()
+
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+        for subscriber in self.subscribers.values():
+            subscriber.close()
+
+        self.subscribers.clear()
+
+    def subscribe(self, handler, username, series, logs, last_id=None):
+        subscriber = Subscriber(handler, username, series, logs)
+        self.subscribers[handler] = subscriber
+
+        # Send what we have now, so the page doesn't start out empty
+        for name in subscriber.series:
+            frame = self._series_frame(name)
+
+            if frame is not None:
+                subscriber.send(frame)
+
+        if logs:
+            if last_id is None:
+                last_id = 0  # Everything we have
+
+            # Anything newer goes out with the next tick
+            records = [
+                r for r in self.log_buffer.since(last_id)
+                if r["id"] <= self.last_log_id
+            ]
+
+            if records:
+                subscriber.send(self._log_frame(records))
+
+        return subscriber
+
+    def unsubscribe(self, handler, finish=True):
+        """
+        Stop sending to a handler, finishing its request unless `finish` is
+        False - when the client has already gone, for example.
+        """
+
+        subscriber = self.subscribers.pop(handler, None)
+
+        if subscriber is not None:
+            subscriber.close(finish)
+
+    def _series_frame(self, name):
+        series = self.plugin.stats.get_series(name)
+
+        if series is None or series.latest is None:
+            return None
+
+        latest = series.latest
+
+        return make_frame("metric", {
+            "series": name,
+            "x": int(round(latest[0] * 1000)),
+            "y": float("%0.2f" % latest[2])
+        })
+
+    def _log_frame(self, records):
+        return make_frame("log", records, records[-1]["id"])
+
+    def tick(self):
+        # An error here would stop the LoopingCall, and every page with it
+        try:
+            self._tick()
+        except Exception:
+            self.plugin.logger.exception("Error sending live updates")
+
+    def _tick(self):
+        self.log_buffer.attach()  # For plugins loaded since the last tick
+
+        if not self.subscribers:
+            self.last_log_id = self.log_buffer.last_id
+            return
+
+        self.ticks += 1
+        now = time.time()
+
+        self.check_subscribers(now)
+
+        frames = {}  # Series name, or None for the log: frame
+
+        # Only read the series somebody wants, and only once each
+        wanted = set()
+
+        for subscriber in self.subscribers.itervalues():
+            wanted.update(subscriber.series)
+
+        for name in wanted:
+            series = self.plugin.stats.get_series(name)
+
+            if series is None or series.latest is None:
+                continue
+
+            t = series.latest[0]
+
+            if self.last_points.get(name, None) == t:
+                continue  # Nothing new
+
+            self.last_points[name] = t
+            frames[name] = self._series_frame(name)
+
+        records = self.log_buffer.since(self.last_log_id)
+
+        if records:
+            self.last_log_id = records[-1]["id"]
+            frames[None] = self._log_frame(records)
+
+        keepalive = None
+
+        if now - self.last_keepalive >= KEEPALIVE_INTERVAL:
+            self.last_keepalive = now
+            keepalive = ": keepalive\n\n"
+
+        self.frames += len(frames)
+
+        for subscriber in self.subscribers.values():
+            for name in subscriber.series:
+                if name in frames:
+                    subscriber.send(frames[name])
+                    self.writes += 1
+
+            if subscriber.logs and None in frames:
+                subscriber.send(frames[None])
+                self.writes += 1
+
+            if keepalive is not None:
+                subscriber.send(keepalive)
+
+    def check_subscribers(self, now):
+        recheck = now - self.last_recheck >= RECHECK_INTERVAL
+
+        if recheck:
+            self.last_recheck = now
+
+        for handler, subscriber in self.subscribers.items():
+            if subscriber.paused_since is not None and \
+                    now - subscriber.paused_since > MAX_PAUSE:
+                self.plugin.logger.debug(
+                    "Disconnecting slow push subscriber: %s"
+                    % subscriber.username
+                )
+                self.kicked += 1
+                self.unsubscribe(handler)
+            elif recheck and not self.plugin.check_permission(
+                    "web.admin", subscriber.username):
+                self.unsubscribe(handler)
+
+    def get_stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "paused": len([
+                s for s in self.subscribers.itervalues()
+                if s.paused_since is not None
+            ]),
+            "ticks": self.ticks,
+            "frames": self.frames,
+            "writes": self.writes,
+            "kicked": self.kicked,
+            "log_lines": len(self.log_buffer.records)
+        }
@@ -0,0 +1,271 @@
+"""
+Rate limiting for API routes.
+
+Every API request takes a token from a bucket for its API key (if the key
+exists), and another from a bucket for the address it came from. Buckets
+refill at a steady rate, up to a maximum (the burst size), and requests
+that find a bucket empty are turned away with a 429 before the route gets
+to run.
+
+Limits can be set for all API routes, and overridden for specific routes,
+in the "rate_limits" section of web.yml.
+"""
+
+__author__ = 'Gareth Coles'
+
+import re
+import time
+import weakref
+
+from collections import OrderedDict
+
+from twisted.internet import task
+
+from plugins.web.access_log import API_PATH
+from plugins.web.apikeys import hash_key
+
+#: Seconds between throwing away buckets that have filled back up
+PRUNE_INTERVAL = 60
+
+#: Most buckets to keep - past this, the least recently used are thrown away
+MAX_BUCKETS = 10000
+
+DEFAULT_LIMITS = {
+    "per_key": {"rate": 2, "burst": 20},
+    "per_ip": {"rate": 5, "burst": 50}
+}
+
+
+class TokenBucket(object):
+    """
+    A bucket of `burst` tokens, refilled at `rate` tokens per second.
+    """
+
+    __slots__ = ["rate", "burst", "tokens", "updated", "limited"]
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now if now is not None else time.time()
+        self.limited = 0  # Requests turned away by this bucket
+
+    def update(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait(self, now):
+        """
+        Seconds until a token is available, or 0 if one is available now.
+        """
+
+        self.update(now)
+
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.update(now)
+        return self.tokens >= self.burst
+
+
+class Rule(object):
+    """
+    The limits for a set of routes.
+    """
+
+    def __init__(self, name, config, defaults=None):
+        if defaults is None:
+            defaults = {}
+
+        self.name = name
+        self.per_key = self._parse(config, defaults, "per_key")
+        self.per_ip = self._parse(config, defaults, "per_ip")
+
+        if name == "default":
+            self.regex = None
+        else:
+            self.regex = re.compile("^%s$" % name)
+
+    def _parse(self, config, defaults, scope):
+        limits = config.get(scope, defaults.get(scope, None))
+
+        if not limits or not limits.get("rate", 0):
+            return None  # No limit
+        return limits["rate"], limits.get("burst", limits["rate"])
+
+
+class RateLimiter(object):
+    """
+    Token buckets for API keys and addresses. This is only used from the
+    reactor thread.
+    """
+
+    _plugin_object = None
+
+    looping_callback = None
+    _sampled = 0  # Limited requests at the last stats sample
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        defaults = dict(DEFAULT_LIMITS)
+        defaults.update(config)
+
+        self.default = Rule("default", defaults)
+        self.rules = [
+            Rule(pattern, limits or {}, defaults)
+            for pattern, limits in (config.get("routes", None) or {}).items()
+        ]
+
+        # (scope, rule name, key hash or address): TokenBucket, least
+        # recently used first
+        self.buckets = OrderedDict()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def start(self):
+        self.plugin.stats.register_series(
+            "rate_limited_requests", self.sample_limited, "requests",
+            "API requests turned away by the rate limiter"
+        )
+
+        self.looping_callback = task.LoopingCall(self.prune)
+        self.looping_callback.start(PRUNE_INTERVAL, False)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+    def find_rule(self, path):
+        for rule in self.rules:
+            if rule.regex.match(path):
+                return rule
+        return self.default
+
+    def _get_bucket(self, scope, rule, identity, limits, now):
+        name = (scope, rule.name, identity)
+        bucket = self.buckets.pop(name, None)
+
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+
+            bucket = TokenBucket(limits[0], limits[1], now)
+
+        self.buckets[name] = bucket  # Most recently used, at the end
+        return bucket
+
+    def check(self, path, address):
+        """
+        Take a token for a request, returning 0 if it can go ahead, or how
+        many seconds the client should wait before trying again.
+        """
+
+        matched = API_PATH.match(path)
+
+        if matched is None:
+            return 0  # Not an API route
+
+        key, path = matched.groups()
+        rule = self.find_rule(path or "/")
+        now = time.time()
+        buckets = []
+
+        if rule.per_key is not None:
+            key_hash = hash_key(key)
+
+            # Made-up keys are turned away by the route, and only count
+            # against the address - they'd fill the table up otherwise
+            if self.plugin.api_keys.get_username_by_hash(key_hash):
+                buckets.append(self._get_bucket(
+                    "key", rule, key_hash, rule.per_key, now
+                ))
+
+        if rule.per_ip is not None:
+            buckets.append(self._get_bucket(
+                "ip", rule, address, rule.per_ip, now
+            ))
+
+        wait = 0
+
+        for bucket in buckets:
+            bucket_wait = bucket.wait(now)
+
+            if bucket_wait:
+                bucket.limited += 1
+                wait = max(wait, bucket_wait)
+
+        if wait:
+            self.limited += 1
+            return wait
+
+        for bucket in buckets:
+            bucket.take()
+
+        self.allowed += 1
+        return 0
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+
+        # A full bucket is no different from a new one
+        self.buckets = OrderedDict(
+            (identity, bucket) for identity, bucket in self.buckets.iteritems()
+            if not bucket.is_full(now)
+        )
+
+    def sample_limited(self):
+        limited, self._sampled = self.limited - self._sampled, self.limited
+        return limited
+
+    def get_stats(self):
+        now = time.time()
+        buckets = []
+
+        for (scope, rule, identity), bucket in self.buckets.iteritems():
+            bucket.update(now)
+
+            entry = {
+                "scope": scope,
+                "rule": rule,
+                "tokens": round(bucket.tokens, 2),
+                "burst": bucket.burst,
+                "rate": bucket.rate,
+                "limited": bucket.limited
+            }
+
+            if scope == "key":
+                # Never expose the key itself
+                entry["key"] = identity[:12]
+                entry["username"] = self.plugin.api_keys.get_username_by_hash(
+                    identity
+                )
+            else:
+                entry["address"] = identity
+
+            buckets.append(entry)
+
+        buckets.sort(key=lambda b: b["tokens"])
+
+        return {
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "buckets": buckets
+        }
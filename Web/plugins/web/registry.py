@@ -0,0 +1,608 @@
+"""
+A registry of counters, gauges and histograms, served at /metrics in the
+Prometheus text exposition format.
+
+Plugins can register their own metrics with `plugin.metrics` - see
+DEVELOPMENT.md. Most of the Web plugin's own numbers are already kept
+somewhere else (the access log's latency histograms, the lag monitor and so
+on), so rather than counting everything twice, they're read when the
+metrics are scraped, by collectors.
+"""
+
+__author__ = 'Gareth Coles'
+
+import binascii
+import re
+import socket
+import threading
+import weakref
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from plugins.web.access_log import LATENCY_BUCKETS
+
+#: Default histogram buckets, in seconds
+DEFAULT_BUCKETS = tuple(b / 1000.0 for b in LATENCY_BUCKETS)
+
+METRIC_NAME = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+LABEL_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    elif value == float("-inf"):
+        return "-Inf"
+    elif value != value:
+        return "NaN"
+    elif isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def escape_label(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(
+        u"\n", u"\\n"
+    ).replace(u'"', u'\\"')
+
+
+def escape_help(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return u""
+
+    return u"{%s}" % u",".join(
+        u'%s="%s"' % (name, escape_label(value)) for name, value in labels
+    )
+
+
+class Metric(object):
+    """
+    Base class for metrics. Metrics with label names keep a child per set of
+    label values - use `labels()` to get one.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, description="", label_names=()):
+        if not METRIC_NAME.match(name):
+            raise ValueError("Invalid metric name: %s" % name)
+
+        for label in label_names:
+            if not LABEL_NAME.match(label) or label.startswith("__"):
+                raise ValueError("Invalid label name: %s" % label)
+
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+
+        self.lock = threading.Lock()
+        self.children = {}  # Label values: child
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.label_names)
+
+        if len(values) != len(self.label_names):
+            raise ValueError(
+                "Expected labels %s, got %s" % (self.label_names, values)
+            )
+
+        values = tuple(unicode(v) for v in values)
+
+        with self.lock:
+            child = self.children.get(values, None)
+
+            if child is None:
+                child = self.children[values] = self._new_child()
+
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _unlabelled(self):
+        if self.label_names:
+            raise ValueError("%s has labels, use labels()" % self.name)
+        return self.labels()
+
+    def collect(self):
+        """
+        Get a list of (suffix, labels, value) samples.
+        """
+
+        samples = []
+
+        with self.lock:
+            children = self.children.items()
+
+        for values, child in sorted(children):
+            labels = zip(self.label_names, values)
+
+            for suffix, extra, value in child.samples():
+                samples.append((suffix, labels + extra, value))
+
+        return samples
+
+
+class _Value(object):
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [("", [], self.value)]
+
+
+class _GaugeValue(_Value):
+
+    func = None
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = float(value)
+
+    def set_function(self, func):
+        """
+        Call `func` to get the value whenever we're scraped.
+        """
+
+        self.func = func
+
+    def samples(self):
+        if self.func is not None:
+            return [("", [], self.func())]
+        return [("", [], self.value)]
+
+
+class _HistogramValue(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        return histogram_samples(self.buckets, counts, total, count)
+
+
+def histogram_samples(buckets, counts, total, count):
+    """
+    Samples for a histogram, given the number of values that fell in each
+    bucket (not the running totals) - anything above the last bucket is
+    worked out from `count`.
+    """
+
+    samples = []
+    seen = 0
+
+    for bound, n in zip(buckets, counts):
+        seen += n
+        samples.append(("_bucket", [("le", format_value(bound))], seen))
+
+    samples.append(("_bucket", [("le", "+Inf")], count))
+    samples.append(("_sum", [], total))
+    samples.append(("_count", [], count))
+
+    return samples
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only go up")
+        self._unlabelled().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, or is worked out when we're scraped.
+    """
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled().dec(amount)
+
+    def set(self, value):
+        self._unlabelled().set(value)
+
+    def set_function(self, func):
+        self._unlabelled().set_function(func)
+
+
+class Histogram(Metric):
+    """
+    Counts of values falling under each of a fixed set of bounds, with
+    their total - for latencies and sizes.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description="", label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        if "le" in label_names:
+            raise ValueError("Histograms can't have an 'le' label")
+
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super(Histogram, self).__init__(name, description, label_names)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled().observe(value)
+
+
+class MetricsRegistry(object):
+    """
+    Named metrics and collectors.
+
+    A collector is a function returning a list of (name, type, description,
+    samples) tuples, where samples are (suffix, labels, value) - labels being
+    a list of (name, value) pairs. Collectors are called on the reactor
+    thread, so they can read anything the reactor owns.
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.collectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _register(self, cls, name, description, label_names, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+
+            if metric is not None:
+                if not isinstance(metric, cls):
+                    raise ValueError(
+                        "%s is already registered as a %s"
+                        % (name, metric.type)
+                    )
+                return metric  # Keep the values over a plugin reload
+
+            if name in self.collectors:
+                raise ValueError("%s is already registered" % name)
+
+            metric = cls(name, description, label_names, **kwargs)
+            self.metrics[name] = metric
+
+        return metric
+
+    def counter(self, name, description="", label_names=()):
+        return self._register(Counter, name, description, label_names)
+
+    def gauge(self, name, description="", label_names=()):
+        return self._register(Gauge, name, description, label_names)
+
+    def histogram(self, name, description="", label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram, name, description, label_names, buckets=buckets
+        )
+
+    def unregister(self, name):
+        with self.lock:
+            if name in self.metrics:
+                del self.metrics[name]
+                return True
+            return False
+
+    def add_collector(self, name, func):
+        with self.lock:
+            self.collectors[name] = func
+
+    def remove_collector(self, name):
+        with self.lock:
+            return self.collectors.pop(name, None) is not None
+
+    def collect(self):
+        with self.lock:
+            metrics = self.metrics.values()
+            collectors = self.collectors.values()
+
+        families = [
+            (m.name, m.type, m.description, m.collect()) for m in metrics
+        ]
+
+        for collector in collectors:
+            families.extend(collector())
+
+        return families
+
+    def render(self):
+        """
+        Everything, in the Prometheus text exposition format.
+        """
+
+        lines = []
+
+        for name, _type, description, samples in self.collect():
+            if description:
+                lines.append(
+                    u"# HELP %s %s" % (name, escape_help(description))
+                )
+            lines.append(u"# TYPE %s %s" % (name, _type))
+
+            for suffix, labels, value in samples:
+                lines.append(u"%s%s%s %s" % (
+                    name, suffix, format_labels(labels), format_value(value)
+                ))
+
+        lines.append(u"")
+        return u"\n".join(lines).encode("utf-8")
+
+
+## Checking addresses against the allow-list
+
+def _parse_address(address):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return family, int(binascii.hexlify(packed), 16), len(packed) * 8
+    return None
+
+
+class AddressList(object):
+    """
+    Addresses and networks, like "127.0.0.1" or "10.0.0.0/8".
+    """
+
+    def __init__(self, networks):
+        self.networks = []
+
+        for network in networks:
+            address, _, prefix = network.partition("/")
+            parsed = _parse_address(address.strip())
+
+            if parsed is None:
+                raise ValueError("Invalid address: %s" % network)
+
+            family, value, bits = parsed
+            prefix = int(prefix) if prefix else bits
+            mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+
+            self.networks.append((family, value & mask, mask))
+
+    def __contains__(self, address):
+        parsed = _parse_address(address)
+
+        if parsed is None:
+            return False
+
+        family, value, _ = parsed
+
+        for net_family, network, mask in self.networks:
+            if family == net_family and value & mask == network:
+                return True
+        return False
+
+
+## The Web plugin's own numbers
+
+class WebCollector(object):
+    """
+    Reads the Web plugin's numbers from wherever they're kept.
+    """
+
+    _plugin_object = None
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin):
+        self._plugin_object = weakref.ref(plugin)
+
+    def __call__(self):
+        plugin = self.plugin
+        families = []
+
+        families.extend(self.collect_requests(plugin.access_log))
+
+        if plugin.lag_monitor is not None:
+            families.extend(self.collect_lag(plugin.lag_monitor))
+
+        families.extend(self.collect_threadpool(reactor.getThreadPool()))
+
+        if plugin.render_pool is not None:
+            families.extend(self.collect_render_pool(plugin.render_pool))
+
+        families.append((
+            "ultros_web_sessions", "gauge", "Open sessions",
+            [("", [], plugin.sessions.count())]
+        ))
+        families.extend(self.collect_api_keys(plugin.api_keys))
+
+        if plugin.rate_limiter is not None:
+            families.append((
+                "ultros_web_rate_limited_requests_total", "counter",
+                "API requests turned away by the rate limiter",
+                [("", [], plugin.rate_limiter.limited)]
+            ))
+
+        families.extend(self.collect_cache(
+            "ultros_web_permission_cache", plugin.permission_cache
+        ))
+
+        if plugin.response_cache is not None:
+            families.extend(self.collect_cache(
+                "ultros_web_response_cache", plugin.response_cache
+            ))
+
+        if plugin.push_hub is not None:
+            families.append((
+                "ultros_web_push_subscribers", "gauge",
+                "Open live update streams",
+                [("", [], len(plugin.push_hub.subscribers))]
+            ))
+
+        families.append(self.collect_series(plugin.stats))
+
+        return families
+
+    def collect_requests(self, access_log):
+        counts = []
+        latencies = []
+
+        for route, histogram in sorted(access_log.histograms.items()):
+            labels = [("route", route)]
+            counts.append(("", labels, histogram.count))
+
+            for suffix, extra, value in histogram_samples(
+                    DEFAULT_BUCKETS, histogram.buckets, histogram.total / 1000,
+                    histogram.count):
+                latencies.append((suffix, labels + extra, value))
+
+        counters = access_log.counters
+
+        return [
+            ("ultros_web_requests_total", "counter",
+             "Requests handled, by route", counts),
+            ("ultros_web_request_duration_seconds", "histogram",
+             "Time taken to handle requests, by route", latencies),
+            ("ultros_web_access_log_dropped_total", "counter",
+             "Access log records dropped because the queue was full",
+             [("", [], counters["dropped"])]),
+            ("ultros_web_access_log_queue_depth", "gauge",
+             "Access log records waiting to be written",
+             [("", [], access_log.queue.qsize())])
+        ]
+
+    def collect_lag(self, monitor):
+        series = self.plugin.stats.get_series("reactor_lag")
+        latest = series.latest if series is not None else None
+
+        families = [
+            ("ultros_reactor_late_beats_total", "counter",
+             "Reactor heartbeats later than the lag threshold",
+             [("", [], monitor.counters["late_beats"])]),
+            ("ultros_reactor_stalls_total", "counter",
+             "Reactor stalls caught by the watchdog",
+             [("", [], monitor.counters["stalls"])])
+        ]
+
+        if latest is not None:
+            families.append((
+                "ultros_reactor_lag_seconds", "gauge",
+                "Largest reactor lag in the last stats sample",
+                [("", [], latest[2] / 1000)]
+            ))
+
+        return families
+
+    def collect_render_pool(self, pool):
+        stats = pool.get_stats()
+
+        return [
+            ("ultros_web_render_queue_depth", "gauge",
+             "Render jobs waiting for a thread",
+             [("", [], stats["queued"])]),
+            ("ultros_web_render_running", "gauge",
+             "Render jobs running", [("", [], stats["running"])]),
+            ("ultros_web_render_jobs_total", "counter",
+             "Render jobs finished, by result",
+             [("", [("result", "success")],
+               stats["completed"] - stats["failed"]),
+              ("", [("result", "failure")], stats["failed"])]),
+            ("ultros_web_render_duration_seconds", "histogram",
+             "Time taken by render jobs",
+             histogram_samples(
+                 DEFAULT_BUCKETS, pool.run_times.buckets,
+                 pool.run_times.total / 1000, pool.run_times.count
+             ))
+        ]
+
+    def collect_api_keys(self, api_keys):
+        # Not broken down by key or user, as that would tell anyone who can
+        # scrape us who has keys and which ones they are
+        return [
+            ("ultros_web_api_keys", "gauge", "API keys",
+             [("", [], len(api_keys.keys))]),
+            ("ultros_web_api_key_uses_total", "counter",
+             "API requests made with a valid key", [("", [], api_keys.uses)])
+        ]
+
+    def collect_threadpool(self, pool):
+        return [
+            ("ultros_reactor_threadpool_queue_depth", "gauge",
+             "Calls waiting for a thread in the reactor's threadpool",
+             [("", [], pool.q.qsize())]),
+            ("ultros_reactor_threadpool_threads", "gauge",
+             "Threads in the reactor's threadpool, by state",
+             [("", [("state", "busy")], len(pool.working)),
+              ("", [("state", "idle")], len(pool.waiters))]),
+            ("ultros_reactor_threadpool_max_threads", "gauge",
+             "Most threads the reactor's threadpool may start",
+             [("", [], pool.max)])
+        ]
+
+    def collect_cache(self, name, cache):
+        return [
+            (name + "_hits_total", "counter", "Cache hits",
+             [("", [], cache.hits)]),
+            (name + "_misses_total", "counter", "Cache misses",
+             [("", [], cache.misses)])
+        ]
+
+    def collect_series(self, stats):
+        samples = []
+
+        for name, series in stats.series.items():
+            latest = series.latest
+
+            if latest is not None:
+                samples.append((
+                    "", [("series", name), ("unit", series.unit)], latest[2]
+                ))
+
+        return (
+            "ultros_stats_latest", "gauge",
+            "Latest value of each statistics series", samples
+        )
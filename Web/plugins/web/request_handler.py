@@ -1,5 +1,6 @@
 __author__ = 'Gareth Coles'
 
+import math
 import traceback
 
 from cyclone.web import RequestHandler as Handler
@@ -7,8 +8,30 @@ from cyclone import escape
 
 import json
 
+from twisted.internet import defer
 from twisted.python.failure import Failure
 
+from plugins.web.response_cache import USERNAME_MARKER
+
+
+def get_client_address(request, trusted_proxies):
+    """
+    The address a request came from. Cyclone takes remote_ip from the
+    X-Real-Ip or X-Forwarded-For header, which any client can send, so
+    that's only believed when it was set by a proxy we trust.
+    """
+
+    transport = getattr(request.connection, "transport", None)
+
+    if transport is None:  # Part of a batch, given the batch's address
+        return request.remote_ip
+
+    peer = getattr(transport.getPeer(), "host", None)
+
+    if peer is None or peer in trusted_proxies:
+        return request.remote_ip
+    return peer
+
 
 class RequestHandler(Handler):
 
@@ -21,6 +44,26 @@ class RequestHandler(Handler):
     #: :type: list
     js = None
 
+    _session_key = None
+    _session_object = None
+    _session_resolved = False  # So we only look the session up once
+
+    ## Response caching - see finish_cached()
+
+    #: Seconds to cache this route's pages for, or None to not cache them
+    cache_ttl = None
+
+    #: Permissions that change what this route's pages look like
+    cache_permissions = []
+
+    #: Query arguments that change what this route's pages look like
+    cache_args = []
+
+    #: Things that, when they change, should clear this route's pages
+    cache_tags = []
+
+    _cache_key = None  # Set when the page we're rendering should be cached
+
     def __init__(self, *args, **kwargs):
         self.css = ["/static/custom.css"]
         self.js = []
@@ -43,27 +86,125 @@ class RequestHandler(Handler):
         if path not in self.js:
             self.js.append(path)
 
+    def get_client_address(self):
+        return get_client_address(self.request, self.plugin.trusted_proxies)
+
     def clear_session(self):
         self.set_secure_cookie("auth", "")
+        self._session_resolved = False
 
     def create_template_loader(self, _=None):  # No alternate template paths
         return self.application.settings["template_loader"]
 
+    def finish_cached(self):
+        """
+        Send a cached copy of this page, if there is one, returning True if
+        we did. Otherwise, the page rendered by the next render() call is
+        cached for the next request.
+        """
+
+        cache = self.plugin.response_cache
+
+        if cache is None or self.cache_ttl is None:
+            return False
+
+        if self.request.method != "GET" or self.get_argument("msg", None):
+            return False  # Messages are one-offs
+
+        key = self.get_cache_key()
+        body = cache.get(key)
+
+        if body is None:
+            self._cache_key = key
+            return False
+
+        self.finish(self._personalise(body))
+        return True
+
     def finish_json(self, _dict):
         self.set_header("Content-Type", "application/json")
         return self.finish(json.dumps(_dict, sort_keys=True))
 
+    def finish_json_async(self, _dict):
+        """
+        Like finish_json(), but the JSON is encoded in the render pool.
+        Return the Deferred from your route, and don't change the dict
+        until it fires.
+        """
+
+        pool = self.plugin.render_pool
+
+        if pool is None:
+            return defer.succeed(self.finish_json(_dict))
+
+        d = pool.run(json.dumps, _dict, sort_keys=True)
+        d.addCallback(self._finish_encoded)
+
+        return d
+
+    def _finish_encoded(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.finish(data)
+
+    def get_cache_key(self):
+        """
+        The key this page is cached under. Routes can extend this if their
+        pages depend on anything else.
+        """
+
+        s = self.get_session_object()
+
+        return (
+            self.__class__.__module__,
+            self.request.path,
+            tuple(self.get_argument(arg, None) for arg in self.cache_args),
+            tuple(
+                self.plugin.check_permission(perm, s)
+                for perm in self.cache_permissions
+            ),
+            s is not None
+        )
+
     def get_session_key(self):
-        return self.get_secure_cookie("session", max_age_days=9999999) or None
+        if not self._session_resolved:
+            self._resolve_session()
+        return self._session_key
 
     def get_session_object(self):
-        cookie = self.get_session_key()
+        if not self._session_resolved:
+            self._resolve_session()
+        return self._session_object
 
-        if cookie is not None:
-            return self.sessions.get_session(cookie)
-        return None
+    def _resolve_session(self):
+        # The session is needed by prepare(), the route and the templates,
+        # so it's only looked up once per request
+        key = self.get_secure_cookie("session", max_age_days=9999999) or None
+
+        self._session_key = key
+        self._session_object = self.sessions.get_session(key)
+        self._session_resolved = True
 
     def prepare(self):
+        if getattr(self.request, "batch", None) is not None:
+            # Part of a batch, which has already been through all this
+            return
+
+        limiter = self.plugin.rate_limiter
+
+        if limiter is not None:
+            wait = limiter.check(self.request.path, self.get_client_address())
+
+            if wait:
+                retry_after = int(math.ceil(wait))
+
+                self.set_status(429, "Too Many Requests")  # Not in httplib
+                self.set_header("Retry-After", retry_after)
+
+                return self.finish_json({
+                    "error": "Too many requests.",
+                    "retry_after": retry_after
+                })
+
         self.plugin.logger.trace("XSRF token: %s" % self.xsrf_token)
 
         s = self.get_session_object()
@@ -94,10 +235,51 @@ class RequestHandler(Handler):
 
         super(RequestHandler, self).redirect(url, permanent, status)
 
+    def _personalise(self, body):
+        s = self.get_session_object()
+
+        if s is None:
+            return body
+        return body.replace(USERNAME_MARKER, s["username"])
+
     def render(self, template_name, **kwargs):
-        self.finish(self.render_string(template_name, **kwargs))
+        self._finish_rendered(self.render_string(template_name, **kwargs))
+
+    def render_async(self, template_name, **kwargs):
+        """
+        Like render(), but the template is rendered in the render pool.
+        Return the Deferred from your route. Anything the template uses
+        will be read from another thread, so don't pass in things the
+        reactor might be changing.
+        """
+
+        pool = self.plugin.render_pool
+
+        if pool is None:
+            return defer.succeed(self.render(template_name, **kwargs))
+
+        template, namespace = self._get_template(template_name, kwargs)
+        self.xsrf_token  # May set a cookie, which we can't do from a thread
+
+        d = pool.run(template.render, **namespace)
+        d.addCallback(self._finish_rendered)
+
+        return d
+
+    def _finish_rendered(self, body):
+        if self._cache_key is not None:
+            self.plugin.response_cache.set(
+                self._cache_key, body, self.cache_ttl, self.cache_tags
+            )
+            body = self._personalise(body)
+
+        self.finish(body)
 
     def render_string(self, template_name, **kwargs):
+        template, namespace = self._get_template(template_name, kwargs)
+        return template.render(**namespace)
+
+    def _get_template(self, template_name, kwargs):
         loader = self.create_template_loader()
 
         namespace = self.get_template_namespace()
@@ -105,23 +287,40 @@ class RequestHandler(Handler):
         namespace.update(kwargs)
         namespace.update(loader.plugin.namespace)
 
-        namespace["extra_css"] = self.css
-        namespace["extra_js"] = self.js
+        # Fingerprint anything that's in web/static, so it can be cached
+        assets = self.plugin.static_assets
+        namespace["extra_css"] = [assets.url(url) for url in self.css]
+        namespace["extra_js"] = [assets.url(url) for url in self.js]
         namespace["headers"] = kwargs.get("headers", [])
         namespace["nav_items"] = self.plugin.navbar_items
         namespace["nav_name"] = self.name
         namespace["session"] = self.get_session_object()
+
+        if self._cache_key is not None and namespace["session"]:
+            # Cached pages are shared, so leave a gap for the username
+            namespace["session"] = dict(
+                namespace["session"], username=USERNAME_MARKER
+            )
+
         namespace["sessions"] = self.sessions
         namespace["xsrf"] = self.xsrf_form_html
 
         namespace["_message"] = self.get_argument("msg", None)
         namespace["_message_type"] = self.get_argument("col", "green")
 
-        template = loader.load(template_name)
-        return template.render(**namespace)
+        return loader.load(template_name), namespace
 
     def set_session(self, key, remember=False):
-        self.set_secure_cookie("session", key, 30 if not remember else 9999999)
+        # Cyclone works out the expiry date, so this can't be much further
+        # away than it is, or it won't fit in a datetime
+        self.set_secure_cookie("session", key, 30 if not remember else 3650)
+
+        if not self._session_resolved or key != self._session_key:
+            # A new session, from logging in - prepare() just sets the same
+            # one again, which we've already looked up
+            self._session_key = key
+            self._session_object = self.sessions.get_session(key)
+            self._session_resolved = True
 
     def write_error(self, status_code, **kwargs):
         tb = ""
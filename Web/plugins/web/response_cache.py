@@ -0,0 +1,100 @@
+"""
+A cache of rendered pages.
+
+Routes opt in by setting `cache_ttl`, and calling `finish_cached()` before
+doing any expensive work. Pages are cached by route, path, the query
+arguments and permissions the route says matter, and whether the user is
+logged in - so every user with the same permissions shares the same cached
+page. The username is put back in when the page is sent.
+
+Entries are dropped when they expire, or when something they're tagged with
+changes - plugins being loaded or unloaded, for example.
+"""
+
+__author__ = 'Gareth Coles'
+
+import time
+import uuid
+
+from collections import OrderedDict
+
+#: How many pages to keep
+DEFAULT_SIZE = 256
+
+#: Stands in for the username in cached pages
+USERNAME_MARKER = "web-cache-username-%s" % uuid.uuid4().hex
+
+
+class ResponseCache(object):
+    """
+    Rendered pages, least recently used first. This is only used from the
+    reactor thread.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.entries = OrderedDict()  # Key: (body, expires, tags)
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is None or entry[1] <= time.time():
+            self.misses += 1
+            return None
+
+        self.entries[key] = entry  # Most recently used
+        self.hits += 1
+
+        return entry[0]
+
+    def set(self, key, body, ttl, tags=None):
+        self.entries.pop(key, None)
+        self.entries[key] = (body, time.time() + ttl, frozenset(tags or []))
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *tags):
+        """
+        Drop every page tagged with any of the given tags.
+        """
+
+        tags = set(tags)
+        keys = [
+            key for key, entry in self.entries.iteritems()
+            if entry[2] & tags
+        ]
+
+        for key in keys:
+            del self.entries[key]
+
+        if keys:
+            self.invalidations += 1
+
+        return len(keys)
+
+    def clear(self):
+        if self.entries:
+            self.invalidations += 1
+        self.entries.clear()
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+
+        if not total:
+            return 0.0
+        return self.hits * 100.0 / total
+
+    def get_stats(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.get_hit_rate(),
+            "invalidations": self.invalidations
+        }
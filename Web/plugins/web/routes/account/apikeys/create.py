@@ -34,5 +34,6 @@ class Route(RequestHandler):
             else:
                 self.redirect(
                     "/account",
-                    message="API key created: %s" % key
+                    message="API key created: %s - make a note of it now, "
+                            "as it won't be shown again." % key
                 )
@@ -23,6 +23,7 @@ class Route(RequestHandler):
                 redirect="/account"
             )
         else:
+            # The account page only knows the hash of each key
             key = self.get_argument("key", default=None)
 
             if key is None:
@@ -32,14 +33,14 @@ class Route(RequestHandler):
                     message_colour="red"
                 )
             else:
-                if not self.plugin.api_keys.is_owner(s["username"], key):
+                if not self.plugin.api_keys.owns_hash(s["username"], key):
                     self.redirect(
                         "/account",
                         message="Missing or invalid API key.",
                         message_colour="red"
                     )
                 else:
-                    if self.plugin.api_keys.delete_key(key):
+                    if self.plugin.api_keys.delete_hash(key):
                         self.redirect(
                             "/account",
                             message="API key removed successfully."
@@ -1,10 +1,13 @@
 """
 Admin file page - /admin/file/<file>
+
+The file itself is loaded and saved a page at a time, through
+/api/admin/files/<type>/<file>.
 """
 
 __author__ = 'Gareth Coles'
 
-from plugins.web.decorators import check_xsrf
+from plugins.web.file_view import find_file
 from plugins.web.request_handler import RequestHandler
 
 
@@ -44,111 +47,12 @@ class Route(RequestHandler):
                 content=content
             )
         else:
-            files = {
-                "config": self.plugin.storage.config_files,
-                "data": self.plugin.storage.data_files
-            }
-
-            filetype = filetype.lower()
-
-            if filetype not in files:
-                return self.redirect(
-                    "/admin/files",
-                    message="Unknown filetype: %s" % filetype,
-                    message_colour="red"
-                )
-
-            files = files[filetype]
-
-            if filename not in files:
-                return self.redirect(
-                    "/admin/files",
-                    message="This file cannot be found. Is it loaded?",
-                    message_colour="red"
-                )
-
-            fh = files[filename].get()
-
-            if fh.representation is None:
-                return self.redirect(
-                    "/admin/files",
-                    message="This file cannot be viewed or edited.",
-                    message_colour="red"
-                )
-
-            representation = fh.representation
-
-            if representation == "json":
-                representation = "javascript"
-
-            return self.render(
-                "admin/file.html",
-                content=fh.read()[1].rstrip("\n").rstrip("\r"),
-                filename=filename,
-                mode=representation,
-                error=False,
-                filetype=filetype,
-                success=False
-            )
-
-    @check_xsrf
-    def post(self, filetype, filename):
-        s = self.get_session_object()
-
-        if s is None:
-            self.redirect(
-                "/login",
-                message="You need to login to access this.",
-                message_colour="red",
-                redirect="/admin/file/%s/%s" % (filetype, filename)
-            )
-        elif not self.plugin.check_permission("web.admin", s):
-            content = """
-<div class="ui red fluid message">
-    <p>You do not have permission to access the admin section.</p>
-    <p> If you feel this was in error, tell a bot admin to give you the
-        <code>web.admin</code> permission.
-    </p>
-</div>
-            """
-
-            self.render(
-                "generic.html",
-                _title="Admin | No permission",
-                content=content
-            )
-        else:
-            content = self.get_argument("content", default=None)
-
-            files = {
-                "config": self.plugin.storage.config_files,
-                "data": self.plugin.storage.data_files
-            }
+            fh, _, error = find_file(self.plugin, filetype, filename)
 
-            filetype = filetype.lower()
-
-            if filetype not in files:
+            if error is not None:
                 return self.redirect(
                     "/admin/files",
-                    message="Unknown filetype: %s" % filetype,
-                    message_colour="red"
-                )
-
-            files = files[filetype]
-
-            if filename not in files:
-                return self.redirect(
-                    "/admin/files",
-                    message="This file cannot be found. Is it loaded?",
-                    message_colour="red"
-                )
-
-            fh = files[filename].get()
-
-            if fh.representation is None:
-                return self.redirect(
-                    "/admin/files",
-                    message="This file cannot be viewed or edited.",
+                    message=error,
                     message_colour="red"
                 )
 
@@ -157,42 +61,9 @@ class Route(RequestHandler):
             if representation == "json":
                 representation = "javascript"
 
-            if content is None:
-                return self.render(
-                    "admin/file.html",
-                    content=fh.read()[1].rstrip("\n").rstrip("\r"),
-                    filename=filename,
-                    mode=representation,
-                    error="Missing 'content' parameter.",
-                    filetype=filetype,
-                    success=False
-                )
-
-            result = fh.validate(content)
-            error = False
-
-            if result[0] is False:
-                error = result[1]
-            elif isinstance(result[0], list):
-                error = []
-
-                for element in result:
-                    error.append("Line %s: %s" % tuple(element))
-
-                error = "<br />\n".join(error)
-
-            if error is False:
-                result = fh.write(content)
-
-                if not result:
-                    error = "Unable to write file."
-
             return self.render(
                 "admin/file.html",
-                content=content.rstrip("\n").rstrip("\r"),
                 filename=filename,
                 mode=representation,
-                error=error,
-                filetype=filetype,
-                success=(True if not error else False)
+                filetype=filetype.lower()
             )
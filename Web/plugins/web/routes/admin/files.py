@@ -13,6 +13,17 @@ class Route(RequestHandler):
 
     name = "admin"
 
+    cache_ttl = 60
+    cache_tags = ["storage"]
+
+    def get_cache_key(self):
+        storage = self.plugin.storage
+
+        # Files can come and go without an event, so count them too
+        return super(Route, self).get_cache_key() + (
+            len(storage.config_files), len(storage.data_files)
+        )
+
     def get(self, *args, **kwargs):
         s = self.get_session_object()
 
@@ -38,7 +49,7 @@ class Route(RequestHandler):
                 _title="Admin | No permission",
                 content=content
             )
-        else:
+        elif not self.finish_cached():
             storage = self.plugin.storage
 
             file_objs = OrderedDict()
@@ -0,0 +1,151 @@
+"""
+Admin object census page - /admin/heap
+"""
+
+__author__ = 'Gareth Coles'
+
+from plugins.web.decorators import check_xsrf
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = "admin"
+
+    def check_access(self):
+        s = self.get_session_object()
+
+        if s is None:
+            self.redirect(
+                "/login",
+                message="You need to login to access this.",
+                message_colour="red",
+                redirect="/admin/heap"
+            )
+            return False
+        elif not self.plugin.check_permission("web.admin", s):
+            content = """
+<div class="ui red fluid message">
+    <p>You do not have permission to access the admin section.</p>
+    <p> If you feel this was in error, tell a bot admin to give you the
+        <code>web.admin</code> permission.
+    </p>
+</div>
+            """
+
+            self.render(
+                "generic.html",
+                _title="Admin | No permission",
+                content=content
+            )
+            return False
+        return True
+
+    def get_snapshot_argument(self, name):
+        try:
+            snapshot_id = int(self.get_argument(name, 0) or 0)
+        except ValueError:
+            return None
+
+        if not snapshot_id:
+            return None
+        return self.plugin.heap_census.get_snapshot(snapshot_id)
+
+    def get(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        census = self.plugin.heap_census
+
+        if census is None:
+            return self.render(
+                "admin/heap.html",
+                census=None,
+                snapshots=[],
+                current=None,
+                base=None,
+                types=[],
+                owners=[],
+                referrers=None
+            )
+
+        snapshots = list(census.snapshots)
+
+        # Compare the newest snapshot with the oldest, unless told otherwise
+        current = self.get_snapshot_argument("snapshot")
+        base = self.get_snapshot_argument("base")
+
+        if current is None and snapshots:
+            current = snapshots[-1]
+
+        if base is None and len(snapshots) > 1 and \
+                snapshots[0] is not current:
+            base = snapshots[0]
+
+        try:
+            count = int(self.get_argument("count", 50) or 50)
+        except ValueError:
+            count = 50
+
+        types = []
+        owners = []
+
+        if current is not None:
+            if base is not None:
+                types = current.diff(base, "types", count)
+                owners = current.diff(base, "owners", count)
+            else:
+                types = current.top("types", count)
+                owners = current.top("owners", count)
+
+        return self.render_async(
+            "admin/heap.html",
+            census=census,
+            snapshots=[s.get_info() for s in reversed(snapshots)],
+            current=current.get_info() if current is not None else None,
+            base=base.get_info() if base is not None else None,
+            types=types,
+            owners=owners,
+            referrers=census.referrers
+        )
+
+    @check_xsrf
+    def post(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        census = self.plugin.heap_census
+
+        if census is None:
+            return self.redirect("/admin/heap")
+
+        if self.get_argument("action", "snapshot") == "referrers":
+            type_name = self.get_argument("type", "").strip()
+
+            if not type_name:
+                return self.redirect(
+                    "/admin/heap",
+                    message="Which type should we look for?",
+                    message_colour="red"
+                )
+
+            d = census.find_referrers(type_name)
+        else:
+            d = census.take_snapshot()
+
+        def done(result):
+            if result is None:  # The census has logged why
+                self.redirect(
+                    "/admin/heap",
+                    message="That didn't work - check the log for details.",
+                    message_colour="red"
+                )
+            else:
+                self.redirect("/admin/heap")
+
+            return result
+
+        # Both of these can take a few seconds
+        d.addCallback(done)
+
+        return d
@@ -53,9 +53,15 @@ class Route(RequestHandler):
                 } for v in self.plugin.stats.get_ram()
             ])
 
-            self.render(
+            # For the min/max range on the history graphs
+            self.add_js("//code.highcharts.com/highcharts-more.js")
+
+            return self.render_async(
                 "admin/index.html",
                 ram=ram,
                 cpu=cpu,
-                total_mem=self.plugin.stats.get_ram_total()
+                total_mem=self.plugin.stats.get_ram_total(),
+                permissions=self.plugin.permission_cache.get_stats(),
+                responses=(self.plugin.response_cache.get_stats()
+                           if self.plugin.response_cache is not None else None)
             )
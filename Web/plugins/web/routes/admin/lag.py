@@ -0,0 +1,74 @@
+"""
+Admin reactor lag page - /admin/lag
+"""
+
+__author__ = 'Gareth Coles'
+
+from plugins.web.decorators import check_xsrf
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = "admin"
+
+    def check_access(self):
+        s = self.get_session_object()
+
+        if s is None:
+            self.redirect(
+                "/login",
+                message="You need to login to access this.",
+                message_colour="red",
+                redirect="/admin/lag"
+            )
+            return False
+        elif not self.plugin.check_permission("web.admin", s):
+            content = """
+<div class="ui red fluid message">
+    <p>You do not have permission to access the admin section.</p>
+    <p> If you feel this was in error, tell a bot admin to give you the
+        <code>web.admin</code> permission.
+    </p>
+</div>
+            """
+
+            self.render(
+                "generic.html",
+                _title="Admin | No permission",
+                content=content
+            )
+            return False
+        return True
+
+    def get(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        monitor = self.plugin.lag_monitor
+
+        if monitor is None:
+            return self.render(
+                "admin/lag.html",
+                monitor=None,
+                summary=[],
+                stalls=[]
+            )
+
+        # Stack traces make for a big page
+        return self.render_async(
+            "admin/lag.html",
+            monitor=monitor,
+            summary=monitor.get_summary(),
+            stalls=list(reversed(monitor.get_stalls()))
+        )
+
+    @check_xsrf
+    def post(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        if self.plugin.lag_monitor is not None:
+            self.plugin.lag_monitor.clear()
+
+        self.redirect("/admin/lag", message="Stall history cleared.")
@@ -0,0 +1,40 @@
+"""
+Admin live log page - /admin/logs
+"""
+
+__author__ = 'Gareth Coles'
+
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = "admin"
+
+    def get(self, *args, **kwargs):
+        s = self.get_session_object()
+
+        if s is None:
+            return self.redirect(
+                "/login",
+                message="You need to login to access this.",
+                message_colour="red",
+                redirect="/admin/logs"
+            )
+        elif not self.plugin.check_permission("web.admin", s):
+            content = """
+<div class="ui red fluid message">
+    <p>You do not have permission to access the admin section.</p>
+    <p> If you feel this was in error, tell a bot admin to give you the
+        <code>web.admin</code> permission.
+    </p>
+</div>
+            """
+
+            return self.render(
+                "generic.html",
+                _title="Admin | No permission",
+                content=content
+            )
+
+        return self.render("admin/logs.html", hub=self.plugin.push_hub)
@@ -0,0 +1,172 @@
+"""
+Admin profiler page - /admin/profiler
+
+Profiles' collapsed stacks can be downloaded from
+/admin/profiler/<id>.folded, for flamegraph.pl or speedscope.
+"""
+
+__author__ = 'Gareth Coles'
+
+import time
+
+from plugins.web.decorators import check_xsrf
+from plugins.web.request_handler import RequestHandler
+
+
+class ProfilerHandler(RequestHandler):
+
+    name = "admin"
+
+    def check_access(self):
+        s = self.get_session_object()
+
+        if s is None:
+            self.redirect(
+                "/login",
+                message="You need to login to access this.",
+                message_colour="red",
+                redirect="/admin/profiler"
+            )
+            return False
+        elif not self.plugin.check_permission("web.admin", s):
+            content = """
+<div class="ui red fluid message">
+    <p>You do not have permission to access the admin section.</p>
+    <p> If you feel this was in error, tell a bot admin to give you the
+        <code>web.admin</code> permission.
+    </p>
+</div>
+            """
+
+            self.render(
+                "generic.html",
+                _title="Admin | No permission",
+                content=content
+            )
+            return False
+        return True
+
+
+class Route(ProfilerHandler):
+
+    def get(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        profiler = self.plugin.profiler
+
+        if profiler is None:
+            return self.render(
+                "admin/profiler.html",
+                profiler=None,
+                profiles=[],
+                selected=None,
+                top=None
+            )
+
+        profiles = [p.get_info() for p in reversed(profiler.profiles)]
+        selected = None
+        top = None
+
+        try:
+            profile_id = int(self.get_argument("profile", 0))
+        except ValueError:
+            profile_id = 0
+
+        if profile_id:
+            profile = profiler.get_profile(profile_id)
+        else:
+            profile = profiler.profiles[-1] if profiler.profiles else None
+
+        if profile is not None:
+            selected = profile.get_info()
+
+            if not profile.running:
+                try:
+                    count = int(self.get_argument("count", 25) or 25)
+                except ValueError:
+                    count = 25
+
+                top = profile.get_top(count)
+
+        return self.render_async(
+            "admin/profiler.html",
+            profiler=profiler,
+            profiles=profiles,
+            selected=selected,
+            top=top
+        )
+
+    @check_xsrf
+    def post(self, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        profiler = self.plugin.profiler
+
+        if profiler is None:
+            return self.redirect("/admin/profiler")
+
+        if self.get_argument("action", "start") == "stop":
+            profiler.stop()
+            return self.redirect(
+                "/admin/profiler", message="Profiling stopped."
+            )
+
+        try:
+            duration = float(self.get_argument("duration", 10))
+            interval = float(self.get_argument("interval", 10)) / 1000
+        except ValueError:
+            return self.redirect(
+                "/admin/profiler",
+                message="The duration and interval must be numbers.",
+                message_colour="red"
+            )
+
+        profile = profiler.start(duration, interval)
+
+        if profile is None:
+            return self.redirect(
+                "/admin/profiler",
+                message="There's already a profile running.",
+                message_colour="red"
+            )
+
+        self.redirect(
+            "/admin/profiler",
+            message="Profiling for %s seconds." % profile.duration
+        )
+
+
+class Download(ProfilerHandler):
+
+    def get(self, profile_id, *args, **kwargs):
+        if not self.check_access():
+            return
+
+        profiler = self.plugin.profiler
+        profile = None
+
+        if profiler is not None:
+            profile = profiler.get_profile(int(profile_id))
+
+        if profile is None:
+            return self.send_error(404)
+
+        filename = "ultros-%s.folded" % time.strftime(
+            "%Y%m%d-%H%M%S", time.localtime(profile.started)
+        )
+
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.set_header(
+            "Content-Disposition", "attachment; filename=%s" % filename
+        )
+
+        # This can be big, so build it in the render pool
+        if self.plugin.render_pool is None:
+            return self.finish(profile.get_collapsed())
+
+        d = self.plugin.render_pool.run(profile.get_collapsed)
+        d.addCallback(self.finish)
+
+        return d
@@ -0,0 +1,175 @@
+"""
+API route for paging through and patching files -
+/api/admin/files/<type>/<file>
+
+GET takes `start` (zero-based) and `count`, and returns that window of
+lines, along with the total number of lines and the file's current version.
+
+POST takes `start`, `end` (exclusive), `version` and `content`, and replaces
+those lines with the given content - as long as the file is still at that
+version. An empty `content` deletes the lines. Errors from validating the
+result are returned with line numbers relative to the whole file.
+"""
+
+__author__ = 'Gareth Coles'
+
+from twisted.internet import defer, threads
+
+from plugins.web.decorators import check_xsrf
+from plugins.web.file_view import find_file, VersionConflict
+from plugins.web.request_handler import RequestHandler
+
+#: Most lines we'll send for a single request
+MAX_COUNT = 5000
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    def _find(self, filetype, filename):
+        s = self.get_session_object()
+
+        if s is None:
+            self.finish_json(
+                {"error": "You must login to use this."}
+            )
+        elif not self.plugin.check_permission("web.admin", s):
+            self.finish_json(
+                {"error": "You don't have permission to use this."}
+            )
+        else:
+            fh, path, error = find_file(self.plugin, filetype, filename)
+
+            if error is not None:
+                self.finish_json({"error": error})
+            else:
+                return fh, path
+
+        return None, None
+
+    def _get_int(self, name, default=None):
+        value = self.get_argument(name, None)
+
+        if value is None:
+            if default is None:
+                raise ValueError("Missing '%s' parameter." % name)
+            return default
+
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("'%s' must be a number." % name)
+
+    @defer.inlineCallbacks
+    def get(self, filetype, filename):
+        fh, path = self._find(filetype, filename)
+
+        if fh is None:
+            return
+
+        try:
+            start = self._get_int("start", 0)
+            count = min(self._get_int("count", 500), MAX_COUNT)
+        except ValueError as e:
+            self.finish_json({"error": e.message})
+            return
+
+        try:
+            result = yield threads.deferToThread(
+                self.plugin.file_views.read_lines, path, start, count
+            )
+        except (IOError, OSError) as e:
+            self.finish_json({"error": "Unable to read file: %s" % e})
+            return
+
+        self.finish_json(result)
+
+    @check_xsrf
+    @defer.inlineCallbacks
+    def post(self, filetype, filename):
+        fh, path = self._find(filetype, filename)
+
+        if fh is None:
+            return
+
+        try:
+            start = self._get_int("start")
+            end = self._get_int("end")
+        except ValueError as e:
+            self.finish_json({"error": e.message})
+            return
+
+        version = self.get_argument("version", None)
+        content = self.get_argument("content", None)
+
+        if version is None or content is None:
+            self.finish_json(
+                {"error": "Missing 'version' or 'content' parameter."}
+            )
+            return
+
+        views = self.plugin.file_views
+        lines = content.split("\n") if content else []
+
+        try:
+            errors = yield threads.deferToThread(
+                self._patch_and_write, fh, path, version, start, end, lines
+            )
+        except VersionConflict as e:
+            self.finish_json({"error": e.message, "conflict": True})
+            return
+        except (IOError, OSError) as e:
+            self.finish_json({"error": "Unable to save file: %s" % e})
+            return
+
+        if errors:
+            self.finish_json({"error": "Invalid file.", "errors": errors})
+            return
+
+        views.invalidate(path)
+
+        # Reloading runs the file's callbacks, which expect the reactor
+        try:
+            fh.reload()
+        except Exception as e:
+            self.plugin.logger.exception("Error reloading %s" % path)
+            self.finish_json({"error": "Unable to reload file: %s" % e})
+            return
+
+        if self.plugin.response_cache is not None:
+            self.plugin.response_cache.invalidate("storage")  # For mtimes
+
+        result = yield threads.deferToThread(
+            views.read_lines, path, start, len(lines)
+        )
+        result["success"] = True
+
+        self.finish_json(result)
+
+    def _patch_and_write(self, fh, path, version, start, end, lines):
+        """
+        Patch, validate and write the file, returning a list of validation
+        errors - the file is only written if there aren't any.
+        """
+
+        views = self.plugin.file_views
+
+        with views.get_path_lock(path):
+            data = views.build_patch(path, version, start, end, lines)
+
+            # YAML and JSON can only be checked as a whole document, but at
+            # least we're doing it in a thread now
+            result = fh.validate(data)
+            errors = []
+
+            if result[0] is False:
+                errors.append(result[1])
+            elif isinstance(result[0], list):
+                for element in result:
+                    errors.append("Line %s: %s" % tuple(element))
+
+            if not errors:
+                views.write(path, data)
+
+        return errors
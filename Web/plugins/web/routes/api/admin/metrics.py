@@ -0,0 +1,99 @@
+"""
+API route for querying stored metrics - /api/admin/metrics
+
+With no arguments, this lists the available series. Otherwise, it takes:
+
+* `series` - Comma-separated list of series names
+* `start`, `end` - Unix timestamps; negative values are relative to now.
+  Defaults to the last hour
+* `resolution` - One of raw, 1m, 1h or 1d; picked for you if not given
+* `max_points` - Pick a resolution giving no more than this many points
+"""
+
+__author__ = 'Gareth Coles'
+
+import time
+
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    def _get_time(self, name, default):
+        value = self.get_argument(name, None)
+
+        if value is None:
+            return default
+
+        value = float(value)
+
+        if value < 0:
+            value += time.time()
+        return value
+
+    def get(self, *args, **kwargs):
+        s = self.get_session_object()
+
+        if s is None:
+            return self.finish_json(
+                {"error": "You must login to use this."}
+            )
+        elif not self.plugin.check_permission("web.admin", s):
+            return self.finish_json(
+                {"error": "You don't have permission to use this."}
+            )
+
+        stats = self.plugin.stats
+        names = self.get_argument("series", None)
+
+        if not names:
+            return self.finish_json({
+                "series": [
+                    series.get_info() for series in stats.series.values()
+                ]
+            })
+
+        try:
+            end = self._get_time("end", time.time())
+            start = self._get_time("start", end - 3600)
+            max_points = self.get_argument("max_points", None)
+
+            if max_points is not None:
+                max_points = int(max_points)
+        except ValueError:
+            return self.finish_json(
+                {"error": "start, end and max_points must be numbers."}
+            )
+
+        resolution = self.get_argument("resolution", None)
+        data = {}
+
+        for name in names.split(","):
+            series = stats.get_series(name)
+
+            if series is None:
+                return self.finish_json(
+                    {"error": "Unknown series: %s" % name}
+                )
+
+            try:
+                used, points = series.query(
+                    start, end, resolution, max_points
+                )
+            except KeyError as e:
+                return self.finish_json({"error": e.message})
+
+            data[name] = {
+                "unit": series.unit,
+                "resolution": used,
+                "points": points
+            }
+
+        # This can be a lot of points, so encode them in the render pool
+        return self.finish_json_async({
+            "start": int(start * 1000),
+            "end": int(end * 1000),
+            "series": data
+        })
@@ -0,0 +1,86 @@
+"""
+API route for live updates - /api/admin/push
+
+This is a Server-Sent Events stream, which stays open until the client goes
+away. It takes:
+
+* `series` - Comma-separated list of stats series to send new points for
+* `logs` - Set to 1 to send new log lines
+
+Events are `metric` ({series, x, y}), `log` (a list of log records, with the
+last record's ID as the event ID, so reconnecting clients pick up where they
+left off) and `dropped`, sent when the client was too slow to keep up and
+missed some frames.
+"""
+
+__author__ = 'Gareth Coles'
+
+from cyclone.web import asynchronous
+
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    @asynchronous
+    def get(self, *args, **kwargs):
+        s = self.get_session_object()
+
+        if s is None:
+            return self.finish_json(
+                {"error": "You must login to use this."}
+            )
+        elif not self.plugin.check_permission("web.admin", s):
+            return self.finish_json(
+                {"error": "You don't have permission to use this."}
+            )
+
+        hub = self.plugin.push_hub
+
+        if hub is None:
+            return self.finish_json(
+                {"error": "Live updates are disabled."}
+            )
+
+        names = [
+            name for name in self.get_argument("series", "").split(",")
+            if name
+        ]
+
+        for name in names:
+            if self.plugin.stats.get_series(name) is None:
+                return self.finish_json(
+                    {"error": "Unknown series: %s" % name}
+                )
+
+        logs = self.get_argument("logs", "0").lower() in ("1", "true", "yes")
+
+        if not names and not logs:
+            return self.finish_json(
+                {"error": "Subscribe to at least one series, or the logs."}
+            )
+
+        last_id = self.request.headers.get("Last-Event-ID", None)
+
+        try:
+            if last_id is not None:
+                last_id = int(last_id)
+        except ValueError:
+            last_id = None
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Accel-Buffering", "no")  # For nginx
+
+        # Ask the browser to wait a few seconds before reconnecting
+        self.write("retry: 5000\n\n")
+        self.flush()
+
+        hub.subscribe(self, s["username"], names, logs, last_id)
+
+    def on_connection_close(self, *args, **kwargs):
+        if self.plugin.push_hub is not None:
+            # The client's gone, so there's nothing to finish
+            self.plugin.push_hub.unsubscribe(self, False)
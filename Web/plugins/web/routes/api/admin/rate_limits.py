@@ -0,0 +1,37 @@
+"""
+API route for the rate limiter's state - /api/admin/rate_limits
+
+Returns the number of API requests allowed and turned away, and every
+bucket that isn't full, emptiest first.
+"""
+
+__author__ = 'Gareth Coles'
+
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    def get(self, *args, **kwargs):
+        s = self.get_session_object()
+
+        if s is None:
+            return self.finish_json(
+                {"error": "You must login to use this."}
+            )
+        elif not self.plugin.check_permission("web.admin", s):
+            return self.finish_json(
+                {"error": "You don't have permission to use this."}
+            )
+
+        limiter = self.plugin.rate_limiter
+
+        if limiter is None:
+            return self.finish_json({"enabled": False})
+
+        stats = limiter.get_stats()
+        stats["enabled"] = True
+
+        self.finish_json(stats)
@@ -0,0 +1,150 @@
+"""
+API route for running several API requests at once - /api/v1/<key>/batch
+
+POST a JSON list of sub-requests (or an object with a "requests" list).
+Each sub-request is an object with:
+
+* `path` - The API path after the key, like "/plugins/web/get_username",
+  optionally with a query string
+* `method` - GET (the default), POST, PUT or DELETE
+* `args` - An object of arguments, added to the query string
+* `body` - A string or JSON value to send as the request body. Strings
+  are sent as form data ("a=1&b=2"), and for POST and PUT are read into
+  the arguments like a normal form post
+* `id` - Anything you like, returned with the result
+
+Sub-requests are all started at once, so ones that wait on something run
+at the same time. The response has a "results" list in the same order,
+each with the sub-request's "status" and "body" - decoded, if it was JSON.
+The API key is checked, and the request rate-limited, once for the whole
+batch.
+"""
+
+__author__ = 'Gareth Coles'
+
+import json
+
+from twisted.internet import defer, reactor
+
+from plugins.web.access_log import API_PATH
+from plugins.web.api_errors import (
+    bad_request_error, invalid_key_error, not_found_error
+)
+from plugins.web.batch import (
+    Batch, BatchError, build_request, DEFAULT_MAX_ITEMS, DEFAULT_TIMEOUT
+)
+from plugins.web.decorators import check_api
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    def check_route(self, path):
+        """
+        Make sure a sub-request's path goes to an API route, and that it
+        isn't another batch.
+        """
+
+        for spec in self.application.router.match(path):
+            if spec.regex.match(path):
+                if issubclass(spec.handler_class, Route):
+                    raise BatchError(400, "Batches can't be nested")
+                return
+
+        raise BatchError(404, "Route not found")
+
+    @check_api
+    def post(self, username, *args, **kwargs):
+        if username is None:
+            return self.finish_json(invalid_key_error())
+
+        config = self.plugin.config.get("batch", {})
+        max_items = config.get("max_items", DEFAULT_MAX_ITEMS)
+
+        try:
+            items = json.loads(self.request.body)
+        except ValueError:
+            return self.finish_json(
+                bad_request_error("The body must be a JSON list")
+            )
+
+        if isinstance(items, dict):
+            items = items.get("requests", None)
+
+        if not isinstance(items, list):
+            return self.finish_json(
+                bad_request_error("The body must be a JSON list")
+            )
+
+        if len(items) > max_items:
+            return self.finish_json(bad_request_error(
+                "Batches may have up to %s requests" % max_items
+            ))
+
+        api_key = API_PATH.match(self.request.path).group(1)
+        prefix = self.request.path[:-len("/batch")]
+        batch = Batch(api_key, username)
+
+        results = [None] * len(items)
+        waiting = []
+
+        def store(result, i):
+            results[i].update(result)
+
+        address = self.get_client_address()
+
+        for i, item in enumerate(items):
+            results[i] = {}
+
+            if isinstance(item, dict) and "id" in item:
+                results[i]["id"] = item["id"]
+
+            try:
+                request, collector = build_request(
+                    item, prefix, self.request, batch, address
+                )
+                self.check_route(request.path)
+            except BatchError as e:
+                results[i]["status"] = e.status
+
+                if e.status == 404:
+                    results[i]["body"] = not_found_error()
+                else:
+                    results[i]["body"] = bad_request_error(e.message)
+                continue
+
+            collector.finished.addCallback(store, i)
+            waiting.append(collector.finished)
+
+            self.application(request)
+
+        # Wait for any that are still running, but not forever
+        done = defer.Deferred()
+        timer = reactor.callLater(
+            config.get("timeout", DEFAULT_TIMEOUT), done.callback, None
+        )
+
+        def finished(_):
+            if timer.active():
+                timer.cancel()
+                done.callback(None)
+
+        defer.DeferredList(waiting).addCallback(finished)
+
+        def respond(_):
+            for result in results:
+                if "status" not in result:
+                    result.update({
+                        "status": 504,
+                        "body": {
+                            "error": "timeout",
+                            "error_msg": "Timed out"
+                        }
+                    })
+
+            self.finish_json({"results": results})
+
+        done.addCallback(respond)
+        return done
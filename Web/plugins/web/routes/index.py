@@ -11,7 +11,14 @@ class Route(RequestHandler):
 
     name = "home"
 
+    cache_ttl = 30  # Protocols come and go without telling us
+    cache_permissions = ["web.index.plugins", "web.index.protocols"]
+    cache_tags = ["plugins", "packages", "protocols"]
+
     def get(self, *args, **kwargs):
+        if self.finish_cached():
+            return
+
         s = self.get_session_object()
 
         packages = None
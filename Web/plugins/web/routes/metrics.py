@@ -0,0 +1,53 @@
+"""
+Prometheus metrics - /metrics
+
+This is off unless it's enabled in the config. Scrapers need to come from
+an address in the "metrics: allow" list (see get_client_address()), or
+send an API key belonging to a user with the `web.metrics` permission -
+either as a bearer token in the Authorization header, or as the `key`
+argument.
+"""
+
+__author__ = 'Gareth Coles'
+
+from plugins.web.registry import CONTENT_TYPE
+from plugins.web.request_handler import RequestHandler
+
+
+class Route(RequestHandler):
+
+    name = ""
+
+    def get_api_key(self):
+        header = self.request.headers.get("Authorization", "")
+
+        if header.lower().startswith("bearer "):
+            return header[7:].strip()
+        return self.get_argument("key", None)
+
+    def check_access(self):
+        if self.get_client_address() in self.plugin.metrics_allow:
+            return True
+
+        key = self.get_api_key()
+
+        if not key:
+            return False
+
+        username = self.plugin.api_keys.use_key(key)
+
+        if username is None:
+            return False
+        return self.plugin.check_permission("web.metrics", username)
+
+    def get(self, *args, **kwargs):
+        if self.plugin.metrics_allow is None:
+            return self.send_error(404)  # Disabled
+
+        if not self.check_access():
+            self.set_status(403)
+            self.set_header("Content-Type", "text/plain; charset=utf-8")
+            return self.finish("Forbidden\n")
+
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.finish(self.plugin.metrics.render())
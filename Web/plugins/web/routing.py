@@ -0,0 +1,336 @@
+"""
+The Web plugin's route table.
+
+Routes used to be handed straight to Cyclone, which keeps them in a list and
+tries every regex in turn - and can't remove them without building a new
+Application, which meant restarting the server. Instead, we keep our own
+table, which can be changed while the server is running.
+
+Every change builds a new, immutable RouteTable and swaps it in, so
+requests never see a half-updated table and never need a lock. Inside a
+table, routes that are plain strings are looked up in a dict, and the rest
+are filed in a trie under the literal path segments their pattern starts
+with, so only the regexes that could possibly match a path get tried.
+"""
+
+__author__ = 'Gareth Coles'
+
+import re
+import threading
+
+from collections import OrderedDict
+
+from cyclone.util import import_object
+from cyclone.web import Application, URLSpec
+
+#: Characters with a special meaning in regexes
+SPECIAL = set(".^$*+?{}[]\\|()")
+
+#: Characters that make the character before them optional
+OPTIONAL = set("?*{")
+
+#: Path segments that match any single segment, like "([A-Za-z0-9]+)" for
+#: the API key in API routes
+WILDCARD_SEGMENT = re.compile(r"^\(\[[A-Za-z0-9_\-]+\]\+\)$")
+
+#: Trie key for wildcard segments
+WILDCARD = None
+
+
+def has_alternation(pattern):
+    """
+    Check whether a pattern has a top-level | in it, in which case it
+    doesn't have a usable prefix.
+    """
+
+    depth = 0
+    in_class = False
+    escaped = False
+
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+
+    return False
+
+
+def literal_prefix(pattern):
+    """
+    Get the part of a pattern that will always match exactly the same text,
+    as a (prefix, whole pattern is literal) tuple.
+    """
+
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+
+    if pattern.endswith("$") and not pattern.endswith("\\$"):
+        pattern = pattern[:-1]
+
+    if has_alternation(pattern):
+        return "", False
+
+    prefix = []
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                c = pattern[i + 1]
+                step = 2
+            else:
+                break  # \d, \w and friends
+        elif c in SPECIAL:
+            break
+        else:
+            step = 1
+
+        following = pattern[i + step:i + step + 1]
+
+        if following in OPTIONAL:
+            break
+
+        prefix.append(c)
+        i += step
+
+        if following == "+":
+            break  # We know it's there at least once, but not after that
+
+    return "".join(prefix), i == len(pattern)
+
+
+def trie_segments(pattern):
+    """
+    Get the path segments at the start of a pattern that we can file it
+    under in the trie - each either a literal string or WILDCARD. For
+    example, "/api/v1/([A-Za-z0-9]+)/test/(.*)" gives
+    ["api", "v1", WILDCARD, "test"].
+    """
+
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+
+    if not pattern.startswith("/") or has_alternation(pattern):
+        return []
+
+    segments = []
+
+    # A / inside a group or class would split it up wrongly, but we stop at
+    # the first segment that isn't a literal or a wildcard, so that's fine
+    for segment in pattern.split("/")[1:-1]:
+        if WILDCARD_SEGMENT.match(segment):
+            segments.append(WILDCARD)
+            continue
+
+        prefix, literal = literal_prefix(segment)
+
+        if not literal:
+            break
+
+        segments.append(prefix)
+
+    return segments
+
+
+class Route(object):
+    """
+    A single route, as added to the Router.
+    """
+
+    def __init__(self, pattern, handler, kwargs=None, sequence=0):
+        if isinstance(handler, basestring):
+            handler = import_object(handler)
+
+        self.pattern = pattern
+        self.spec = URLSpec(pattern, handler, kwargs)
+        self.sequence = sequence  # Order it was added in
+
+        self.prefix, self.literal = literal_prefix(pattern)
+        self.segments = trie_segments(pattern)
+
+    def __repr__(self):
+        return "<Route %r -> %s>" % (self.pattern, self.spec.handler_class)
+
+
+class RouteTable(object):
+    """
+    An immutable snapshot of the routes, built for matching.
+    """
+
+    def __init__(self, routes, version=0):
+        self.version = version
+        self.exact = {}  # Path: spec
+        self.trie = {}  # Segment or WILDCARD: (child trie, [routes])
+        self.root = []  # Routes without a usable prefix
+
+        for route in routes:
+            if route.literal:
+                self.exact.setdefault(route.prefix, route.spec)
+                continue
+
+            node = None
+            children = self.trie
+
+            for segment in route.segments:
+                node = children.setdefault(segment, ({}, []))
+                children = node[0]
+
+            if node is None:
+                self.root.append(route)
+            else:
+                node[1].append(route)
+
+    def match(self, path):
+        """
+        Get a list of specs that might match a path, in the order they
+        should be tried.
+        """
+
+        spec = self.exact.get(path, None)
+
+        if spec is not None:
+            return [spec]
+
+        candidates = list(self.root)
+        tries = [self.trie]
+
+        for segment in path.split("/")[1:]:
+            found = []
+
+            for children in tries:
+                node = children.get(segment, None)
+
+                if node is not None:
+                    found.append(node[0])
+                    candidates.extend(node[1])
+
+                if segment:
+                    node = children.get(WILDCARD, None)
+
+                    if node is not None:
+                        found.append(node[0])
+                        candidates.extend(node[1])
+
+            if not found:
+                break
+
+            tries = found
+
+        if len(candidates) > 1:
+            candidates.sort(key=lambda r: r.sequence)
+
+        return [route.spec for route in candidates]
+
+
+class Router(object):
+    """
+    The set of routes the Web plugin serves. Plain-string patterns are
+    matched before regexes; otherwise, routes are tried in the order they
+    were added, just like Cyclone.
+
+    Changes are made from the reactor thread, and take effect from the next
+    request.
+    """
+
+    def __init__(self):
+        self.routes = OrderedDict()  # Pattern: Route
+        self.table = RouteTable([])
+        self.version = 0
+        self.sequence = 0
+
+        self.lock = threading.Lock()
+
+    def __contains__(self, pattern):
+        return pattern in self.routes
+
+    def __len__(self):
+        return len(self.routes)
+
+    def _rebuild(self):
+        self.version += 1
+        self.table = RouteTable(self.routes.values(), self.version)
+
+    def add(self, pattern, handler, kwargs=None):
+        """
+        Add a route. The handler may be a RequestHandler subclass, or its
+        fully-qualified name. Returns False if the pattern is already
+        routed.
+        """
+
+        with self.lock:
+            if pattern in self.routes:
+                return False
+
+            self.sequence += 1
+            self.routes[pattern] = Route(
+                pattern, handler, kwargs, self.sequence
+            )
+
+            self._rebuild()
+
+        return True
+
+    def remove(self, *patterns):
+        """
+        Remove routes by pattern, returning how many were removed.
+        """
+
+        with self.lock:
+            removed = 0
+
+            for pattern in patterns:
+                if self.routes.pop(pattern, None) is not None:
+                    removed += 1
+
+            if removed:
+                self._rebuild()
+
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+            self._rebuild()
+
+    def get_routes(self):
+        return [
+            (route.pattern, route.spec.handler_class)
+            for route in self.routes.itervalues()
+        ]
+
+    def match(self, path):
+        return self.table.match(path)
+
+
+class RoutedApplication(Application):
+    """
+    A Cyclone application that takes its routes from a Router, falling back
+    to Cyclone's own handlers (for static files) when none of them match.
+    """
+
+    def __init__(self, router, **settings):
+        self.router = router
+        Application.__init__(self, [], **settings)
+
+    def _get_host_handlers(self, request):
+        specs = self.router.match(request.path)
+        fallback = Application._get_host_handlers(self, request)
+
+        if fallback:
+            specs = specs + fallback
+
+        return specs or None
@@ -1,27 +1,142 @@
 __author__ = 'Gareth Coles'
 
-import datetime
+import sqlite3
 import time
 import weakref
 
+from twisted.internet import task
+
 from utils.password import mkpasswd
 
+#: Sessions without "remember me" expire after this many seconds unused
+SESSION_LIFETIME = 30 * 24 * 60 * 60
+
+#: How often pending last-seen times are written to the database
+FLUSH_INTERVAL = 30
+
+#: How often expired sessions are removed from the database
+EXPIRY_INTERVAL = 60 * 60
+
 
 class Sessions(object):
+    """
+    Session store, backed by SQLite.
+
+    Sessions are indexed by key and by username, and by last-seen time so
+    that expiring them doesn't need to look at every session. Sessions that
+    have been looked up are cached, and updating a session's last-seen time
+    only touches the cache - the times are written to the database in one
+    batch every FLUSH_INTERVAL seconds.
+
+    This is only used from the reactor thread.
+    """
 
     _plugin_object = None
-    sessions = {}
+
+    db = None
+    path = None
+
+    cache = None  # key -> session dict
+    pending = None  # key -> last-seen time not yet in the database
+
+    looping_callback = None
+    last_expiry = 0
 
     @property
     def plugin(self):
         return self._plugin_object()
 
-    def __init__(self, plugin, sessions):
+    def __init__(self, plugin, path, legacy=None):
         self._plugin_object = weakref.ref(plugin)
-        self.sessions = sessions
+        self.path = path
+
+        self.cache = {}
+        self.pending = {}
+
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, "
+                "username TEXT NOT NULL, "
+                "remember INTEGER NOT NULL, "
+                "time REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_username "
+                "ON sessions (username)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_expiry "
+                "ON sessions (remember, time)"
+            )
+
+        if legacy is not None and list(legacy.keys()):
+            self.migrate(legacy)
 
         self.clear_old()
 
+    def migrate(self, legacy):
+        """
+        Import sessions from the old sessions.json storage file, and then
+        empty it so they aren't imported again.
+        """
+
+        keys = list(legacy.keys())
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                [
+                    (key, legacy[key]["username"],
+                     bool(legacy[key]["remember"]), legacy[key]["time"])
+                    for key in keys
+                ]
+            )
+
+        with legacy:
+            for key in keys:
+                del legacy[key]
+
+        self.plugin.logger.info(
+            "Migrated %s sessions from sessions.json" % len(keys)
+        )
+
+    def start(self):
+        self.looping_callback = task.LoopingCall(self.task)
+        self.looping_callback.start(FLUSH_INTERVAL, False)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+        self.flush()
+
+    def task(self):
+        self.flush()
+
+        if time.time() - self.last_expiry >= EXPIRY_INTERVAL:
+            self.clear_old()
+
+    def flush(self):
+        """
+        Write any pending last-seen times to the database.
+        """
+
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE sessions SET time = ? WHERE key = ?",
+                [(t, key) for key, t in pending.iteritems()]
+            )
+
     def check_login(self, username, password):
         x = self.plugin.commands.auth_handler
         if x.check_login(username, password):
@@ -31,26 +146,26 @@ class Sessions(object):
 
     def check_session(self, s):
         if not s["remember"]:
-            then = datetime.datetime.fromtimestamp(s["time"])
-            now = datetime.datetime.now()
-
-            delta = now - then
-            if delta > datetime.timedelta(days=30):
+            if time.time() - s["time"] > SESSION_LIFETIME:
                 return False
 
         return True
 
     def clear_old(self):
-        done = 0
+        self.flush()  # Don't expire anything that was used recently
+
+        self.last_expiry = time.time()
+        cutoff = self.last_expiry - SESSION_LIFETIME
 
-        with self.sessions:
-            for key in list(self.sessions.keys()):
-                s = self.sessions[key]
+        with self.db:
+            done = self.db.execute(
+                "DELETE FROM sessions WHERE remember = 0 AND time < ?",
+                (cutoff,)
+            ).rowcount
 
-                if not self.check_session(s):
-                    del self.sessions[key]
-                    self.plugin.logger.debug("Removed session: %s" % key)
-                    done += 1
+        for key, s in self.cache.items():
+            if not self.check_session(s):
+                del self.cache[key]
 
         self.plugin.logger.info("Cleared %s old sessions" % done)
 
@@ -60,46 +175,90 @@ class Sessions(object):
 
         s = {
             "username": username,
-            "remember": remember,
-            "time": time.mktime(datetime.datetime.now().timetuple())
+            "remember": bool(remember),
+            "time": time.time()
         }
 
-        with self.sessions:
-            self.sessions[key] = s
+        with self.db:
+            self.db.execute(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?)",
+                (key, username, s["remember"], s["time"])
+            )
+
+        self.cache[key] = s
 
         return key
 
     def delete_session(self, key):
-        with self.sessions:
-            if key in self.sessions:
-                del self.sessions[key]
-                return True
+        s = self.cache.pop(key, None)
+        self.pending.pop(key, None)
 
-        return False
+        if s is None:
+            s = self.db.execute(
+                "SELECT username FROM sessions WHERE key = ?", (key,)
+            ).fetchone()
+
+        if s is not None:
+            self.plugin.permission_cache.invalidate(s["username"])
+
+        with self.db:
+            return self.db.execute(
+                "DELETE FROM sessions WHERE key = ?", (key,)
+            ).rowcount > 0
 
     def delete_sessions_for_user(self, username):
-        with self.sessions:
-            for key in list(self.sessions.keys()):
-                if self.sessions[key]["username"] == username:
-                    del self.sessions[key]
+        username = username.lower()
+        self.plugin.permission_cache.invalidate(username)
+
+        for key, s in self.cache.items():
+            if s["username"] == username:
+                del self.cache[key]
+                self.pending.pop(key, None)
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM sessions WHERE username = ?", (username,)
+            )
 
     def get_session(self, key):
-        s = self.sessions.get(key, None)
+        if key is None:
+            return None
+
+        s = self.cache.get(key, None)
 
         if s is None:
-            return s
+            row = self.db.execute(
+                "SELECT username, remember, time FROM sessions WHERE key = ?",
+                (key,)
+            ).fetchone()
 
-        if not self.check_session(s):
-            with self.sessions:
-                del self.sessions[key]
+            if row is None:
+                return None
 
+            s = {
+                "username": row["username"],
+                "remember": bool(row["remember"]),
+                "time": row["time"]
+            }
+            self.cache[key] = s
+
+        if not self.check_session(s):
+            self.delete_session(key)
             return None
 
         return s
 
+    def count(self):
+        """
+        How many sessions there are, including any that have expired but
+        haven't been cleared yet.
+        """
+
+        return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
     def update_session_time(self, key):
-        if key in self.sessions:
-            with self.sessions:
-                self.sessions[key]["time"] = time.mktime(
-                    datetime.datetime.now().timetuple()
-                )
+        s = self.get_session(key)
+
+        if s is not None:
+            s["time"] = time.time()
+            self.pending[key] = s["time"]
@@ -0,0 +1,205 @@
+"""
+Static file serving.
+
+Everything under web/static is read, hashed and compressed once, when the
+plugin loads, and served from memory. URLs made with `static_url()` carry a
+fingerprint of the file's contents, so they can be cached forever - when a
+file changes, so does its URL.
+
+Brotli is used as well as gzip if the "brotli" module is installed.
+"""
+
+__author__ = 'Gareth Coles'
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from cStringIO import StringIO
+
+from cyclone.web import RequestHandler, HTTPError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Types worth compressing - everything else is sent as it is
+COMPRESSIBLE_TYPES = set([
+    "text/plain", "text/html", "text/css", "text/xml", "text/javascript",
+    "application/javascript", "application/x-javascript", "application/json",
+    "application/xml", "image/svg+xml"
+])
+
+#: How long to cache fingerprinted URLs for - a year
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def gzip_data(data):
+    buf = StringIO()
+    f = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=9, mtime=0)
+
+    f.write(data)
+    f.close()
+
+    return buf.getvalue()
+
+
+class Asset(object):
+    """
+    A single static file, with its fingerprint and every encoding of it
+    we're able to send.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.mime_type = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+
+        self.fingerprint = hashlib.sha1(data).hexdigest()[:12]
+        self.etag = '"%s"' % self.fingerprint
+
+        self.encodings = {"identity": data}
+
+        if self.mime_type in COMPRESSIBLE_TYPES:
+            # Always keep the gzipped version for these, even if it's no
+            # smaller, or Cyclone will gzip the response all over again
+            self.encodings["gzip"] = gzip_data(data)
+
+            if brotli is not None:
+                compressed = brotli.compress(data)
+
+                if len(compressed) < len(data):
+                    self.encodings["br"] = compressed
+
+    @property
+    def size(self):
+        return sum(len(d) for d in self.encodings.itervalues())
+
+    def negotiate(self, accept_encoding):
+        """
+        Pick the best encoding we have that the client will accept.
+        """
+
+        accepted = set(
+            part.split(";")[0].strip().lower()
+            for part in accept_encoding.split(",")
+        )
+
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+class StaticAssets(object):
+    """
+    The set of assets under the static directory.
+    """
+
+    def __init__(self, root="web/static"):
+        self.root = root
+        self.assets = {}
+
+        self.load()
+
+    def load(self):
+        assets = {}
+
+        for path, _, files in os.walk(self.root):
+            for filename in files:
+                full_path = os.path.join(path, filename)
+                name = os.path.relpath(full_path, self.root).replace(
+                    os.sep, "/"
+                )
+
+                with open(full_path, "rb") as f:
+                    assets[name] = Asset(name, f.read())
+
+        self.assets = assets
+
+    def get(self, path):
+        return self.assets.get(path, None)
+
+    def get_stats(self):
+        return {
+            "assets": len(self.assets),
+            "bytes": sum(a.size for a in self.assets.itervalues()),
+            "brotli": brotli is not None
+        }
+
+    def url(self, path, prefix="/static/"):
+        """
+        Get the fingerprinted URL for an asset. Paths that aren't assets
+        are returned as-is.
+        """
+
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        elif path.startswith("/") or "://" in path:
+            return path  # Not one of ours
+
+        asset = self.assets.get(path.split("?", 1)[0], None)
+
+        if asset is None:
+            return "%s%s" % (prefix, path)
+        return "%s%s?v=%s" % (prefix, asset.path, asset.fingerprint)
+
+
+class StaticHandler(RequestHandler):
+    """
+    Serves assets from the plugin's StaticAssets. This replaces Cyclone's
+    StaticFileHandler, via the "static_handler_class" setting.
+    """
+
+    def initialize(self, path=None, default_filename=None):
+        pass
+
+    @classmethod
+    def make_static_url(cls, settings, path):
+        return settings["static_assets"].url(
+            path, settings.get("static_url_prefix", "/static/")
+        )
+
+    def compute_etag(self):
+        return None  # We set our own, and don't need the body hashed
+
+    def head(self, path):
+        self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        asset = self.settings["static_assets"].get(path)
+
+        if asset is None:
+            raise HTTPError(404)
+
+        self.set_header("Content-Type", asset.mime_type)
+        self.set_header("Etag", asset.etag)  # Vary is added by Cyclone
+
+        if self.get_argument("v", None) == asset.fingerprint:
+            self.set_header(
+                "Cache-Control", "public, max-age=%s" % CACHE_MAX_AGE
+            )
+        else:
+            # Unfingerprinted or outdated URL - check back each time
+            self.set_header("Cache-Control", "public, no-cache")
+
+        if_none_match = self.request.headers.get("If-None-Match", "")
+
+        if asset.etag in if_none_match or if_none_match.strip() == "*":
+            self.set_status(304)
+            return
+
+        encoding = asset.negotiate(
+            self.request.headers.get("Accept-Encoding", "")
+        )
+        data = asset.encodings[encoding]
+
+        if encoding != "identity":
+            self.set_header("Content-Encoding", encoding)
+
+        if include_body:
+            self.write(data)
+        else:
+            self.set_header("Content-Length", len(data))
@@ -3,23 +3,32 @@ __author__ = 'Gareth Coles'
 import psutil
 import time
 
-from collections import deque
+from collections import OrderedDict
 from twisted.internet import task
 
+from plugins.web.metrics import Series
 from system.singleton import Singleton
 
 
 class Stats(object):
     """
-    Statistics about this process and the machine itself.
+    Statistics about this process and the machine itself, and anything else
+    that other plugins want to keep track of.
 
-    This uses fixed-length queues to store up to 20 items of each statistic.
+    Each statistic is a named series - see plugins.web.metrics - holding
+    raw samples for the last hour, and min/avg/max rollups per minute for a
+    day, per hour for two weeks and per day for a year, in a fixed amount of
+    memory.
     """
 
     __metaclass__ = Singleton
 
-    cpu = deque(maxlen=20)
-    ram = deque(maxlen=20)
+    interval = 5.0  # Seconds between samples
+
+    series = None  # Name -> Series
+    failing = None  # Names of series whose samplers have raised errors
+
+    logger = None  # Set by the Web plugin, as we outlive it
 
     process = psutil.Process()
 
@@ -29,39 +38,112 @@ class Stats(object):
         return int(round(time.time() * 1000))
 
     def __init__(self):
-        pass
+        self.series = OrderedDict()
+        self.failing = set()
+
+        self.register_series(
+            "cpu", self.process.cpu_percent, "%", "CPU used by Ultros"
+        )
+        self.register_series(
+            "ram",
+            lambda: (float(self.process.memory_info().rss) / 1024) / 1024,
+            "MB", "Memory used by Ultros"
+        )
 
     def start(self):
-        self.cpu.clear()
-        self.ram.clear()
-
         self.looping_callback = task.LoopingCall(self.task)
-        self.looping_callback.start(5.0)
+        self.looping_callback.start(self.interval)
 
     def stop(self):
         self.looping_callback.stop()
 
+    ## Series
+
+    def register_series(self, name, func=None, unit="", description=""):
+        """
+        Register a new series, returning it. If `func` is given, it's called
+        every `interval` seconds to take a sample - otherwise, use
+        `record()` to add values to the series yourself.
+
+        If the series already exists, it's returned as-is, so plugins can
+        keep their history over a reload.
+        """
+
+        if name in self.series:
+            series = self.series[name]
+
+            if func is not None:
+                series.func = func
+            return series
+
+        series = Series(name, unit, description, func, self.interval)
+        self.series[name] = series
+
+        return series
+
+    def unregister_series(self, name):
+        if name in self.series:
+            del self.series[name]
+            return True
+        return False
+
+    def get_series(self, name):
+        return self.series.get(name, None)
+
+    def record(self, name, value, t=None):
+        self.series[name].add(value, t)
+
+    def query(self, name, start=None, end=None, resolution=None,
+              max_points=None):
+        return self.series[name].query(start, end, resolution, max_points)
+
+    ## The original CPU/RAM functions, with the last 20 samples
+
+    def _get_recent(self, name, count=20):
+        _, points = self.series[name].query(
+            time.time() - count * self.interval, resolution="raw"
+        )
+
+        return [[p[2], p[0]] for p in points[-count:]]
+
+    def _get_latest(self, name):
+        latest = self.series[name].latest
+
+        if latest is None:
+            return None
+        return [latest[2], int(round(latest[0] * 1000))]
+
     def get_cpu(self):
-        return list(self.cpu)
+        return self._get_recent("cpu")
 
     def get_ram(self):
-        return list(self.ram)
+        return self._get_recent("ram")
 
     def get_cpu_latest(self):
-        return self.cpu[-1]
+        return self._get_latest("cpu")
 
     def get_ram_latest(self):
-        return self.ram[-1]
+        return self._get_latest("ram")
 
     def get_ram_total(self):
         return (float(psutil.virtual_memory().total) / 1024) / 1024
 
     def task(self):
-        self.cpu.append([
-            self.process.cpu_percent(),
-            self._get_timestamp()
-        ])
-        self.ram.append([
-            (float(self.process.memory_info().rss) / 1024) / 1024,
-            self._get_timestamp()
-        ])
+        now = time.time()
+
+        for series in self.series.values():
+            if series.func is None:
+                continue
+
+            try:
+                series.add(series.func(), now)
+            except Exception:
+                # Don't let one broken series stop the others being sampled,
+                # or fill the log with the same error every few seconds
+                if series.name not in self.failing:
+                    self.failing.add(series.name)
+
+                    if self.logger is not None:
+                        self.logger.exception(
+                            "Unable to sample series: %s" % series.name
+                        )
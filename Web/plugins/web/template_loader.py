@@ -1,23 +1,41 @@
 __author__ = 'Gareth Coles'
 
-import threading
-import tempfile
 import os
 import shutil
+import threading
 
 from weakref import ref
 
 from cyclone.template import BaseLoader
 from mako.lookup import TemplateLookup
+from twisted.internet import task
 
 
 class TemplateLoader(BaseLoader):
+    """
+    Mako template loader.
+
+    Every template under `root` is compiled when the loader is created, with
+    the compiled modules kept in `cache_dir` so that unchanged templates
+    don't need to be compiled again after a restart.
 
-    lock = None  # To protect the template cache
+    Loaded templates are kept in a dict that's never modified once it's
+    been published - changes build a new dict and swap it in - so `load()`
+    doesn't need a lock. Template files are checked for changes every
+    `check_interval` seconds rather than on every request.
+    """
+
+    lock = None  # Only held while publishing a new set of templates
     lookup = None  # Mako template lookup class
+    templates = None  # Template name -> Mako template, never modified
+    mtimes = None  # Template name -> mtime when it was loaded
+
     _plugin = None  # Weakref of the plugin itself
     root = "web/templates"  # Relative path of templates
-    tempdir = None  # Location of cached templates
+    cache_dir = "data/plugins/web/template_cache"  # Compiled templates
+
+    check_interval = 5  # Seconds between checks for changed templates
+    looping_callback = None
 
     @property
     def plugin(self):
@@ -27,17 +45,108 @@ class TemplateLoader(BaseLoader):
         plugin = ref(plugin)
         self.namespace = namespace or {}
         self.namespace["plugin"] = plugin
-
-        self.lock = threading.RLock()
-        self.lookup = TemplateLookup([self.root], self.tempdir)
         self._plugin = plugin
-        self.tempdir = tempfile.gettempdir()
+
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.compile_all()
+
+    def start(self):
+        self.looping_callback = task.LoopingCall(self.check)
+        self.looping_callback.start(self.check_interval, False)
+
+    def stop(self):
+        if self.looping_callback is not None and \
+                self.looping_callback.running:
+            self.looping_callback.stop()
+
+    def _make_lookup(self):
+        # We check for changes ourselves, so Mako doesn't need to stat the
+        # template for every lookup
+        return TemplateLookup(
+            [self.root], self.cache_dir, filesystem_checks=False
+        )
+
+    def _find_templates(self):
+        found = {}
+
+        for path, _, files in os.walk(self.root):
+            for filename in files:
+                if not filename.endswith(".html"):
+                    continue
+
+                full_path = os.path.join(path, filename)
+                name = os.path.relpath(full_path, self.root).replace(
+                    os.sep, "/"
+                )
+
+                found[name] = os.path.getmtime(full_path)
+
+        return found
+
+    def compile_all(self):
+        """
+        Compile every template, and publish the new set. Modules already in
+        the cache are reused if they're newer than their templates.
+        """
+
+        mtimes = self._find_templates()
+        lookup = self._make_lookup()
+        templates = {}
+
+        for name in sorted(mtimes.keys()):
+            try:
+                templates[name] = lookup.get_template(name)
+            except Exception:
+                self.plugin.logger.exception(
+                    "Unable to compile template: %s" % name
+                )
+
+        with self.lock:
+            self.lookup = lookup
+            self.mtimes = mtimes
+            self.templates = templates
+
+        self.plugin.logger.debug("Compiled %s templates" % len(templates))
+
+    def check(self):
+        """
+        Recompile the templates if any of them have been added, removed or
+        changed since they were loaded.
+
+        Everything is recompiled, since templates inherit from and include
+        each other - but the cache means only the changed ones are actually
+        compiled again.
+        """
+
+        if self._find_templates() != self.mtimes:
+            self.plugin.logger.debug("Templates changed, reloading")
+            self.compile_all()
 
     def reset(self):
+        """
+        Throw away all the compiled templates and compile them again.
+        """
+
         with self.lock:
-            shutil.rmtree(self.tempdir)
-            os.mkdir(self.tempdir)
+            shutil.rmtree(self.cache_dir, True)
+            os.makedirs(self.cache_dir)
+
+        self.compile_all()
 
     def load(self, name, _=None):
-        with self.lock:
-            return self.lookup.get_template(name)
+        template = self.templates.get(name, None)
+
+        if template is None:
+            # Not there at startup - don't wait for the next check
+            template = self.lookup.get_template(name)
+
+            with self.lock:
+                templates = dict(self.templates)
+                templates[name] = template
+                self.templates = templates
+
+        return template
@@ -0,0 +1,139 @@
+"""
+A small pool of threads for rendering templates and encoding JSON, so big
+pages don't hold up the reactor (and every protocol running on it).
+
+Routes use this through RequestHandler.render_async() and
+finish_json_async(), which return Deferreds that fire back on the reactor.
+"""
+
+__author__ = 'Gareth Coles'
+
+import threading
+import time
+import weakref
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from plugins.web.access_log import LatencyHistogram
+
+#: Threads to render with
+DEFAULT_THREADS = 4
+
+
+class RenderPool(object):
+    """
+    A bounded thread pool, keeping track of how long jobs wait and run.
+    """
+
+    _plugin_object = None
+
+    pool = None
+
+    _max_depth = 0  # Deepest the queue has been since the last sample
+    _sampled = (0, 0.0)  # Jobs and total run time at the last sample
+
+    @property
+    def plugin(self):
+        return self._plugin_object()
+
+    def __init__(self, plugin, config=None):
+        self._plugin_object = weakref.ref(plugin)
+
+        if config is None:
+            config = {}
+
+        self.threads = config.get("threads", DEFAULT_THREADS)
+        self.lock = threading.Lock()
+
+        self.queued = 0  # Waiting for a thread
+        self.running = 0  # Being worked on
+        self.completed = 0
+        self.failed = 0
+
+        self.run_times = LatencyHistogram()
+        self.wait_times = LatencyHistogram()
+
+    def start(self):
+        self.pool = ThreadPool(1, self.threads, "Web render pool")
+        self.pool.start()
+
+        self.plugin.stats.register_series(
+            "render_queue_depth", self.sample_depth, "jobs",
+            "Deepest the render queue got in each sample"
+        )
+        self.plugin.stats.register_series(
+            "render_time", self.sample_time, "ms",
+            "Mean time taken to render a page or encode JSON"
+        )
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run a function in the pool, returning a Deferred that fires with
+        its result on the reactor.
+        """
+
+        if self.pool is None:
+            # Not started (or stopped) - do it here instead
+            return defer.maybeDeferred(func, *args, **kwargs)
+
+        with self.lock:
+            self.queued += 1
+            self._max_depth = max(self._max_depth, self.queued)
+
+        return threads.deferToThreadPool(
+            reactor, self.pool, self._run, time.time(), func, args, kwargs
+        )
+
+    def _run(self, queued_at, func, args, kwargs):
+        started = time.time()
+
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_times.add((started - queued_at) * 1000)
+
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.run_times.add((time.time() - started) * 1000)
+
+    def sample_depth(self):
+        with self.lock:
+            depth, self._max_depth = self._max_depth, self.queued
+        return depth
+
+    def sample_time(self):
+        with self.lock:
+            count, total = self.run_times.count, self.run_times.total
+
+        old_count, old_total = self._sampled
+        self._sampled = (count, total)
+
+        if count == old_count:
+            return 0.0
+        return (total - old_total) / (count - old_count)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "threads": self.threads,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "run_time": self.run_times.get_stats(),
+                "wait_time": self.wait_times.get_stats()
+            }